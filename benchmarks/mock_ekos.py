@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+import csv
+import io
+import re
+import threading
+
+from datetime import datetime
+from html import escape
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import quote
+from urllib.parse import urlparse
+
+from benchmarks.synthetic import iter_rows
+
+SESSION_COOKIE = 'ekos_bench_session=1'
+
+LOGIN_PAGE = '''<html><head><title>Ekos Login</title></head><body>
+<form method="post" action="/login">
+<input id="txtUsername" name="username">
+<input id="txtPassword" name="password" type="password">
+<button type="submit">Log in</button>
+</form></body></html>'''
+
+# Layout matches the selectors used by EkosExport.open_reports_page: the
+# 'All Reports' item is the first 'nav-option nav-option--main' element and
+# 'Reporting' is the fifth
+APP_PAGE = '''<html><head><title>Ekos</title>
+<style>#group {display: none} iframe {width: 100%; height: 600px}</style>
+<script>
+function showReporting() { document.getElementById('group').style.display = 'block'; }
+function openAllReports() { document.getElementById('classicContainer').src = '/classic/reports'; }
+</script></head><body>
+<div class="nav-option--group" id="group">
+<div class="nav-option nav-option--main" onclick="openAllReports()">All Reports</div>
+</div>
+<div class="nav-options">
+<div class="nav-option nav-option--main">Home</div>
+<div class="nav-option nav-option--main">Production</div>
+<div class="nav-option nav-option--main">Inventory</div>
+<div class="nav-option nav-option--main" onclick="showReporting()">Reporting</div>
+</div>
+<iframe id="classicContainer" name="classicContainer" src="about:blank"></iframe>
+</body></html>'''
+
+REPORTS_PAGE = '''<html><head><title>All Reports</title>
+<style>iframe {{width: 100%; height: 400px}}</style>
+<script>
+function openReport(name) {{
+    var old = document.getElementById('formFrame_0');
+    if (old) {{ old.remove(); }}
+    var frame = document.createElement('iframe');
+    frame.id = 'formFrame_0';
+    frame.name = 'formFrame_0';
+    frame.src = '/classic/report?name=' + encodeURIComponent(name);
+    document.body.appendChild(frame);
+    return false;
+}}
+function closeReport() {{
+    document.getElementById('formFrame_0').style.display = 'none';
+}}
+</script></head><body>
+{links}
+</body></html>'''
+
+REPORT_PAGE = '''<html><head><title>{name}</title>
+<style>#csv_export {{display: none}}</style></head><body>
+<div class="buttonGroupInner"
+    onclick="document.getElementById('csv_export').style.display = 'block'">Export</div>
+<a id="csv_export" href="/export?name={quoted}">CSV</a>
+<div class="CloseButton" onclick="parent.closeReport()">Close</div>
+</body></html>'''
+
+def report_rows(report_name):
+    '''Number of rows served for a report, taken from the trailing number of
+    its name e.g. 'Bench 1000' -> 1000
+    '''
+    match = re.search(r'(\d+)$', report_name)
+    return int(match.group(1)) if match else 100
+
+class MockEkosHandler(BaseHTTPRequestHandler):
+    '''Local stand-in for the Ekos pages driven by EkosExport: login form,
+    navigation, the classicContainer report list, the formFrame_0 report form
+    and the csv export
+    '''
+    def log_message(self, format, *args):
+        return
+
+    def _html(self, content, status=200, headers=()):
+        body = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _redirect(self, location, headers=()):
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+
+    def _logged_in(self):
+        return SESSION_COOKIE in self.headers.get('Cookie', '')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path == '/login':
+            self._redirect(
+                '/app', [('Set-Cookie', SESSION_COOKIE + '; Path=/')]
+            )
+        else:
+            self._html('Not found', 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/':
+            self._html(LOGIN_PAGE)
+        elif not self._logged_in():
+            self._redirect('/')
+        elif url.path == '/app':
+            self._html(APP_PAGE)
+        elif url.path == '/classic/reports':
+            links = '\n'.join(
+                '<p><a href="#" onclick="return openReport(\'{0}\')">{0}</a></p>'.format(
+                    escape(name)
+                ) for name in self.server.reports
+            )
+            self._html(REPORTS_PAGE.format(links=links))
+        elif url.path == '/classic/report':
+            name = query.get('name', [''])[0]
+            self._html(REPORT_PAGE.format(name=escape(name), quoted=quote(name)))
+        elif url.path == '/export':
+            self._export(query.get('name', [''])[0])
+        else:
+            self._html('Not found', 404)
+
+    def _export(self, report_name):
+        '''Streams the synthetic csv for report_name as a download named in the
+        default Ekos format
+        '''
+        filename = 'Export_{}_.csv'.format(datetime.now().strftime('%Y%m%d%H%M%S'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header(
+            'Content-Disposition', 'attachment; filename="{}"'.format(filename)
+        )
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for i, row in enumerate(iter_rows(report_rows(report_name))):
+            writer.writerow(row)
+            if i % 1000 == 0:
+                self.wfile.write(buffer.getvalue().encode('utf-8'))
+                buffer.seek(0)
+                buffer.truncate()
+        self.wfile.write(buffer.getvalue().encode('utf-8'))
+
+class MockEkosServer:
+    '''Runs MockEkosHandler on a local port in a background thread. Pass
+    login_url and app_url to EkosExport
+
+    PARAMS
+    --------------
+    reports : report names listed on the All Reports page. The trailing number
+    of each name is the number of rows exported
+    '''
+    def __init__(self, reports, port=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), MockEkosHandler)
+        self.httpd.reports = list(reports)
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+        self.login_url = self.url
+        self.app_url = self.url + 'app'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
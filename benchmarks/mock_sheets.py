@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import json
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+# Largest request body accepted, similar to the limits of the real API
+MAX_BODY = 10 * 1024 * 1024
+
+class MockSheetsHandler(BaseHTTPRequestHandler):
+    '''Minimal stand-in for the Sheets v4 values endpoints used by SheetsAPI.
+    Values are counted, not stored, so large benchmarks stay cheap
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def _reply(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        stats = self.server.stats
+        with self.server.lock:
+            stats['requests'] += 1
+            stats['bytes'] += length
+        if length > MAX_BODY:
+            self.rfile.read(length)
+            self._reply(413, {'error' : {'code' : 413, 'message' : 'Request too large'}})
+            return
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        path = unquote(urlparse(self.path).path)
+        match = re.match(r'/v4/spreadsheets/([^/]+)/values(.*)$', path)
+        if match == None:
+            self._reply(404, {'error' : {'code' : 404, 'message' : path}})
+            return
+        spreadsheet_id, rest = match.groups()
+        # ranges contain ':' too, so only POST requests carry an action
+        sheet_range, action = rest.lstrip('/'), None
+        if self.command == 'POST':
+            sheet_range, _, action = sheet_range.rpartition(':')
+
+        with self.server.lock:
+            if action in ('clear', 'batchClear'):
+                stats['clears'] += len(body.get('ranges', [sheet_range]))
+            elif action == 'batchUpdate':
+                for value_range in body.get('data', []):
+                    stats['rows'] += len(value_range.get('values', []))
+                stats['updates'] += len(body.get('data', []))
+            else:
+                stats['rows'] += len(body.get('values', []))
+                stats['updates'] += 1
+        self._reply(200, {'spreadsheetId' : spreadsheet_id})
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+class MockSheetsServer:
+    '''Runs MockSheetsHandler on a local port in a background thread. Pass
+    url as api_endpoint to SheetsAPI.get_service
+    '''
+    def __init__(self, port=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), MockSheetsHandler)
+        self.httpd.lock = threading.Lock()
+        self.reset()
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def reset(self):
+        '''Zeroes the request counters'''
+        self.httpd.stats = {
+            'requests' : 0, 'bytes' : 0, 'rows' : 0, 'updates' : 0, 'clears' : 0
+        }
+
+    @property
+    def stats(self):
+        return dict(self.httpd.stats)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+'''Offline benchmarks for EkosExport and SheetsAPI against local stand-ins
+for Ekos and the Sheets v4 API. Run from the repository root:
+
+    python -m benchmarks.run --rows 1000,10000,100000 --output bench.json
+
+The Ekos benchmarks need Firefox and geckodriver and are skipped unless
+--driver-path is given. The Sheets benchmarks need google-api-python-client
+and google-auth-httplib2
+'''
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.mock_ekos import MockEkosServer
+from benchmarks.mock_sheets import MockSheetsServer
+from benchmarks.synthetic import write_report
+from src import metrics
+
+def measure(func, *args, **kwargs):
+    '''Calls func and returns (result, seconds, peak python memory in bytes)'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def bench_sheets(rows_list, work_dir):
+    '''Times each SheetsAPI import path for every report size'''
+    from google.auth.credentials import AnonymousCredentials
+    from src.googleapi import SheetsAPI
+
+    server = MockSheetsServer().start()
+    sheets_api = SheetsAPI(scopes=[], spreadsheet_id='bench')
+    credentials = AnonymousCredentials()
+    service = sheets_api.get_service(credentials, api_endpoint=server.url)
+
+    def queued(path):
+        sheets_api.queue_data(path, 'data!A:T')
+        sheets_api.queue_last_updated('info!B1')
+        return sheets_api.flush(service)
+
+    cases = {
+        'import_data' : lambda path: sheets_api.import_data(
+            service, path, 'data!A:T'
+        ),
+        'import_data_chunked' : lambda path: sheets_api.import_data_chunked(
+            service, path, 'data!A:T'
+        ),
+        'import_data_chunked_x4' : lambda path: sheets_api.import_data_chunked(
+            service, path, 'data!A:T', workers=4, credentials=credentials,
+            api_endpoint=server.url
+        ),
+        'queue_and_flush' : queued,
+        'import_data_delta' : lambda path: sheets_api.import_data_delta(
+            service, path, 'data!A:T', os.path.join(work_dir, 'snapshot.csv')
+        )
+    }
+
+    results = []
+    try:
+        for rows in rows_list:
+            path = write_report(os.path.join(work_dir, 'report_{}.csv'.format(rows)), rows)
+            size = os.path.getsize(path)
+            for name, case in cases.items():
+                server.reset()
+                _, seconds, peak = measure(case, path)
+                stats = server.stats
+                results.append({
+                    'benchmark' : 'sheets.{}'.format(name),
+                    'rows' : rows,
+                    'csv_bytes' : size,
+                    'seconds' : seconds,
+                    'peak_memory_bytes' : peak,
+                    'rows_per_second' : rows / seconds if seconds else None,
+                    'requests' : stats['requests'],
+                    'request_bytes' : stats['bytes'],
+                    'rows_received' : stats['rows']
+                })
+                print_result(results[-1])
+            os.remove(path)
+    finally:
+        server.stop()
+    return results
+
+def bench_ekos(rows_list, work_dir, driver_path, headless):
+    '''Times a full login and export of one report per size from the mock
+    Ekos site, with per-step timings from the metrics tracer
+    '''
+    from src.ekosexport import EkosExport
+
+    reports = ['Bench {}'.format(rows) for rows in rows_list]
+    server = MockEkosServer(reports).start()
+    download_dir = os.path.join(work_dir, 'downloads', '')
+    os.makedirs(download_dir, exist_ok=True)
+
+    results = []
+    metrics.tracer.enabled = True
+    ekos = None
+    try:
+        metrics.tracer.reset()
+        start = time.perf_counter()
+        ekos = EkosExport(
+            'Firefox', driver_path, 2, download_dir, headless=headless,
+            login_url=server.login_url, app_url=server.app_url
+        )
+        ekos.login('bench', 'bench')
+        ekos.open_reports_page()
+        results.append({
+            'benchmark' : 'ekos.startup_and_login',
+            'seconds' : time.perf_counter() - start
+        })
+        print_result(results[-1])
+
+        for rows, report_name in zip(rows_list, reports):
+            metrics.tracer.reset()
+            path, seconds, peak = measure(
+                ekos.export_report_to_file, report_name, 'bench.csv', timeout=600
+            )
+            size = os.path.getsize(path)
+            os.remove(path)
+            steps = {}
+            for span in metrics.tracer.spans:
+                steps[span['step']] = steps.get(span['step'], 0) + span['duration']
+            results.append({
+                'benchmark' : 'ekos.export_report_to_file',
+                'rows' : rows,
+                'csv_bytes' : size,
+                'seconds' : seconds,
+                'peak_memory_bytes' : peak,
+                'rows_per_second' : rows / seconds if seconds else None,
+                'steps' : steps
+            })
+            print_result(results[-1])
+    finally:
+        metrics.tracer.enabled = False
+        if ekos != None:
+            ekos.quit()
+        server.stop()
+    return results
+
+def print_result(result):
+    line = '{:<36} {:>9} rows {:>9.3f}s'.format(
+        result['benchmark'], result.get('rows', ''), result['seconds']
+    )
+    if 'peak_memory_bytes' in result:
+        line += ' {:>9.1f} MiB'.format(result['peak_memory_bytes'] / 2 ** 20)
+    if 'requests' in result:
+        line += ' {:>5} requests'.format(result['requests'])
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--rows', default='1000,10000,100000,1000000',
+        help='comma separated report sizes in rows'
+    )
+    parser.add_argument('--driver-path', help='geckodriver, enables Ekos benchmarks')
+    parser.add_argument('--headless', action='store_true')
+    parser.add_argument('--skip-sheets', action='store_true')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    rows_list = [int(rows) for rows in args.rows.split(',')]
+    work_dir = tempfile.mkdtemp(prefix='ekos_bench_')
+    results = []
+    try:
+        if not args.skip_sheets:
+            results += bench_sheets(rows_list, work_dir)
+        if args.driver_path:
+            results += bench_ekos(rows_list, work_dir, args.driver_path, args.headless)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
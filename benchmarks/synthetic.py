@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import csv
+import random
+
+from datetime import date
+from datetime import timedelta
+
+# 20 columns, matching the data!A:T range used by deliveries.py
+HEADER = [
+    'Invoice ID', 'Delivery Date', 'Customer', 'Customer ID', 'Distributor',
+    'Route', 'Product', 'SKU', 'Package', 'Quantity', 'Unit Price', 'Total',
+    'Deposit', 'Discount', 'Tax', 'Status', 'Sales Rep', 'City', 'State', 'Notes'
+]
+
+def iter_rows(rows, seed=0):
+    '''Yields the header followed by rows of synthetic delivery data
+
+    PARAMS
+    -----------
+    rows : number of data rows
+    seed : random seed, so runs with the same rows are identical
+    '''
+    rng = random.Random(seed)
+    start = date(2021, 1, 1)
+    yield HEADER
+    for i in range(rows):
+        quantity = rng.randint(1, 50)
+        price = round(rng.uniform(20, 200), 2)
+        yield [
+            str(100000 + i),
+            str(start + timedelta(days=i % 365)),
+            'Customer {}'.format(i % 500),
+            str(i % 500),
+            'Distributor {}'.format(i % 7),
+            'Route {}'.format(i % 12),
+            'Product {}'.format(i % 40),
+            'SKU-{:05d}'.format(i % 40),
+            rng.choice(['1/2 BBL', '1/6 BBL', '24x12oz', '24x16oz']),
+            str(quantity),
+            '{:.2f}'.format(price),
+            '{:.2f}'.format(quantity * price),
+            '{:.2f}'.format(quantity * 30.0),
+            '0.00',
+            '{:.2f}'.format(quantity * price * 0.08),
+            rng.choice(['Delivered', 'Scheduled', 'Invoiced']),
+            'Rep {}'.format(i % 5),
+            'City {}'.format(i % 30),
+            'CA',
+            ''
+        ]
+
+def write_report(path, rows, seed=0):
+    '''Writes a synthetic report csv with rows data rows to path'''
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(iter_rows(rows, seed))
+    return path
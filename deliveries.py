@@ -1,14 +1,22 @@
 #!/usr/bin/env python
+import sys
 import yaml
 import logging
 
-from src import ekosexport
+from src import delivery
 from src import googleapi
+from src.catalog import ReportCatalog
+from src import metrics
+from src import reportstate
+from src import runstate
+from src import executor
+from src.exportpool import SessionPool
+from src.jobs import build_plan
+from src.jobs import jobs_from_config
+from src.jobs import limits_from_config
 
 #Config file
 conf_file = './deliveries_config_SAMPLE.yaml' # path to config file
-stream = open(conf_file, 'r')
-config = yaml.safe_load(stream)
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -24,63 +32,122 @@ formatter = logging.Formatter(
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
-# Variables
-# EkosExport class
-browser = 'Firefox'
-driver_path = config['driver_path']
-profile_dir = 2 # set custom directory
-profile_dir_path = config['profile_dir_path']
-headless = False
-
-# Ekos
-username = config['ekos_user']
-password = config['ekos_pw']
-report_name = 'Distro - This Week'
-
 # GoogleAPI
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-SPREADSHEET_ID = config['spreadsheet_id']
 
-# credentials
-cred_path = config['cred_path']
-token_path = config['token_path']
+def load_config(conf_file):
+    '''Reads the YAML config file'''
+    with open(conf_file, 'r') as stream:
+        return yaml.safe_load(stream)
 
-# Sheet info
-DATA_RANGE_NAME = 'data!A:T'
-INFO_RANGE_NAME = 'info!B1'
-data = '{}{}.csv'.format(config['profile_dir_path'], report_name)
+def main(config, force=False):
+    '''Exports every report used by the jobs in config once and delivers it
+    to each of its sinks, running independent work concurrently within the
+    limits section of the config. Returns True if every task succeeded
 
-if __name__ == '__main__':
-    try:
-        logger.info('Instantiating ekos object')
-        ekos = ekosexport.EkosExport(
-            browser = browser,
-            driver_path = driver_path,
-            profile_dir = profile_dir,
-            profile_dir_path = profile_dir_path,
-            headless = headless
-        )
-        logger.info('Instantiating google sheets object')
-        gs = googleapi.SheetsAPI(
-            scopes = SCOPES,
-            spreadsheet_id = SPREADSHEET_ID
-        )
+    PARAMS
+    -----------
+    config : dict loaded from the YAML config file
+    force : upload reports even when they are unchanged
+    '''
+    # Variables
+    # EkosExport class
+    ekos_kwargs = {
+        'browser' : 'Firefox',
+        'driver_path' : config['driver_path'],
+        'headless' : False,
+        'lean' : config.get('lean_profile', False), # block images, fonts and telemetry
+        'page_load_strategy' : config.get('page_load_strategy', 'normal'), # or eager/none
+        'wait_stats_path' : config.get('wait_stats_path'), # learned wait timeouts
+        'scripted' : config.get('scripted_export', False), # export each report in one script
+        'http_export' : config.get('http_export', False), # download known exports over HTTP
+    }
+    profile_dir_path = config['profile_dir_path']
+
+    # Ekos
+    username = config['ekos_user']
+    password = config['ekos_pw']
+    cookie_path = config.get('cookie_path') # None disables the cookie cache
+    catalog_path = config.get('catalog_path') # None navigates through the menu
+
+    # credentials
+    cred_path = config['cred_path']
+    token_path = config['token_path']
+
+    # Jobs
+    jobs = jobs_from_config(config)
+    limits = limits_from_config(config) # browser, sheets and transform
+
+    # Change detection
+    state_path = config.get('state_path') # None uploads on every run
+
+    # Checkpoints
+    checkpoint_path = config.get('checkpoint_path') # None restarts failed runs
+    checkpoint_max_age = config.get('checkpoint_max_age', 3600) # seconds a run can resume
+    stage_attempts = config.get('stage_attempts', 3) # tries per task
+    retry_delay = config.get('retry_delay', 2) # seconds before the first retry, doubled
 
-        logger.info('Beginning report download process')
-        ekos.login(username, password)
-        ekos.download_report(report_name)
-        ekos.rename_file('{}.csv'.format(report_name))
-        ekos.quit()
-
-        credentials = gs.get_credentials(cred_path, token_path)
-        service = gs.get_service(credentials)
-        gs.import_data(
-            service = service,
-            data = data,
-            sheet_range = DATA_RANGE_NAME
+    # Warehouse
+    warehouse_path = config.get('warehouse_path') # None keeps no history
+
+    # Metrics
+    trace_path = config.get('trace_path') # per run JSON trace
+    prometheus_path = config.get('prometheus_path') # node_exporter textfile
+    metrics.tracer.enabled = trace_path != None or prometheus_path != None
+
+    sessions = SessionPool(
+        ekos_kwargs, profile_dir_path, username, password,
+        cookie_path = cookie_path,
+        size = limits['browser']
+    )
+    catalog = ReportCatalog(catalog_path) if catalog_path != None else None
+    state = reportstate.ReportState(state_path) if state_path != None else None
+
+    gs = googleapi.SheetsAPI(
+        scopes = SCOPES,
+        spreadsheet_id = config['spreadsheet_id']
+    )
+    service = delivery.thread_service(gs, cred_path, token_path)
+
+    def export(report_name):
+        with sessions.session() as ekos:
+            return delivery.export_report(ekos, report_name, catalog)
+
+    checkpoint = None
+    if checkpoint_path != None:
+        checkpoint = runstate.RunCheckpoint(
+            checkpoint_path, 'deliveries', max_age=checkpoint_max_age
         )
-        gs.last_updated(service = service, sheet_range = INFO_RANGE_NAME)
+    dag = executor.DAGExecutor(
+        limits = limits,
+        checkpoint = checkpoint,
+        attempts = stage_attempts,
+        base_delay = retry_delay
+    )
+    build_plan(
+        dag, jobs, export,
+        delivery.uploader(service, SCOPES, state, force),
+        delivery.stamper(service, SCOPES),
+        work_dir = profile_dir_path,
+        load = delivery.warehouse_loader(warehouse_path, jobs) if warehouse_path != None else None
+    )
+
+    logger.info('Delivering {} jobs in {} tasks'.format(len(jobs), len(dag.tasks)))
+    try:
+        results = dag.run()
+    finally:
+        sessions.close()
+        if trace_path != None:
+            metrics.tracer.write_trace(trace_path)
+        if prometheus_path != None:
+            metrics.tracer.write_prometheus(prometheus_path)
+    return all(result in (executor.DONE, executor.RESUMED)
+        for result in results.values())
+
+if __name__ == '__main__':
+    try:
+        ok = main(load_config(conf_file), force='--force' in sys.argv)
     except Exception as e:
-        ekos.quit()
         logger.exception(e)
-
+        ok = False
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+import signal
+import sys
+import logging
+
+from deliveries import load_config
+from src import delivery
+from src import googleapi
+from src import reportstate
+from src.catalog import ReportCatalog
+from src.daemon import Daemon
+from src.daemon import ScheduledJob
+from src.daemon import send_command
+from src.jobs import jobs_from_config
+from src.jobs import limits_from_config
+
+#Config file
+conf_file = './deliveries_config_SAMPLE.yaml' # path to config file
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# GoogleAPI
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+def main(config, args=()):
+    '''Runs the daemon described by the daemon section of config until it is
+    stopped, or with args e.g. ['run', 'distro'], ['status'] or ['stop'],
+    sends that command to a running daemon. Returns the exit status
+
+    PARAMS
+    -----------
+    config : dict loaded from the YAML config file
+    args : command line arguments
+    '''
+    daemon_config = config['daemon']
+    socket_path = daemon_config.get('socket_path') # None disables on demand runs
+
+    # ekosd.py run <job> / status / stop talks to a running daemon
+    if args:
+        if socket_path == None:
+            print('daemon.socket_path is not set in {}, so there is no running daemon to '
+                'send {} to'.format(conf_file, args[0]), file=sys.stderr)
+            return 2
+        command = args[0]
+        kwargs = {'job' : args[1]} if command == 'run' and len(args) > 1 else {}
+        try:
+            reply = send_command(socket_path, command, **kwargs)
+        except OSError as e:
+            print('Could not reach the daemon at {}: {}'.format(socket_path, e),
+                file=sys.stderr)
+            return 1
+        print(reply)
+        return 0 if reply.get('ok') else 1
+
+    # EkosExport class
+    ekos_kwargs = {
+        'browser' : 'Firefox',
+        'driver_path' : config['driver_path'],
+        'headless' : True,
+        'lean' : config.get('lean_profile', False),
+        'page_load_strategy' : config.get('page_load_strategy', 'normal'),
+        'wait_stats_path' : config.get('wait_stats_path'),
+        'scripted' : config.get('scripted_export', False),
+        'http_export' : config.get('http_export', False),
+    }
+    download_dir = config['profile_dir_path'] # one sub directory per session
+    catalog_path = config.get('catalog_path') # None navigates through the menu
+    state_path = config.get('state_path') # None uploads on every run
+    warehouse_path = config.get('warehouse_path') # None keeps no history
+
+    # schedule entries name jobs of the jobs section
+    jobs = jobs_from_config(config)
+    jobs_by_name = {job.name : job for job in jobs}
+    scheduled = [ScheduledJob.from_config(entry, jobs_by_name)
+        for entry in daemon_config['schedule']]
+
+    state = reportstate.ReportState(state_path) if state_path != None else None
+    gs = googleapi.SheetsAPI(scopes = SCOPES, spreadsheet_id = config['spreadsheet_id'])
+    service = delivery.thread_service(gs, config['cred_path'], config['token_path'])
+    daemon = Daemon(
+        ekos_kwargs = ekos_kwargs,
+        download_dir = download_dir,
+        username = config['ekos_user'],
+        password = config['ekos_pw'],
+        jobs = scheduled,
+        upload = delivery.uploader(service, SCOPES, state),
+        stamp = delivery.stamper(service, SCOPES),
+        load = delivery.warehouse_loader(warehouse_path, jobs) if warehouse_path != None else None,
+        catalog = ReportCatalog(catalog_path) if catalog_path != None else None,
+        sessions = daemon_config.get('sessions', 1),
+        cookie_path = config.get('cookie_path'),
+        socket_path = socket_path,
+        limits = limits_from_config(config),
+        attempts = config.get('stage_attempts', 3),
+        base_delay = config.get('retry_delay', 2),
+        recycle_jobs = daemon_config.get('recycle_jobs', 50),
+        max_memory_mb = daemon_config.get('max_memory_mb'),
+        health_interval = daemon_config.get('health_interval', 300)
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.exception(e)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(load_config(conf_file), sys.argv[1:]))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+class ReportCatalog:
+    '''Index of the reports listed on the Ekos All Reports page, persisted to
+    disk so exports can load the report list directly and open a report without
+    searching the page for it. Built and refreshed by EkosExport.build_catalog.
+    Shared by the sessions of a SessionPool or Daemon, so updates are locked
+
+    PARAMS
+    --------------
+    path : PATH to the JSON catalog file
+
+    ttl : seconds before the catalog is considered stale and rebuilt
+    '''
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.built = 0
+        self.reports_url = None
+        self.reports = {} # report_name : {'href', 'id', 'index', 'export_url'}
+        self.lock = threading.RLock() # sessions update the catalog from their threads
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.built = data['built']
+                self.reports_url = data['reports_url']
+                self.reports = data['reports']
+            except (ValueError, KeyError):
+                logger.warning('Report catalog {} is corrupt. Ignoring'.format(path))
+
+    def is_stale(self):
+        '''Returns True if the catalog is empty or older than ttl'''
+        return not self.reports or time.time() - self.built > self.ttl
+
+    def get(self, report_name):
+        '''Returns the catalog entry for report_name, or None'''
+        return self.reports.get(report_name)
+
+    def update(self, reports_url, links):
+        '''Merges links scraped from the All Reports page into the catalog and
+        saves it
+
+        PARAMS
+        -----------
+        reports_url : url of the All Reports page loaded in classicContainer
+        links : list of {'name', 'href', 'index'} dicts, one per report link
+        '''
+        with self.lock:
+            self.reports_url = reports_url
+            for link in links:
+                name = link['name']
+                if not name:
+                    continue
+                match = re.search(r'[?&](?:report_?id|id)=(\w+)', link['href'] or '', re.I)
+                entry = self.reports.setdefault(name, {})
+                entry.update({
+                    'href' : link['href'],
+                    'id' : match.group(1) if match else None,
+                    'index' : link['index']
+                })
+            self.built = time.time()
+            self.save()
+        logger.info('Report catalog updated with {} reports'.format(len(links)))
+        return
+
+    def set_export_url(self, report_name, url):
+        '''Records the url behind the csv_export link of report_name, seen when
+        it was exported in the browser, so later exports can download it over
+        HTTP (see src.httpexport.HttpExporter). Links without a url e.g.
+        javascript: and reports not in the catalog are ignored
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        url : href of the csv_export link
+        '''
+        with self.lock:
+            entry = self.reports.get(report_name)
+            if entry == None or not url or url.startswith('javascript:') or url.endswith('#'):
+                return
+            if entry.get('export_url') != url:
+                entry['export_url'] = url
+                self.save()
+        return
+
+    def save(self):
+        '''Writes the catalog file atomically, through a temporary file unique
+        to the call so concurrent saves do not write to the same one
+        '''
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)),
+                prefix=os.path.basename(self.path) + '.',
+                suffix='.tmp'
+            )
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'built' : self.built,
+                    'reports_url' : self.reports_url,
+                    'reports' : self.reports
+                }, f, indent=2)
+            os.replace(tmp_path, self.path)
+        return
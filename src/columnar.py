@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+
+from datetime import datetime
+from urllib.parse import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError: # optional, only needed for typed parsing and the cache
+    pa = None
+
+from src.reportstate import fingerprint
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Column types inferred by infer_schema
+ID = 'id'
+DATE = 'date'
+INTEGER = 'integer'
+DECIMAL = 'decimal'
+CURRENCY = 'currency'
+STRING = 'string'
+
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y %I:%M %p']
+TIME_DIRECTIVE = re.compile(r'%[HIMSfp]')
+ID_HEADER = re.compile(r'(\bid\b|#|number|\bno\b|sku|invoice)', re.I)
+INTEGER_VALUE = re.compile(r'^-?\d+$')
+DECIMAL_VALUE = re.compile(r'^-?\d*\.\d+$|^-?\d+\.?\d*$')
+CURRENCY_VALUE = re.compile(r'^\(?-?\$-?[\d,]*\.?\d*\)?$|^-?[\d]{1,3}(,\d{3})+(\.\d+)?$')
+
+def _date_format(values):
+    '''Returns the first format in DATE_FORMATS that parses every value'''
+    for date_format in DATE_FORMATS:
+        try:
+            for value in values:
+                datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return date_format
+    return None
+
+def infer_schema(path, sample_rows=1000):
+    '''Infers the type of each column of a csv from its header and the first
+    sample_rows rows. Returns a dict of column : (type, date format or None)
+
+    Integer columns whose header looks like an identifier (ID, #, Number, SKU,
+    Invoice) or whose values have leading zeros are typed ID and kept as
+    dictionary encoded strings
+
+    PARAMS
+    -----------
+    path : PATH to csv
+    sample_rows : number of rows inspected
+    '''
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        samples = [[] for _ in header]
+        for i, row in enumerate(reader):
+            if i >= sample_rows:
+                break
+            for j, value in enumerate(row[:len(header)]):
+                value = value.strip()
+                if value:
+                    samples[j].append(value)
+
+    schema = {}
+    for column, values in zip(header, samples):
+        if not values:
+            schema[column] = (STRING, None)
+        elif all(INTEGER_VALUE.match(v) for v in values):
+            leading_zeros = any(len(v) > 1 and v.startswith('0') for v in values)
+            if leading_zeros or ID_HEADER.search(column):
+                schema[column] = (ID, None)
+            else:
+                schema[column] = (INTEGER, None)
+        elif all(DECIMAL_VALUE.match(v) for v in values):
+            schema[column] = (DECIMAL, None)
+        elif all(CURRENCY_VALUE.match(v) for v in values):
+            schema[column] = (CURRENCY, None)
+        else:
+            date_format = _date_format(values)
+            if date_format != None:
+                schema[column] = (DATE, date_format)
+            elif ID_HEADER.search(column):
+                schema[column] = (ID, None)
+            else:
+                schema[column] = (STRING, None)
+    return schema
+
+def _require_pyarrow():
+    if pa == None:
+        raise ImportError('pyarrow is required for typed parsing: pip install pyarrow')
+
+def load_report(path, schema=None):
+    '''Parses a csv into a pyarrow Table of typed columns. Empty cells become
+    nulls, currency is parsed to float64, dates to date32, dates with a time
+    to timestamp[s], integers to int64 and IDs and strings are dictionary
+    encoded. Use column(name).to_numpy() for NumPy arrays
+
+    PARAMS
+    -----------
+    path : PATH to csv
+    schema : schema from infer_schema. Inferred when None
+    '''
+    _require_pyarrow()
+    if schema == None:
+        schema = infer_schema(path)
+    # read every column as text, then convert, so Ekos formats are handled here
+    table = pa_csv.read_csv(
+        path,
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column : pa.string() for column in schema},
+            strings_can_be_null=True,
+            null_values=['']
+        )
+    )
+    columns = []
+    for name in table.column_names:
+        column = table.column(name)
+        column_type, date_format = schema.get(name, (STRING, None))
+        try:
+            if column_type == INTEGER:
+                column = pc.cast(column, pa.int64())
+            elif column_type == DECIMAL:
+                column = pc.cast(column, pa.float64())
+            elif column_type == CURRENCY:
+                negative = pc.match_substring(column, '(')
+                column = pc.cast(
+                    pc.replace_substring_regex(column, r'[$,()]', ''), pa.float64()
+                )
+                column = pc.if_else(negative, pc.negate(column), column)
+            elif column_type == DATE:
+                column = pc.strptime(column, format=date_format, unit='s')
+                if not TIME_DIRECTIVE.search(date_format):
+                    column = pc.cast(column, pa.date32())
+            else:
+                column = pc.dictionary_encode(column)
+        except pa.ArrowInvalid as e:
+            # a value outside the sampled rows did not fit, keep the text
+            logger.warning('Column {} kept as text: {}'.format(name, e))
+            column = pc.dictionary_encode(table.column(name))
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+class ColumnarCache:
+    '''Cache of typed report tables stored as Parquet files, one per report
+    version. A version is identified by the content hash of the exported csv
+    and a hash of the schema it was parsed with, so re-reading an unchanged
+    export skips parsing the csv entirely and a changed schema is parsed again
+
+    Files are named <report>__<content hash>-<schema hash>.parquet, where the
+    report name is percent encoded including '_', so the '__' separator never
+    occurs in it and each report's versions are found exactly
+
+    PARAMS
+    --------------
+    cache_dir : directory the Parquet files are stored in
+
+    keep : number of versions kept per report. Older versions are removed
+    '''
+    def __init__(self, cache_dir, keep=5):
+        self.cache_dir = cache_dir
+        self.keep = keep
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _prefix(self, report_name):
+        return quote(report_name, safe='').replace('_', '%5F') + '__'
+
+    def path(self, report_name, csv_path, schema=None):
+        '''Returns the Parquet path for the version of report_name in csv_path
+        parsed with schema. schema is inferred when None
+        '''
+        if schema == None:
+            schema = infer_schema(csv_path)
+        content_hash, _ = fingerprint(csv_path)
+        schema_hash = hashlib.sha256(
+            json.dumps(schema, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(
+            self.cache_dir,
+            '{}{}-{}.parquet'.format(
+                self._prefix(report_name), content_hash[:16], schema_hash[:8]
+            )
+        )
+
+    def load(self, report_name, csv_path, schema=None):
+        '''Returns the typed table for the csv at csv_path, parsing it and
+        writing it to the cache if this version is not cached yet
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        csv_path : PATH to the exported csv
+        schema : schema from infer_schema. Inferred when None
+        '''
+        _require_pyarrow()
+        if schema == None:
+            schema = infer_schema(csv_path)
+        cache_path = self.path(report_name, csv_path, schema)
+        if os.path.exists(cache_path):
+            logger.info('Loading {} from columnar cache'.format(report_name))
+            table = pq.read_table(cache_path, memory_map=True)
+            # Parquet has no second resolution, so timestamps come back in ms
+            return table.cast(pa.schema([
+                field.with_type(pa.timestamp('s')) if pa.types.is_timestamp(field.type)
+                else field for field in table.schema
+            ]))
+
+        table = load_report(csv_path, schema)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, cache_path)
+        logger.info('Cached {} rows of {} at {}'.format(
+            table.num_rows, report_name, cache_path
+        ))
+        self.prune(report_name)
+        return table
+
+    def prune(self, report_name):
+        '''Removes all but the newest keep versions of report_name'''
+        prefix = self._prefix(report_name)
+        version = re.compile(r'[0-9a-f]{16}-[0-9a-f]{8}\.parquet')
+        versions = sorted(
+            (os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                if f.startswith(prefix) and version.fullmatch(f[len(prefix):])),
+            key=os.path.getmtime,
+            reverse=True
+        )
+        for path in versions[self.keep:]:
+            os.remove(path)
+        return
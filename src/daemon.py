@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+try:
+    import psutil
+except ImportError: # optional, only needed to recycle sessions on memory growth
+    psutil = None
+
+from selenium.common.exceptions import WebDriverException
+
+from src import delivery
+from src import executor
+from src.ekosexport import EkosExport
+from src.jobs import build_plan
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+class ScheduledJob:
+    '''Jobs of the config (see jobs.jobs_from_config) delivered together on a
+    fixed interval by the Daemon. A report used by several of the jobs is
+    exported once per run
+
+    PARAMS
+    --------------
+    name : name used on the control socket
+
+    jobs : list of jobs.Job
+
+    every : seconds between runs. None only runs the jobs on demand
+    '''
+    def __init__(self, name, jobs, every=None):
+        self.name = name
+        self.jobs = jobs
+        self.every = every
+        self.next_run = time.time() if every != None else None
+        self.last_run = None
+        self.last_result = None
+        self.queued = False
+
+    @classmethod
+    def from_config(cls, entry, jobs):
+        '''Creates a scheduled job from a schedule entry of the YAML config,
+        naming one job or a list of jobs of the jobs section
+
+            schedule :
+              - job : distro
+                every : 900
+              - name : morning
+                jobs : [distro, inventory]
+
+        PARAMS
+        -----------
+        entry : schedule entry
+        jobs : dict of job name : jobs.Job
+
+        Raises ValueError if the entry names a job that is not in jobs
+        '''
+        names = entry['jobs'] if 'jobs' in entry else [entry['job']]
+        unknown = [name for name in names if name not in jobs]
+        if unknown:
+            raise ValueError('Unknown jobs {} in daemon schedule'.format(unknown))
+        return cls(
+            name = entry.get('name', '+'.join(names)),
+            jobs = [jobs[name] for name in names],
+            every = entry.get('every')
+        )
+
+class WarmSession:
+    '''A logged in EkosExport session kept open between jobs. The session is
+    recycled, i.e. quit and started again, after recycle_jobs jobs or when the
+    browser uses more than max_memory_mb, and is health checked before a job
+    when it has been idle for health_interval seconds
+
+    PARAMS
+    --------------
+    ekos_kwargs : keyword arguments of EkosExport
+
+    username, password, cookie_path : see EkosExport.login
+    '''
+    def __init__(
+        self,
+        ekos_kwargs,
+        username,
+        password,
+        cookie_path=None,
+        recycle_jobs=50,
+        max_memory_mb=None,
+        health_interval=300
+    ):
+        self.ekos_kwargs = ekos_kwargs
+        self.username = username
+        self.password = password
+        self.cookie_path = cookie_path
+        self.recycle_jobs = recycle_jobs
+        self.max_memory_mb = max_memory_mb
+        self.health_interval = health_interval
+        self.ekos = None
+        self.jobs = 0
+        self.last_used = 0
+
+    def start(self):
+        '''Starts the browser and logs in'''
+        logger.info('Starting warm Ekos session')
+        self.ekos = EkosExport(**self.ekos_kwargs)
+        try:
+            self.ekos.login(self.username, self.password, cookie_path=self.cookie_path)
+        except Exception:
+            self.quit()
+            raise
+        self.jobs = 0
+        self.last_used = time.monotonic()
+        return
+
+    def quit(self):
+        if self.ekos != None:
+            try:
+                self.ekos.quit()
+            except WebDriverException as e:
+                logger.warning('Error quitting session: {}'.format(e))
+            self.ekos = None
+        return
+
+    def memory_mb(self):
+        '''Returns the resident memory of the webdriver and browser processes
+        in MB, or None if it can not be measured
+        '''
+        if psutil == None or self.ekos == None:
+            return None
+        service = getattr(self.ekos.session, 'service', None)
+        process = getattr(service, 'process', None)
+        if process == None:
+            return None
+        try:
+            driver = psutil.Process(process.pid)
+            processes = [driver] + driver.children(recursive=True)
+            return sum(p.memory_info().rss for p in processes) / (1024 * 1024)
+        except psutil.Error:
+            return None
+
+    def healthy(self):
+        '''Returns True if the browser responds and is still logged in. The app
+        page is reloaded first, as a page loaded before the session expired
+        still shows the navigation
+        '''
+        try:
+            self.ekos.session.switch_to.default_content()
+            self.ekos.load_page(self.ekos.app_url)
+            return self.ekos.is_logged_in(timeout=5)
+        except WebDriverException:
+            return False
+
+    def ensure(self):
+        '''Returns a logged in EkosExport on the top level document, starting,
+        recycling or logging in again as needed. A job that failed inside a
+        report frame would otherwise leave the next job in that frame
+        '''
+        if self.ekos != None:
+            memory = self.memory_mb()
+            if self.jobs >= self.recycle_jobs:
+                logger.info('Recycling session after {} jobs'.format(self.jobs))
+                self.quit()
+            elif self.max_memory_mb != None and memory != None and memory > self.max_memory_mb:
+                logger.info('Recycling session using {:.0f}MB'.format(memory))
+                self.quit()
+            elif time.monotonic() - self.last_used > self.health_interval:
+                if not self.healthy():
+                    logger.info('Session failed health check. Logging in again')
+                    try:
+                        self.ekos.login(
+                            self.username, self.password, cookie_path=self.cookie_path
+                        )
+                    except Exception as e:
+                        logger.warning('Login failed ({}). Recycling session'.format(e))
+                        self.quit()
+        if self.ekos != None:
+            try:
+                self.ekos.session.switch_to.default_content()
+            except WebDriverException as e:
+                logger.warning('Session not responding ({}). Recycling session'.format(e))
+                self.quit()
+        if self.ekos == None:
+            self.start()
+        return self.ekos
+
+    def finished_job(self, ok):
+        '''Counts a job run on the session. A failed job forces a health check
+        before the next one
+        '''
+        self.jobs += 1
+        self.last_used = time.monotonic() if ok else 0
+        return
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    '''Reads one JSON command per line and writes one JSON reply per line'''
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                reply = self.server.daemon.command(request)
+            except Exception as e:
+                reply = {'ok' : False, 'error' : str(e)}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def send_command(socket_path, command, timeout=None, **kwargs):
+    '''Sends a command to a running Daemon's control socket and returns its
+    reply, e.g. send_command(path, 'run', job='distro')
+    '''
+    request = dict(kwargs, command=command)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+
+class Daemon:
+    '''Long running alternative to running deliveries.py from cron. Keeps one
+    or more logged in Ekos sessions warm and runs ScheduledJobs on their
+    schedules, so a job only pays for the export and upload. Each session has
+    its own worker thread and download directory
+
+    A run delivers its jobs the way deliveries.py does, as a DAGExecutor plan
+    (see jobs.build_plan) with its exports on the run's session. Failed tasks
+    are retried within the run. There are no checkpoints, a failed run is
+    simply run again when it is next due
+
+    Jobs can also be run on demand through a Unix socket at socket_path, one
+    JSON command per line:
+
+        {"command": "run", "job": "<name>"} runs a job and replies with its result
+        {"command": "status"} replies with the jobs and sessions
+        {"command": "stop"} stops the daemon
+
+    PARAMS
+    --------------
+    ekos_kwargs : keyword arguments of EkosExport. profile_dir_path is
+    replaced by a directory per session under download_dir
+
+    download_dir : base download directory, e.g. download_dir/session_0/
+
+    username, password, cookie_path : see EkosExport.login
+
+    jobs : list of ScheduledJob
+
+    upload, stamp, load : task functions of jobs.build_plan e.g. from
+    delivery.uploader, delivery.stamper and delivery.warehouse_loader
+
+    catalog : ReportCatalog used to open reports directly. None navigates
+    through the menu
+
+    sessions : number of warm sessions, i.e. jobs run at the same time
+
+    socket_path : PATH of the control socket. None disables it
+
+    limits : DAGExecutor limits of each run (see jobs.limits_from_config).
+    Each run exports on its own session, so its browser limit is always 1
+
+    attempts, base_delay : retries of failed tasks (see runstate.retry)
+
+    recycle_jobs, max_memory_mb, health_interval : see WarmSession
+    '''
+    def __init__(
+        self,
+        ekos_kwargs,
+        download_dir,
+        username,
+        password,
+        jobs,
+        upload,
+        stamp,
+        load=None,
+        catalog=None,
+        sessions=1,
+        cookie_path=None,
+        socket_path=None,
+        limits=None,
+        attempts=3,
+        base_delay=2,
+        recycle_jobs=50,
+        max_memory_mb=None,
+        health_interval=300
+    ):
+        self.jobs = {job.name : job for job in jobs}
+        self.upload = upload
+        self.stamp = stamp
+        self.load = load
+        self.catalog = catalog
+        self.socket_path = socket_path
+        self.limits = dict(limits or {}, browser=1)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.server = None
+
+        self.sessions = []
+        for i in range(sessions):
+            kwargs = dict(ekos_kwargs)
+            kwargs['profile_dir'] = 2
+            kwargs['profile_dir_path'] = os.path.join(
+                download_dir, 'session_{}'.format(i), ''
+            )
+            os.makedirs(kwargs['profile_dir_path'], exist_ok=True)
+            self.sessions.append(WarmSession(
+                kwargs, username, password, cookie_path,
+                recycle_jobs, max_memory_mb, health_interval
+            ))
+
+    def _run_job(self, session, job):
+        '''Runs job on session and returns True if every task succeeded'''
+        start = time.perf_counter()
+        try:
+            ekos = session.ensure()
+            dag = executor.DAGExecutor(
+                limits = self.limits,
+                attempts = self.attempts,
+                base_delay = self.base_delay
+            )
+            build_plan(
+                dag, job.jobs,
+                lambda report_name: delivery.export_report(ekos, report_name, self.catalog),
+                self.upload, self.stamp,
+                work_dir = session.ekos_kwargs['profile_dir_path'],
+                load = self.load
+            )
+            results = dag.run()
+            ok = all(result == executor.DONE for result in results.values())
+        except Exception as e:
+            logger.exception(e)
+            ok = False
+        session.finished_job(ok)
+        logger.info('Job {} {} in {:.1f}s'.format(
+            job.name, 'succeeded' if ok else 'failed', time.perf_counter() - start
+        ))
+        return ok
+
+    def _worker(self, session):
+        '''Runs jobs off the work queue on session until None is received'''
+        while True:
+            item = self.work.get()
+            if item == None:
+                break
+            job, reply = item
+            ok = self._run_job(session, job)
+            with self.lock:
+                job.queued = False
+                job.last_run = time.time()
+                job.last_result = ok
+            if reply != None:
+                reply.put(ok)
+        session.quit()
+        return
+
+    def _enqueue(self, job, reply=None):
+        '''Queues job unless it is already waiting to run. Returns True if queued'''
+        with self.lock:
+            if job.queued and reply == None:
+                return False
+            job.queued = True
+        self.work.put((job, reply))
+        return True
+
+    def _schedule(self):
+        '''Queues jobs as they fall due until the daemon stops'''
+        while not self.stopping.is_set():
+            now = time.time()
+            due = [job for job in self.jobs.values()
+                if job.next_run != None and job.next_run <= now]
+            for job in due:
+                self._enqueue(job)
+                # skip missed runs rather than queueing a backlog of them
+                job.next_run = max(job.next_run + job.every, now)
+            upcoming = [job.next_run for job in self.jobs.values() if job.next_run != None]
+            timeout = max(0, min(upcoming) - time.time()) if upcoming else None
+            self.stopping.wait(timeout)
+        return
+
+    def command(self, request):
+        '''Handles a control socket request and returns the reply'''
+        command = request.get('command')
+        if command == 'run':
+            if self.stopping.is_set():
+                return {'ok' : False, 'error' : 'Daemon is stopping'}
+            job = self.jobs.get(request.get('job'))
+            if job == None:
+                return {'ok' : False, 'error' : 'Unknown job: {}'.format(request.get('job'))}
+            reply = queue.Queue()
+            self._enqueue(job, reply)
+            return {'ok' : reply.get(), 'job' : job.name}
+        if command == 'status':
+            with self.lock:
+                jobs = {job.name : {
+                    'jobs' : [config_job.name for config_job in job.jobs],
+                    'next_run' : job.next_run,
+                    'last_run' : job.last_run,
+                    'last_result' : job.last_result,
+                    'queued' : job.queued,
+                } for job in self.jobs.values()}
+            sessions = [{
+                'running' : session.ekos != None,
+                'jobs' : session.jobs,
+                'memory_mb' : session.memory_mb(),
+            } for session in self.sessions]
+            return {'ok' : True, 'jobs' : jobs, 'sessions' : sessions}
+        if command == 'stop':
+            self.stopping.set()
+            return {'ok' : True}
+        return {'ok' : False, 'error' : 'Unknown command: {}'.format(command)}
+
+    def start(self):
+        '''Starts the session workers, the scheduler and the control socket'''
+        for session in self.sessions:
+            t = threading.Thread(target=self._worker, args=(session,), daemon=True)
+            t.start()
+            self.threads.append(t)
+        scheduler = threading.Thread(target=self._schedule, daemon=True)
+        scheduler.start()
+
+        if self.socket_path != None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path) # left behind by a previous daemon
+            self.server = _ControlServer(self.socket_path, _ControlHandler)
+            self.server.daemon = self
+            os.chmod(self.socket_path, 0o600)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info('Control socket listening at {}'.format(self.socket_path))
+        logger.info('Daemon started with {} sessions and {} jobs'.format(
+            len(self.sessions), len(self.jobs)
+        ))
+        return
+
+    def serve_forever(self):
+        '''Starts the daemon and blocks until it is stopped'''
+        self.start()
+        try:
+            while not self.stopping.wait(1):
+                pass
+        finally:
+            self.shutdown()
+        return
+
+    def stop(self):
+        self.stopping.set()
+        return
+
+    def shutdown(self):
+        '''Stops accepting jobs, lets running jobs finish and quits the sessions'''
+        self.stopping.set()
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socket_path)
+            self.server = None
+        for _ in self.threads:
+            self.work.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        logger.info('Daemon stopped')
+        return
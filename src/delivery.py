@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import logging
+import threading
+
+from src import googleapi
+from src import reportstate
+from src import runstate
+from src.warehouse import SQLiteWarehouse
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Task functions of jobs.build_plan shared by deliveries.py and the Daemon
+
+def export_report(ekos, report_name, catalog=None):
+    '''Exports report_name with a logged in EkosExport and returns the path of
+    the csv. Starts from the top level document, so a previous export that
+    failed inside the report frame does not affect this one
+
+    PARAMS
+    -----------
+    ekos : logged in EkosExport session
+    report_name : ekos report name
+    catalog : ReportCatalog used to open the report directly. None navigates
+    through the menu. With http_export, also holds the export urls
+    '''
+    if ekos.http_export == True:
+        # falls back to the browser export below when the url is unknown
+        return ekos.export_report_direct(report_name, catalog=catalog)
+    ekos.session.switch_to.default_content()
+    if catalog != None:
+        ekos.open_reports_page_direct(catalog)
+    else:
+        ekos.open_reports_page()
+    return ekos.export_report_to_file(
+        report_name, '{}.csv'.format(report_name), catalog=catalog
+    )
+
+def thread_service(sheets_api, cred_path, token_path):
+    '''Returns a function returning the calling thread's Sheets service, built
+    on first use, as services are not thread safe
+    '''
+    local = threading.local()
+
+    def service():
+        if not hasattr(local, 'service'):
+            credentials = sheets_api.get_credentials(cred_path, token_path)
+            local.service = sheets_api.get_service(credentials, cache=False)
+        return local.service
+    return service
+
+def uploader(service, scopes, state=None, force=False):
+    '''Returns the upload function of jobs.build_plan, importing a csv into
+    its sink with a queued write and raising runstate.StageFailed when the
+    write fails, so the task is retried
+
+    PARAMS
+    -----------
+    service : function returning a Sheets service (see thread_service)
+    scopes : scopes of the SheetsAPI created per sink
+    state : ReportState used to skip uploading unchanged reports. None
+    uploads every report
+    force : upload reports even when they are unchanged
+    '''
+    def upload(job, sink, path):
+        if state != None and force == False:
+            change = state.check(job.report_name, sink.sheet_range, path, sink.spreadsheet_id)
+            if change == reportstate.UNCHANGED:
+                logger.info('{} unchanged since last upload to {}. Skipping upload'.format(
+                    job.report_name, sink.sheet_range
+                ))
+                return False
+            logger.info('Report change detected: {}'.format(change))
+        sheets = googleapi.SheetsAPI(scopes = scopes, spreadsheet_id = sink.spreadsheet_id)
+        sheets.queue_data(data = path, sheet_range = sink.sheet_range)
+        if not sheets.flush(service()):
+            raise runstate.StageFailed('Upload to {} failed'.format(sink.sheet_range))
+        if state != None:
+            state.record(job.report_name, sink.sheet_range, path, sink.spreadsheet_id)
+        return True
+    return upload
+
+def stamper(service, scopes):
+    '''Returns the stamp function of jobs.build_plan, writing the current
+    datetime to an info_range (see SheetsAPI.last_updated)
+    '''
+    def stamp(spreadsheet_id, info_range):
+        sheets = googleapi.SheetsAPI(scopes = scopes, spreadsheet_id = spreadsheet_id)
+        sheets.queue_last_updated(sheet_range = info_range)
+        if not sheets.flush(service()):
+            raise runstate.StageFailed('Update of {} failed'.format(info_range))
+    return stamp
+
+def warehouse_loader(warehouse_path, jobs):
+    '''Returns the load function of jobs.build_plan, loading each report into
+    the SQLite warehouse at warehouse_path with the warehouse_keys of the
+    first job using it
+    '''
+    warehouse_keys = {}
+    for job in jobs:
+        warehouse_keys.setdefault(job.report_name, job.warehouse_keys)
+
+    def load(report_name, path):
+        warehouse = SQLiteWarehouse(warehouse_path)
+        try:
+            warehouse.load(report_name, path, key_columns=warehouse_keys.get(report_name))
+        finally:
+            warehouse.close()
+    return load
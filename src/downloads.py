@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import logging
+import os
+import re
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError: # inotify is Linux only, fall back to polling with stat
+    INotify = None
+
+from src.metrics import timed
+from src.metrics import tracer
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+class DownloadTimeout(Exception):
+    '''Raised when a download does not complete within the timeout'''
+    pass
+
+class DownloadWatcher:
+    '''Watches a download directory for a single new file. Call snapshot
+    before triggering the download and wait_for_file afterwards
+
+    Uses inotify (via the optional inotify_simple package) to wake up on
+    directory changes where available, otherwise polls the directory with stat
+
+    PARAMS
+    --------------
+    path : download directory to watch
+
+    regex : regular expression the downloaded filename must match
+
+    poll_interval : seconds between checks when polling, and the time the file
+    size must stay unchanged before the download is considered complete
+    '''
+    def __init__(
+        self,
+        path,
+        regex=r'Export_\d{14}_\.csv', #default ekos file name format
+        poll_interval=0.25
+    ):
+        self.path = path
+        self.regex = re.compile(regex)
+        self.poll_interval = poll_interval
+        self.existing = set()
+        self.inotify = None
+
+    def snapshot(self):
+        '''Records the files already in the download directory and starts
+        watching it for changes
+        '''
+        self.existing = set(os.listdir(self.path))
+        if INotify != None and self.inotify == None:
+            self.inotify = INotify()
+            self.inotify.add_watch(
+                self.path,
+                flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE | flags.DELETE
+            )
+        return
+
+    def close(self):
+        '''Stops watching the download directory'''
+        if self.inotify != None:
+            self.inotify.close()
+            self.inotify = None
+        return
+
+    def _wait(self, seconds):
+        '''Sleeps for up to seconds, waking early on directory events'''
+        if self.inotify != None:
+            self.inotify.read(timeout=int(seconds * 1000))
+        else:
+            time.sleep(seconds)
+        return
+
+    def _find_new_file(self):
+        '''Returns the name of a new, fully written file matching regex, or
+        None if there is none yet
+        '''
+        names = set(os.listdir(self.path))
+        for name in names - self.existing:
+            # in progress downloads are name.part, which match a prefix regex
+            if name.endswith('.part') or self.regex.fullmatch(name) == None:
+                continue
+            # firefox writes to name.part and moves it into place when done
+            if name + '.part' in names:
+                continue
+            return name
+        return None
+
+    def _size(self, filepath):
+        try:
+            return os.stat(filepath).st_size
+        except FileNotFoundError:
+            return None
+
+    @timed('download.wait_for_file')
+    def wait_for_file(self, new_filename=None, timeout=60):
+        '''Waits for the download to complete and returns the path to the
+        downloaded file. The download is complete once the .part file is gone
+        and the file size has stopped changing
+
+        Raises DownloadTimeout if no completed download appears within timeout
+
+        PARAMS
+        ---------
+        new_filename : if provided, the file is atomically renamed to
+        new_filename within the download directory
+
+        timeout : maximum number of seconds to wait for the download
+        '''
+        deadline = time.monotonic() + timeout
+        last_name, last_size = None, None
+        try:
+            while time.monotonic() < deadline:
+                name = self._find_new_file()
+                if name != None:
+                    size = self._size(os.path.join(self.path, name))
+                    if name == last_name and size == last_size and size != None:
+                        break
+                    last_name, last_size = name, size
+                    # wait one interval to confirm the size is stable
+                    time.sleep(self.poll_interval)
+                    continue
+                self._wait(min(self.poll_interval, max(0, deadline - time.monotonic())))
+            else:
+                raise DownloadTimeout(
+                    'No completed download in {} after {}s'.format(self.path, timeout)
+                )
+        finally:
+            self.close()
+
+        filepath = os.path.join(self.path, name)
+        logger.info('Download complete: {}'.format(filepath))
+        if new_filename != None:
+            new_filepath = os.path.join(self.path, new_filename)
+            with tracer.span('download.rename'):
+                os.replace(filepath, new_filepath)
+            logger.info('Renamed {} to {}'.format(name, new_filename))
+            filepath = new_filepath
+        return filepath
@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import base64
+import json
 import logging
 import os
 import re
@@ -6,6 +8,7 @@ import re
 from selenium import webdriver
 from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
 from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 # from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
@@ -14,6 +17,14 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import NoSuchFrameException
 from selenium.common.exceptions import ElementClickInterceptedException
+from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import WebDriverException
+
+from src.downloads import DownloadWatcher
+from src.httpexport import HttpExporter
+from src.metrics import timed
+from src.waits import AdaptiveWait
+from src.metrics import tracer
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -29,6 +40,199 @@ formatter = logging.Formatter(
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+EKOS_LOGIN_URL = 'https://login.goekos.com/'
+EKOS_APP_URL = 'https://app.goekos.com/'
+# element present on every page once logged in
+REPORTING_NAV_XPATH = "//div[@class='nav-options']//div[text()='Reporting']"
+
+# Returns the url of the All Reports page and the name and position of every
+# report link on it
+REPORT_LINKS_SCRIPT = '''
+var links = [];
+var anchors = document.getElementsByTagName('a');
+for (var i = 0; i < anchors.length; i++) {
+    links.push({
+        name: anchors[i].textContent.trim(),
+        href: anchors[i].getAttribute('href'),
+        index: i
+    });
+}
+return {url: location.href, links: links};
+'''
+
+# Clicks the report link at the catalog position if it still has the report
+# name ('index'), otherwise searches the links by name ('moved'). Returns
+# 'missing' if no link has the name
+OPEN_REPORT_SCRIPT = '''
+var name = arguments[0];
+var anchors = document.getElementsByTagName('a');
+var link = anchors[arguments[1]];
+if (link && link.textContent.trim() == name) {
+    link.click();
+    return 'index';
+}
+for (var i = 0; i < anchors.length; i++) {
+    if (anchors[i].textContent.trim() == name) {
+        anchors[i].click();
+        return 'moved';
+    }
+}
+return 'missing';
+'''
+
+# Opens a report and exports it as csv in one call, run from within the
+# classicContainer iFrame: clicks the report link (at the catalog position if
+# given, otherwise by name), waits for the report form in formFrame_0, clicks
+# the export button, the csv export and the close button, then calls back with
+# {ok, stage, export_url}. stage is the step reached, so a failure after the csv
+# export is not retried. export_url is the href of the csv_export link
+EXPORT_REPORT_SCRIPT = '''
+var name = arguments[0];
+var index = arguments[1];
+var timeout = arguments[2];
+var done = arguments[arguments.length - 1];
+var stage = 'link';
+var exportUrl = null;
+
+function formDoc() {
+    var frame = document.getElementById('formFrame_0') ||
+        document.getElementsByName('formFrame_0')[0];
+    return frame ? frame.contentDocument : null;
+}
+function visible(elem) {
+    return elem && !elem.disabled && elem.getClientRects().length > 0;
+}
+function waitFor(get, next) {
+    var start = Date.now();
+    (function poll() {
+        var elem = null;
+        try { elem = get(); } catch (e) {}
+        if (visible(elem)) { next(elem); return; }
+        if (Date.now() - start > timeout) {
+            done({ok: false, stage: stage, export_url: exportUrl});
+            return;
+        }
+        setTimeout(poll, 50);
+    })();
+}
+
+var anchors = document.getElementsByTagName('a');
+var link = anchors[index];
+if (!link || link.textContent.trim() != name) {
+    link = null;
+    for (var i = 0; i < anchors.length; i++) {
+        if (anchors[i].textContent.trim() == name) { link = anchors[i]; break; }
+    }
+}
+if (!link) { done({ok: false, stage: stage, export_url: exportUrl}); return; }
+
+var oldDoc = formDoc();
+link.click();
+stage = 'export_button';
+waitFor(function() {
+    var doc = formDoc();
+    return doc !== oldDoc && doc.getElementsByClassName('buttonGroupInner')[0];
+}, function(button) {
+    button.click();
+    stage = 'csv_export';
+    waitFor(function() { return formDoc().getElementById('csv_export'); }, function(csv) {
+        exportUrl = csv.href;
+        csv.click();
+        stage = 'close';
+        waitFor(function() {
+            return formDoc().getElementsByClassName('CloseButton')[0];
+        }, function(close) {
+            close.click();
+            done({ok: true, stage: 'done', export_url: exportUrl});
+        });
+    });
+});
+'''
+
+# Fetches the csv behind the csv_export link with the page's cookies and keeps
+# the bytes in the page for READ_CHUNK_SCRIPT. Run from within formFrame_0
+FETCH_EXPORT_SCRIPT = '''
+var done = arguments[arguments.length - 1];
+var link = document.getElementById('csv_export');
+var url = link && (link.href || link.getAttribute('data-url'));
+if (!url || url.indexOf('javascript:') == 0 || url.slice(-1) == '#') {
+    done({ok: false, error: 'csv_export has no url'});
+    return;
+}
+fetch(url, {credentials: 'include'}).then(function(response) {
+    if (!response.ok) { throw new Error('HTTP ' + response.status); }
+    var type = response.headers.get('Content-Type') || '';
+    if (type.indexOf('html') != -1) { throw new Error('got ' + type); }
+    return response.arrayBuffer();
+}).then(function(buffer) {
+    window.__ekosExport = new Uint8Array(buffer);
+    done({ok: true, size: buffer.byteLength});
+}).catch(function(error) {
+    done({ok: false, error: String(error)});
+});
+'''
+
+# Returns bytes [start, end) of the fetched csv, base64 encoded
+READ_CHUNK_SCRIPT = '''
+var data = window.__ekosExport.subarray(arguments[0], arguments[1]);
+var binary = '';
+for (var i = 0; i < data.length; i += 32768) {
+    binary += String.fromCharCode.apply(null, data.subarray(i, i + 32768));
+}
+return btoa(binary);
+'''
+
+# Firefox preferences for the lean profile. Blocks images, web fonts and media,
+# turns off animations and stops background services (telemetry, studies,
+# safe browsing lookups and list updates, prefetching and update checks)
+LEAN_PREFERENCES = {
+    # content
+    'permissions.default.image' : 2,
+    'browser.display.use_document_fonts' : 0,
+    'gfx.downloadable_fonts.enabled' : False,
+    'media.autoplay.default' : 5,
+    'media.mediasource.enabled' : False,
+    # animations
+    'toolkit.cosmeticAnimations.enabled' : False,
+    'image.animation_mode' : 'none',
+    'ui.prefersReducedMotion' : 1,
+    # telemetry and studies
+    'toolkit.telemetry.enabled' : False,
+    'toolkit.telemetry.unified' : False,
+    'toolkit.telemetry.archive.enabled' : False,
+    'datareporting.healthreport.uploadEnabled' : False,
+    'datareporting.policy.dataSubmissionEnabled' : False,
+    'app.shield.optoutstudies.enabled' : False,
+    'app.normandy.enabled' : False,
+    # safe browsing
+    'browser.safebrowsing.malware.enabled' : False,
+    'browser.safebrowsing.phishing.enabled' : False,
+    'browser.safebrowsing.downloads.enabled' : False,
+    'browser.safebrowsing.downloads.remote.enabled' : False,
+    'browser.safebrowsing.provider.google4.updateURL' : '',
+    'browser.safebrowsing.provider.mozilla.updateURL' : '',
+    # prefetch
+    'network.prefetch-next' : False,
+    'network.dns.disablePrefetch' : True,
+    'network.http.speculative-parallel-limit' : 0,
+    'network.predictor.enabled' : False,
+    'browser.urlbar.speculativeConnect.enabled' : False,
+    # updates
+    'app.update.auto' : False,
+    'extensions.update.enabled' : False,
+    'browser.search.update' : False,
+}
+
+class ScriptedExportError(Exception):
+    '''Raised when EXPORT_REPORT_SCRIPT fails. stage is the step it reached'''
+    def __init__(self, stage):
+        super().__init__('Scripted export failed at stage: {}'.format(stage))
+        self.stage = stage
+
+class FetchExportError(Exception):
+    '''Raised when a report can not be fetched in the browser'''
+    pass
+
 class EkosExport:
     '''Class for accessing and downloading items from Ekos ERP using Selenium
     Webdriver.
@@ -65,6 +269,30 @@ class EkosExport:
     headless : determines whether or not to run Selenium in headless mode, 
     which is necessary for running on a machine without a monitor e.g. in 
     the cloud
+
+    login_url : Ekos login page. Override to run against a local stand-in
+
+    app_url : Ekos app page loaded when restoring cached cookies
+
+    lean : if True, apply LEAN_PREFERENCES to the profile, blocking images,
+    fonts and media and disabling animations and background services
+
+    page_load_strategy : when page loads return control to Selenium
+
+        'normal' == once the page and all its resources have loaded
+        'eager' == once the DOM is ready
+        'none' == immediately. Pages are then waited on by element (see load_page)
+
+    wait_stats_path : PATH to JSON file of observed wait latencies, used to
+    set the timeout of each wait (see src.waits.AdaptiveWait). None keeps them
+    for this session only
+
+    scripted : if True, export reports with a single injected script rather
+    than one webdriver command per step (see export_report_scripted)
+
+    http_export : if True, download reports whose export url is known over
+    HTTP with the session's cookies, falling back to the browser export (see
+    export_report_direct). Needs requests
     '''
     def __init__(
         self,
@@ -72,13 +300,29 @@ class EkosExport:
         driver_path,
         profile_dir,
         profile_dir_path,
-        headless=False
+        headless=False,
+        login_url=EKOS_LOGIN_URL,
+        app_url=EKOS_APP_URL,
+        lean=False,
+        page_load_strategy='normal',
+        wait_stats_path=None,
+        scripted=False,
+        http_export=False
     ):
         self.browser = browser
         self.driver_path = driver_path
         self.profile_dir = profile_dir
         self.profile_dir_path = profile_dir_path
         self.headless = headless
+        self.login_url = login_url
+        self.app_url = app_url
+        self.lean = lean
+        self.page_load_strategy = page_load_strategy
+        self.wait_stats_path = wait_stats_path
+        self.scripted = scripted
+        self.http_export = http_export
+        # relative export urls resolve against the app, where the cookies are valid
+        self.exporter = HttpExporter(app_url) if http_export == True else None
 
         if self.browser.lower() == 'firefox':
             #set profile
@@ -102,6 +346,9 @@ class EkosExport:
                 'browser.helperApps.neverAsk.saveToDisk',
                 'text/csv,application/vnd.ms-excel'
                 )
+            if self.lean == True:
+                for name, value in LEAN_PREFERENCES.items():
+                    self.profile.set_preference(name, value)
 
             #set options
             self.options = Options()
@@ -109,43 +356,155 @@ class EkosExport:
                 self.options.add_argument('-headless')
               #  self.options.set_headless
 
+            capabilities = DesiredCapabilities.FIREFOX.copy()
+            capabilities['pageLoadStrategy'] = self.page_load_strategy
+
             self.session = webdriver.Firefox(
                 firefox_profile=self.profile,
                 executable_path=self.driver_path,
-                options=self.options
+                options=self.options,
+                capabilities=capabilities
+            )
+            # implicit waits multiply the time spent in every explicit wait
+            self.session.implicitly_wait(0)
+            #explicit wait, timeouts learned per step
+            self.wait = AdaptiveWait(
+                self.session,
+                stats_path=self.wait_stats_path,
+                default_timeout=15
             )
-            # implicit wait
-            self.session.implicitly_wait(30)
-            #explicit wait
-            self.wait = WebDriverWait(self.session, 10)
 
-    def login(self, username, password):
+    @timed('ekos.login')
+    def login(self, username, password, cookie_path=None):
         ''' Logs in to Ekos using credential provided by user and handles
         any alerts that may occur during log in
 
+        If cookie_path is provided, session cookies saved by a previous login
+        are loaded first and the login form is only used when those cookies are
+        missing or no longer valid. Cookies are saved to cookie_path after a
+        successful login
+
         PARAMS
         -----------
         session : selenium webdriver session. Initiated when class in invoked
         username : ekos ERP username
         password : ekos ERP password
+        cookie_path : PATH to cookie cache file. None disables the cache
         '''
+        if cookie_path != None and self.load_cookies(cookie_path):
+            logger.info('Logged into Ekos using cached cookies')
+            return
+
         #open webdriver, go to Ekos login page
         logger.info('Logging into Ekos')
-        self.session.get('https://login.goekos.com/')
-        assert 'Ekos' in self.session.title
+        self.session.get(self.login_url)
         # enter login credentials
-        elem = self.session.find_element_by_id('txtUsername')
+        elem = self.wait.until(
+            EC.presence_of_element_located((By.ID, 'txtUsername')),
+            step='login.form'
+        )
+        assert 'Ekos' in self.session.title
         elem.send_keys(username)
         elem = self.session.find_element_by_id('txtPassword')
         elem.send_keys(password)
         elem.send_keys(Keys.RETURN)
 
-        self.session.implicitly_wait(10)
+        if cookie_path != None:
+            if self.is_logged_in():
+                self.save_cookies(cookie_path)
+            else:
+                logger.warning('Login could not be confirmed. Cookies not saved')
 
-        # session.implicitly_wait(10) #wait for page to load
+        return
 
+    def load_page(self, url, ready=None):
+        '''Loads url. With the 'eager' and 'none' page load strategies the page
+        may still be loading when get returns, so wait until the element located
+        by ready is present
+
+        PARAMS
+        -----------
+        url : page to load
+        ready : (By, value) locator of an element present once the page is
+        usable. None returns as soon as get does
+        '''
+        self.session.get(url)
+        if self.page_load_strategy != 'normal' and ready != None:
+            self.wait.until(EC.presence_of_element_located(ready), step='page.ready')
         return
 
+    def is_logged_in(self, timeout=10):
+        '''Validity probe for the current session. Returns True if the Ekos
+        app navigation is present on the current page
+
+        PARAMS
+        -----------
+        timeout : seconds to wait for the navigation to appear
+        '''
+        try:
+            WebDriverWait(self.session, timeout, poll_frequency=0.1).until(
+                EC.presence_of_element_located((By.XPATH, REPORTING_NAV_XPATH))
+            )
+        except TimeoutException:
+            return False
+        return True
+
+    def save_cookies(self, cookie_path):
+        '''Saves the cookies of the current session to cookie_path. The file
+        is only readable and writable by the current user
+
+        PARAMS
+        -----------
+        cookie_path : PATH to cookie cache file
+        '''
+        cookies = self.session.get_cookies()
+        tmp_path = '{}.{}.tmp'.format(cookie_path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cookies, f)
+        os.replace(tmp_path, cookie_path) # atomic, safe for concurrent workers
+        logger.info('Saved {} cookies to {}'.format(len(cookies), cookie_path))
+        return
+
+    def load_cookies(self, cookie_path):
+        '''Loads cookies saved by save_cookies into the current session and
+        checks that they still give a logged in session. Returns True if the
+        session is logged in, False otherwise
+
+        PARAMS
+        -----------
+        cookie_path : PATH to cookie cache file
+        '''
+        if not os.path.exists(cookie_path):
+            return False
+        if os.stat(cookie_path).st_mode & 0o077:
+            logger.warning(
+                'Cookie cache {} is readable by other users. Ignoring'.format(cookie_path)
+            )
+            return False
+        try:
+            with open(cookie_path) as f:
+                cookies = json.load(f)
+        except ValueError:
+            logger.warning('Cookie cache {} is corrupt. Ignoring'.format(cookie_path))
+            return False
+
+        # cookies can only be added for the domain currently loaded
+        self.load_page(self.app_url, (By.TAG_NAME, 'body'))
+        for cookie in cookies:
+            cookie.pop('sameSite', None) # rejected by some driver versions
+            try:
+                self.session.add_cookie(cookie)
+            except Exception as e:
+                logger.info('Skipping cookie {}: {}'.format(cookie.get('name'), e))
+        self.load_page(self.app_url) # is_logged_in waits for the page
+
+        if self.is_logged_in():
+            return True
+        logger.info('Cached cookies expired')
+        self.session.delete_all_cookies()
+        return False
+
     def download_report(self, report_name):
         '''Clicks report name and downloads report as csv
 
@@ -161,16 +520,72 @@ class EkosExport:
         # print('navigating to reports page')
         # session.get('https://app.goekos.com/03.00/Report_Category') # TODO: user input url?
 
+        self.open_reports_page()
+        self.export_report(report_name)
+
+        return
+
+    def download_reports(self, report_names, rename=True, catalog=None):
+        '''Downloads several reports as csv within a single logged in session.
+        Navigates to the All Reports page once and exports each report in turn,
+        renaming each file to '<report_name>.csv' as it lands when rename is True
+
+        Returns a dict of report_name : True/False indicating whether each
+        report was exported (and renamed) successfully
+
+        PARAMS
+        -----------
+        report_names : list of reports to be downloaded from ekos reports page
+        rename : if True, rename each downloaded file to '<report_name>.csv'
+        catalog : ReportCatalog used to load the report list and open reports
+        directly (see open_reports_page_direct). None navigates through the menu
+        '''
+        results = {}
+        if catalog != None:
+            self.open_reports_page_direct(catalog)
+        else:
+            self.open_reports_page()
+        for report_name in report_names:
+            try:
+                new_filename = '{}.csv'.format(report_name) if rename == True else None
+                self.export_report_to_file(report_name, new_filename, catalog=catalog)
+                results[report_name] = True
+            except Exception as e:
+                logger.exception(e)
+                logger.warning('Failed to export report: {}'.format(report_name))
+                results[report_name] = False
+                # return to the All Reports page before the next report
+                try:
+                    if catalog != None:
+                        self.open_reports_page_direct(catalog)
+                    else:
+                        self.session.switch_to.default_content()
+                        self.open_reports_page()
+                except Exception as e:
+                    logger.exception(e)
+                    break
+        # mark any reports not attempted after an unrecoverable error
+        for report_name in report_names:
+            results.setdefault(report_name, False)
+
+        logger.info('Exported {} of {} reports'.format(
+            sum(results.values()), len(report_names)
+        ))
+        return results
+
+    @timed('ekos.open_reports_page')
+    def open_reports_page(self):
+        '''Navigates to the All Reports page and switches into the Ekos Classic
+        iFrame (classicContainer) that contains the list of reports
+        '''
         # Navigate to reports page
         logger.info('Navigating to Reports Page')
         elem = self.wait.until(
             EC.element_to_be_clickable(
                 # select 4th button in nav-options div
-                (
-                    By.XPATH,
-                    "//div[@class='nav-options']//div[text()='Reporting']"
-                )
-            )
+                (By.XPATH, REPORTING_NAV_XPATH)
+            ),
+            step='nav.reporting'
         )
         # elem.click()
         self.session.execute_script(
@@ -184,7 +599,8 @@ class EkosExport:
                     By.XPATH, 
                     "//div[@class='nav-option--group']//div[text()='All Reports']"
                 )
-            )
+            ),
+            step='nav.all_reports'
         )
         # elem.click()
         self.session.execute_script(
@@ -194,8 +610,21 @@ class EkosExport:
         # Reports page is Ekos Classic iFrame
         # Switch to iFrame
         logger.info('Switching to iFrame')
-        self.session.switch_to.frame('classicContainer')
-        
+        self.wait.until(
+            EC.frame_to_be_available_and_switch_to_it('classicContainer'),
+            step='frame.classicContainer'
+        )
+
+        return
+
+    def open_report(self, report_name):
+        '''Finds report_name on the All Reports page by its link text and opens
+        it. Must be called from within the classicContainer iFrame
+
+        PARAMS
+        -----------
+        report_name : report to be opened from ekos reports page
+        '''
         # find link by link text
         logger.info('Opening Report name: {}'.format(report_name))
         # elem = WebDriverWait(session, 5).until(
@@ -204,43 +633,306 @@ class EkosExport:
         elem = self.wait.until(
             EC.element_to_be_clickable(
                 (By.LINK_TEXT, report_name)
-            )
+            ),
+            step='report.link'
         )
         elem.click()
 
-        # switch to iframe
-        logger.info('Switching to iFrame')
-        self.session.switch_to.frame('formFrame_0')
+        return
 
-        # click export button
-        logger.info('Clicking export button')
-        elem = self.wait.until(
-            EC.element_to_be_clickable(
-                (By.CLASS_NAME, 'buttonGroupInner')
+    @timed('ekos.build_catalog')
+    def build_catalog(self, catalog):
+        '''Records every report link on the All Reports page in catalog. Must be
+        called from within the classicContainer iFrame (see open_reports_page)
+
+        PARAMS
+        -----------
+        catalog : ReportCatalog to update
+        '''
+        # one round trip for the whole list
+        result = self.session.execute_script(REPORT_LINKS_SCRIPT)
+        catalog.update(result['url'], result['links'])
+        return
+
+    def open_reports_page_direct(self, catalog):
+        '''Loads the All Reports page straight into the classicContainer iFrame
+        using the url recorded in catalog, skipping the Reporting and All Reports
+        menu clicks, and switches into the iFrame. Falls back to
+        open_reports_page when the url is unknown or the app page is not loaded.
+        Builds the catalog if it is stale
+
+        PARAMS
+        -----------
+        catalog : ReportCatalog
+        '''
+        self.session.switch_to.default_content()
+        loaded = False
+        if catalog.reports_url != None:
+            logger.info('Loading Reports Page from catalog')
+            loaded = self.session.execute_script(
+                "var frame = document.getElementById('classicContainer');"
+                "if (!frame) { return false; }"
+                "frame.src = arguments[0];"
+                "return true;",
+                catalog.reports_url
             )
-        )
-        elem.click()
+        if loaded:
+            self.wait.until(
+                EC.frame_to_be_available_and_switch_to_it('classicContainer'),
+                step='frame.classicContainer'
+            )
+            self.wait.until(lambda session: session.execute_script(
+                "return document.readyState == 'complete' && "
+                "location.href == arguments[0];",
+                catalog.reports_url
+            ), step='reports.loaded')
+        else:
+            self.open_reports_page()
+            # wait for the report list before reading it
+            self.wait.until(
+                EC.presence_of_element_located((By.TAG_NAME, 'a')),
+                step='reports.list'
+            )
+        if catalog.is_stale():
+            self.build_catalog(catalog)
+        return
 
-        # download report as csv
-        logger.info('Downloading report as csv to {}'.format(self.profile_dir_path))
-        elem = self.wait.until(
-            EC.element_to_be_clickable(
-                (By.ID, 'csv_export')
+    def open_report_from_catalog(self, report_name, catalog):
+        '''Opens report_name from the All Reports page using the link position
+        recorded in catalog, in a single script call rather than waiting on a
+        search of the page by link text. Rebuilds the catalog if the report is
+        missing from it or has moved. Must be called from within the
+        classicContainer iFrame
+
+        PARAMS
+        -----------
+        report_name : report to be opened from ekos reports page
+        catalog : ReportCatalog
+        '''
+        logger.info('Opening Report name from catalog: {}'.format(report_name))
+        entry = catalog.get(report_name)
+        if entry == None:
+            logger.info('{} not in catalog. Refreshing'.format(report_name))
+            self.build_catalog(catalog)
+            entry = catalog.get(report_name)
+        index = entry['index'] if entry != None else -1
+        opened = self.session.execute_script(OPEN_REPORT_SCRIPT, report_name, index)
+        if opened == 'moved':
+            logger.info('{} moved on reports page. Refreshing'.format(report_name))
+            self.build_catalog(catalog)
+        elif opened != 'index':
+            raise NoSuchElementException(
+                'Report not found on reports page: {}'.format(report_name)
             )
+        return
+
+    @timed('ekos.export_report_scripted')
+    def export_report_scripted(self, report_name, catalog=None, timeout=30):
+        '''Opens report from the All Reports page and downloads it as csv using
+        a single asynchronous script (EXPORT_REPORT_SCRIPT), replacing the dozen
+        or more webdriver round trips of the step by step export. Must be called
+        from within the classicContainer iFrame, which it does not leave
+
+        Raises ScriptedExportError if a step does not become ready within
+        timeout
+
+        PARAMS
+        -----------
+        report_name : report to be downloaded from ekos reports page
+        catalog : ReportCatalog giving the position of the report link
+        timeout : seconds to wait for each step
+        '''
+        logger.info('Exporting report by script: {}'.format(report_name))
+        index = -1
+        if catalog != None and catalog.get(report_name) != None:
+            index = catalog.get(report_name)['index']
+        self.session.set_script_timeout(timeout * 4)
+        result = self.session.execute_async_script(
+            EXPORT_REPORT_SCRIPT, report_name, index, timeout * 1000
         )
-        elem.click()
+        if catalog != None and result.get('export_url'):
+            catalog.set_export_url(report_name, result['export_url'])
+        if not result['ok']:
+            raise ScriptedExportError(result['stage'])
+        return
 
-        # close iframe
-        logger.info('Closing iFrame')
-        elem = self.wait.until(
-            EC.element_to_be_clickable(
-                (By.CLASS_NAME, 'CloseButton')
-            )
+    def fetch_report_chunks(self, report_name, catalog=None, chunk_size=4 * 1024 * 1024):
+        '''Opens report from the All Reports page and fetches its csv inside the
+        logged in page, yielding the bytes in chunks of chunk_size instead of
+        downloading a file. Nothing is written to the download directory, so
+        sessions sharing a profile can not pick up each other's exports. Must be
+        called from within the classicContainer iFrame, to which it returns once
+        all chunks have been read
+
+        Raises FetchExportError if the csv_export link has no url to fetch or
+        the fetch fails. The report form is closed in either case
+
+        PARAMS
+        -----------
+        report_name : report to be downloaded from ekos reports page
+        catalog : ReportCatalog used to open the report (see export_report)
+        chunk_size : bytes transferred from the browser per webdriver call
+        '''
+        if catalog != None:
+            self.open_report_from_catalog(report_name, catalog)
+        else:
+            self.open_report(report_name)
+        self.wait.until(
+            EC.frame_to_be_available_and_switch_to_it('formFrame_0'),
+            step='frame.formFrame_0'
         )
-        elem.click()
+        try:
+            self.wait.until(
+                EC.presence_of_element_located((By.ID, 'csv_export')),
+                step='report.csv_export'
+            )
+            logger.info('Fetching report in browser: {}'.format(report_name))
+            self.session.set_script_timeout(300)
+            result = self.session.execute_async_script(FETCH_EXPORT_SCRIPT)
+            if not result['ok']:
+                raise FetchExportError('{}: {}'.format(report_name, result['error']))
+            for start in range(0, result['size'], chunk_size):
+                chunk = self.session.execute_script(
+                    READ_CHUNK_SCRIPT, start, start + chunk_size
+                )
+                yield base64.b64decode(chunk)
+            logger.info('Fetched {} bytes for {}'.format(result['size'], report_name))
+        finally:
+            self.session.execute_script('delete window.__ekosExport;')
+            elem = self.wait.until(
+                EC.element_to_be_clickable((By.CLASS_NAME, 'CloseButton')),
+                step='report.close'
+            )
+            elem.click()
+            self.session.switch_to.parent_frame()
+
+    @timed('ekos.fetch_report')
+    def fetch_report(self, report_name, catalog=None):
+        '''Returns the csv of report as bytes, fetched inside the logged in page
+        (see fetch_report_chunks)
+
+        PARAMS
+        -----------
+        report_name : report to be downloaded from ekos reports page
+        catalog : ReportCatalog used to open the report (see export_report)
+        '''
+        return b''.join(self.fetch_report_chunks(report_name, catalog))
+
+    def close_report(self):
+        '''Closes an open report form and returns to the classicContainer iFrame'''
+        try:
+            self.wait.until(
+                EC.frame_to_be_available_and_switch_to_it('formFrame_0'),
+                step='frame.formFrame_0'
+            )
+        except WebDriverException as e:
+            logger.exception(e)
+            return
+        try:
+            elem = self.wait.until(
+                EC.element_to_be_clickable((By.CLASS_NAME, 'CloseButton')),
+                step='report.close'
+            )
+            elem.click()
+        except WebDriverException as e:
+            logger.exception(e)
+        self.session.switch_to.parent_frame()
+        return
+
+    @timed('ekos.export_report')
+    def export_report(self, report_name, catalog=None):
+        '''Opens report from the All Reports page and downloads it as csv. Must
+        be called from within the classicContainer iFrame (see open_reports_page).
+        Returns to the classicContainer iFrame once the report form is closed
+
+        With scripted, a scripted export that fails before the csv is clicked
+        falls back to the step by step export. A failure at an unknown step is
+        raised, as the csv may already be downloading
+
+        PARAMS
+        -----------
+        report_name : report to be downloaded from ekos reports page
+        catalog : ReportCatalog used to open the report without searching the
+        page for its link (see open_report_from_catalog)
+        '''
+        if self.scripted == True:
+            try:
+                self.export_report_scripted(report_name, catalog)
+                return
+            except ScriptedExportError as e:
+                if e.stage == 'close':
+                    # already exported, only the form is left open
+                    logger.warning('Report exported but not closed: {}'.format(report_name))
+                    self.close_report()
+                    return
+                # the csv was not clicked, so the step by step export can not
+                # download the report twice. Close a form the script opened first
+                logger.warning('{}. Falling back to step by step export'.format(e))
+                if e.stage != 'link':
+                    self.close_report()
+            except WebDriverException as e:
+                # the csv may already have been clicked, so exporting again could
+                # download the report twice. Leave retrying to the caller
+                logger.warning('Scripted export of {} failed: {}'.format(report_name, e))
+                self.close_report()
+                raise
+
+        with tracer.span('ekos.open_report', report_name):
+            if catalog != None:
+                self.open_report_from_catalog(report_name, catalog)
+            else:
+                self.open_report(report_name)
+
+        with tracer.span('ekos.switch_frame', report_name):
+            # switch to iframe
+            logger.info('Switching to iFrame')
+            # the report form frame is created when the report is opened
+            self.wait.until(
+                EC.frame_to_be_available_and_switch_to_it('formFrame_0'),
+                step='frame.formFrame_0'
+            )
+
+        with tracer.span('ekos.export_click', report_name):
+            # click export button
+            logger.info('Clicking export button')
+            elem = self.wait.until(
+                EC.element_to_be_clickable(
+                    (By.CLASS_NAME, 'buttonGroupInner')
+                ),
+                step='report.export_button'
+            )
+            elem.click()
+
+            # download report as csv
+            logger.info('Downloading report as csv to {}'.format(self.profile_dir_path))
+            elem = self.wait.until(
+                EC.element_to_be_clickable(
+                    (By.ID, 'csv_export')
+                ),
+                step='report.csv_export'
+            )
+            if catalog != None:
+                # lets later exports download it directly (see export_report_direct)
+                catalog.set_export_url(report_name, elem.get_attribute('href'))
+            elem.click()
+
+        with tracer.span('ekos.close_report', report_name):
+            # close iframe
+            logger.info('Closing iFrame')
+            elem = self.wait.until(
+                EC.element_to_be_clickable(
+                    (By.CLASS_NAME, 'CloseButton')
+                ),
+                step='report.close'
+            )
+            elem.click()
+
+        # back to report list
+        self.session.switch_to.parent_frame()
 
         return
 
+    @timed('ekos.quit')
     def quit(self):
         '''Quits session opened by open_session
 
@@ -248,23 +940,97 @@ class EkosExport:
         ---------
         session : Selenium webdriver session returned by open_session function
         '''
+        self.wait.save() # keep learned wait timeouts for the next session
+        if self.exporter != None:
+            self.exporter.close()
         self.session.quit()
         return
 
+    @timed('ekos.export_report_to_file')
+    def export_report_to_file(
+        self,
+        report_name,
+        new_filename=None,
+        timeout=60,
+        catalog=None
+    ):
+        '''Exports report (see export_report) and waits for the download to
+        complete, renaming it to new_filename if provided. Returns the path to
+        the downloaded file. Raises DownloadTimeout if the download does not
+        complete within timeout
+
+        PARAMS
+        -----------
+        report_name : report to be downloaded from ekos reports page
+        new_filename : new filename for the downloaded file
+        timeout : maximum number of seconds to wait for the download
+        catalog : ReportCatalog used to open the report (see export_report)
+        '''
+        watcher = DownloadWatcher(self.profile_dir_path)
+        watcher.snapshot()
+        try:
+            self.export_report(report_name, catalog=catalog)
+        except Exception:
+            watcher.close()
+            raise
+        return watcher.wait_for_file(new_filename, timeout=timeout)
+
+    @timed('ekos.export_report_direct')
+    def export_report_direct(self, report_name, new_filename=None, catalog=None):
+        '''Exports report over HTTP with the session's HttpExporter, bypassing
+        the report pages in the browser. The export url is the csv_export href
+        recorded in catalog by an earlier browser export, and the cookies of the
+        logged in session are copied into the exporter. Falls back to clicking
+        through the report pages (see export_report_to_file) if the url is not
+        known yet or the HTTP export fails. Returns the path to the downloaded
+        file
+
+        PARAMS
+        -----------
+        report_name : report to be downloaded
+        new_filename : filename for the downloaded file. Defaults to
+        '<report_name>.csv'
+        catalog : ReportCatalog holding the export urls. Also used to open the
+        report when falling back
+        '''
+        if new_filename == None:
+            new_filename = '{}.csv'.format(report_name)
+
+        if self.exporter != None and self.exporter.resolve(report_name, catalog) != None:
+            self.exporter.load_cookies(self.session.get_cookies())
+            try:
+                return self.exporter.export(
+                    report_name, self.profile_dir_path + new_filename, catalog=catalog
+                )
+            except Exception as e:
+                logger.exception(e)
+        logger.info('Falling back to browser export for {}'.format(report_name))
+
+        self.session.switch_to.default_content()
+        if catalog != None:
+            self.open_reports_page_direct(catalog)
+        else:
+            self.open_reports_page()
+        return self.export_report_to_file(report_name, new_filename, catalog=catalog)
+
+    @timed('ekos.rename_file')
     def rename_file(
         self, 
         new_filename,
-        regex='Export_\d{14}_\.csv', #default ekos file name format
+        regex=r'Export_\d{14}_\.csv', #default ekos file name format
         PATH=None # None defaults to self.profile_dir_path
     ):
         '''Searches for the downloaded csv file based on a regular expression
         and replaces that filename with the filename provided
 
+        Does not wait for the download to complete. Use export_report_to_file
+        to export a report and rename it once fully written
+
         PARAMS
         ---------
         new_filename : new filename for the downloaded file
 
-        regex : regular expression to search for
+        regex : regular expression the whole filename must match
 
         PATH : path to directory to search using regex
         '''
@@ -272,23 +1038,17 @@ class EkosExport:
             PATH = self.profile_dir_path
 
         regex = re.compile(regex)
-        count = 0 # count to track len of os.listdir(PATH)
         for f in os.listdir(PATH):
-            count += 1
-            if regex.match(f) != None:
+            # whole name, as in DownloadWatcher, so Export_..._.csv.part never matches
+            if regex.fullmatch(f) != None:
                 logger.info('File Found!')
-                filename = regex.match(f).string
-                os.rename(PATH+filename, PATH+new_filename)
+                os.replace(PATH+f, PATH+new_filename)
                 break
-            elif regex.match(f) == None and count == len(os.listdir(PATH)):
-                logger.warning('File not found')
-            else:
-                logger.info('File does not match regex. Checking next file')
+        else:
+            logger.warning('File not found')
         return
 
 
-
-
 if __name__ == '__main__':
     import yaml
     #Config file
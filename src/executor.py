@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+import concurrent.futures
+import logging
+
+from src.runstate import retry
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Task results of DAGExecutor.run
+DONE = 'done'
+RESUMED = 'resumed'
+FAILED = 'failed'
+UPSTREAM_FAILED = 'upstream_failed'
+
+class Task:
+    '''A unit of work of a DAGExecutor. func is called with a dict of
+    dependency name : artifacts and returns a dict of artifacts or None. A
+    'files' entry of the artifacts lists the paths the task produced
+    '''
+    def __init__(self, name, func, deps, resource):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.resource = resource
+
+class DAGExecutor:
+    '''Runs tasks in dependency order, running independent tasks concurrently.
+    Every task uses a resource, and no more than limits[resource] tasks of a
+    resource run at once, e.g. one 'browser' task per Ekos session
+
+    Failed tasks are retried with exponential backoff (see runstate.retry).
+    When a task still fails, the tasks depending on it are not run but
+    independent tasks carry on
+
+    With a RunCheckpoint, each completed task is saved with its artifacts and
+    a rerun resumes tasks that completed in the previous run, as long as their
+    files are unchanged and none of their dependencies had to run again
+
+    PARAMS
+    --------------
+    limits : dict of resource : maximum concurrent tasks. Resources that are
+    not listed are limited to one task. Raises ValueError for limits below 1
+
+    checkpoint : RunCheckpoint used to resume a failed run. None always runs
+    every task
+
+    attempts, base_delay, max_delay : see runstate.retry
+    '''
+    def __init__(
+        self,
+        limits=None,
+        checkpoint=None,
+        attempts=3,
+        base_delay=2,
+        max_delay=60
+    ):
+        self.limits = limits or {}
+        invalid = {resource : limit for resource, limit in self.limits.items()
+            if not isinstance(limit, int) or limit < 1}
+        if invalid:
+            raise ValueError('Resource limits must be at least 1: {}'.format(invalid))
+        self.checkpoint = checkpoint
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tasks = {} # insertion ordered, so ties run in the order added
+
+    def add(self, name, func, deps=(), resource='default'):
+        '''Adds a task. Dependencies must be added before the tasks using them
+
+        PARAMS
+        -----------
+        name : unique task name, also its checkpoint stage
+        func : function(inputs) returning a dict of artifacts or None
+        deps : names of tasks that must complete first
+        resource : name of the concurrency limit the task counts against
+        '''
+        if name in self.tasks:
+            raise ValueError('Duplicate task: {}'.format(name))
+        missing = [dep for dep in deps if dep not in self.tasks]
+        if missing:
+            raise ValueError('Task {} depends on unknown tasks {}'.format(name, missing))
+        self.tasks[name] = Task(name, func, deps, resource)
+        return name
+
+    def _resumable(self, task, status):
+        '''Returns True if task completed in the checkpointed run and can be
+        skipped
+        '''
+        if self.checkpoint == None or not self.checkpoint.done(task.name):
+            return False
+        if any(status[dep] != RESUMED for dep in task.deps):
+            return False
+        return self.checkpoint.valid(task.name)
+
+    def _run_task(self, task, inputs):
+        artifacts = retry(
+            lambda: task.func(inputs),
+            self.attempts,
+            self.base_delay,
+            self.max_delay,
+            step=task.name
+        ) or {}
+        return artifacts
+
+    def run(self):
+        '''Runs every task and returns a dict of task name : DONE, RESUMED,
+        FAILED or UPSTREAM_FAILED. The checkpoint is finished when no task
+        failed
+        '''
+        status = {}
+        artifacts = {}
+        pending = list(self.tasks.values())
+        running = {} # future : task
+        in_use = {}
+        resources = set(task.resource for task in pending)
+        workers = max(1, sum(self.limits.get(resource, 1) for resource in resources))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                resolved = False
+                for task in list(pending):
+                    if any(dep not in status for dep in task.deps):
+                        continue
+                    if any(status[dep] in (FAILED, UPSTREAM_FAILED) for dep in task.deps):
+                        logger.warning('Not running {}, a dependency failed'.format(task.name))
+                        status[task.name] = UPSTREAM_FAILED
+                        pending.remove(task)
+                        resolved = True
+                        continue
+                    if self._resumable(task, status):
+                        logger.info('Resuming {} from checkpoint'.format(task.name))
+                        artifacts[task.name] = self.checkpoint.artifacts(task.name)
+                        status[task.name] = RESUMED
+                        pending.remove(task)
+                        resolved = True
+                        continue
+                    if in_use.get(task.resource, 0) >= self.limits.get(task.resource, 1):
+                        continue
+                    inputs = {dep : artifacts[dep] for dep in task.deps}
+                    running[pool.submit(self._run_task, task, inputs)] = task
+                    in_use[task.resource] = in_use.get(task.resource, 0) + 1
+                    pending.remove(task)
+
+                if not running:
+                    if not resolved:
+                        # nothing is running and no task can start, e.g. a resource with no capacity
+                        for task in pending:
+                            logger.warning('Task {} can not be started'.format(task.name))
+                            status[task.name] = FAILED
+                        pending = []
+                    # resolved tasks may have made others ready
+                    continue
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    task = running.pop(future)
+                    in_use[task.resource] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.exception(e)
+                        logger.warning('Task {} failed'.format(task.name))
+                        status[task.name] = FAILED
+                        continue
+                    files = result.pop('files', ())
+                    if self.checkpoint != None:
+                        self.checkpoint.complete(task.name, files, **result)
+                    artifacts[task.name] = result
+                    status[task.name] = DONE
+
+        failed = [name for name, result in status.items() if result != DONE and result != RESUMED]
+        logger.info('Ran {} tasks, {} resumed, {} failed'.format(
+            len(status), sum(1 for result in status.values() if result == RESUMED), len(failed)
+        ))
+        if self.checkpoint != None and not failed:
+            self.checkpoint.finish()
+        return status
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import logging
+import os
+import queue
+import threading
+
+from contextlib import contextmanager
+
+from src.ekosexport import EkosExport
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+class SessionPool:
+    '''Logged in EkosExport sessions shared by threads in one process. Sessions
+    are started on first use, up to size, so no browser is started when no
+    report needs exporting. Each session downloads into its own directory
+
+    PARAMS
+    --------------
+    ekos_kwargs : keyword arguments of EkosExport. profile_dir_path is
+    replaced by a directory per session under download_dir
+
+    download_dir : base download directory, e.g. download_dir/session_0/
+
+    username, password, cookie_path : see EkosExport.login
+
+    size : maximum number of sessions
+    '''
+    def __init__(
+        self,
+        ekos_kwargs,
+        download_dir,
+        username,
+        password,
+        cookie_path=None,
+        size=1
+    ):
+        self.ekos_kwargs = ekos_kwargs
+        self.download_dir = download_dir
+        self.username = username
+        self.password = password
+        self.cookie_path = cookie_path
+        self.size = size
+        self.idle = queue.Queue()
+        self.sessions = []
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def _start(self, session_id):
+        kwargs = dict(self.ekos_kwargs)
+        kwargs['profile_dir'] = 2
+        kwargs['profile_dir_path'] = os.path.join(
+            self.download_dir, 'session_{}'.format(session_id), ''
+        )
+        os.makedirs(kwargs['profile_dir_path'], exist_ok=True)
+        ekos = EkosExport(**kwargs)
+        try:
+            ekos.login(self.username, self.password, cookie_path=self.cookie_path)
+        except Exception:
+            ekos.quit()
+            raise
+        return ekos
+
+    @contextmanager
+    def session(self):
+        '''Context manager lending a logged in session, starting one if all
+        are in use and the pool is not full, otherwise waiting for one
+        '''
+        try:
+            ekos = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                start = self.started < self.size
+                if start:
+                    session_id = self.started
+                    self.started += 1 # reserve the slot while starting
+            if start:
+                try:
+                    ekos = self._start(session_id)
+                except Exception:
+                    with self.lock:
+                        self.started -= 1
+                    raise
+                with self.lock:
+                    self.sessions.append(ekos)
+            else:
+                ekos = self.idle.get()
+        try:
+            yield ekos
+        finally:
+            self.idle.put(ekos)
+
+    def close(self):
+        '''Quits every session'''
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+            self.started = 0
+        for ekos in sessions:
+            ekos.quit()
+        return
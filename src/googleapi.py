@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 
 import csv
+import hashlib
 import logging
 import os.path
+import re
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import timedelta
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.discovery_cache.base import Cache
 from googleapiclient.errors import HttpError
 
+from src.metrics import timed
+
 # Logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -25,6 +33,82 @@ formatter = logging.Formatter(
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+def column_to_index(column):
+    '''Converts an A1 column letter to a zero based index e.g. A -> 0'''
+    index = 0
+    for char in column.upper():
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index - 1
+
+def index_to_column(index):
+    '''Converts a zero based index to an A1 column letter e.g. 27 -> AB'''
+    column = ''
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        column = chr(ord('A') + remainder) + column
+    return column
+
+def split_range(sheet_range):
+    '''Splits a range in A1 notation into (sheet, start_column, start_row,
+    end_column). start_row defaults to 1 and end_column to None when they
+    are not given e.g. 'data!A:T' -> ('data', 'A', 1, 'T')
+    '''
+    sheet, _, cells = sheet_range.rpartition('!')
+    start, _, end = cells.partition(':')
+    match = re.match(r'([A-Za-z]*)(\d*)$', start)
+    start_column = match.group(1).upper() or 'A'
+    start_row = int(match.group(2) or 1)
+    end_column = re.match(r'([A-Za-z]*)', end).group(1).upper() or None
+    return sheet, start_column, start_row, end_column
+
+def row_range(sheet, start_column, end_column, first_row, last_row):
+    '''Builds a range in A1 notation covering first_row to last_row'''
+    cells = '{}{}:{}{}'.format(start_column, first_row, end_column, last_row)
+    if sheet:
+        return '{}!{}'.format(sheet, cells)
+    return cells
+
+# In-process caches shared by all SheetsAPI instances
+_credentials_cache = {} # (token_path, scopes) : credentials
+_service_cache = {} # (credentials, api_endpoint) : service
+
+class DiscoveryFileCache(Cache):
+    '''On-disk cache for Google API discovery documents, used when the
+    installed google-api-python-client does not ship static discovery documents
+
+    PARAMS
+    ------------
+    cache_dir : directory the discovery documents are stored in
+
+    max_age : seconds before a cached discovery document is fetched again
+    '''
+    def __init__(self, cache_dir, max_age=86400):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{}.json'.format(name))
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if datetime.now().timestamp() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        path = self._path(url)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
 class SheetsAPI:
 
     def __init__(
@@ -64,8 +148,12 @@ class SheetsAPI:
         '''
         self.scopes = scopes
         self.spreadsheet_id = spreadsheet_id
+        # writes queued for flush, keyed by spreadsheet
+        self.pending_clears = {}
+        self.pending_updates = {}
 
-    def get_credentials(self, cred_path, token_path):
+    @timed('sheets.get_credentials')
+    def get_credentials(self, cred_path, token_path, refresh_margin=300):
         '''Runs OAuth 2.0 flow to obtain credentials for using the Google API
         Visit https://developers.google.com/workspace/guides/create-credentials#desktop-app
         for more information on creating the necessary access credentials
@@ -79,13 +167,23 @@ class SheetsAPI:
         token_path : PATH to your access and refresh tokens. If the tokens exists,
         the function will look for them at this location, otherwise the tokens will 
         be created and saved at this location
+
+        refresh_margin : seconds before expiry at which the access token is
+        refreshed. Credentials are cached in process, so token_path is only read
+        on first use and only written when the token is refreshed
         '''
-        creds = None
-        if os.path.exists(token_path):
+        cache_key = (token_path, tuple(self.scopes))
+        creds = _credentials_cache.get(cache_key)
+        if creds == None and os.path.exists(token_path):
             creds = Credentials.from_authorized_user_file(token_path, self.scopes)
+        # Refresh shortly before expiry so requests never race the expiry time
+        expiring = (
+            creds != None and creds.expiry != None and
+            creds.expiry - datetime.utcnow() < timedelta(seconds=refresh_margin)
+        )
         # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
+        if not creds or not creds.valid or expiring:
+            if creds and creds.refresh_token:
                 creds.refresh(Request())
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(
@@ -94,26 +192,72 @@ class SheetsAPI:
             # Save the credentials for the next run
             with open(token_path, 'w') as token:
                 token.write(creds.to_json())
+        _credentials_cache[cache_key] = creds
 
         return creds
 
-    def get_service(self, credentials):
+    @timed('sheets.get_service')
+    def get_service(
+        self,
+        credentials,
+        cache=True,
+        discovery_cache_dir=None,
+        api_endpoint=None
+    ):
         '''Creates service of Google Sheets API using the credentials created
         with get_credentials function.
 
         Sheets API v4
 
+        Uses the discovery document bundled with google-api-python-client where
+        available, otherwise the document is cached on disk in
+        discovery_cache_dir. Services are cached in process per credentials
+
         PARAMS
         ------------
         credentials : OAuth 2.0 credentials created using get_credentials function
+
+        cache : if True, return the service already built for these credentials.
+        Services are not thread safe, so use cache=False for a service per thread
+
+        discovery_cache_dir : directory for the on-disk discovery cache. Only
+        used with versions of google-api-python-client without static discovery
+
+        api_endpoint : base url of the Sheets API. Override to run against a
+        local stand-in
         '''
+        cache_key = (credentials, api_endpoint)
+        if cache == True and cache_key in _service_cache:
+            return _service_cache[cache_key]
+
+        client_options = None
+        if api_endpoint != None:
+            client_options = {'api_endpoint' : api_endpoint}
+
+        service = None
         try:
-            service = build('sheets', 'v4', credentials=credentials)
+            try:
+                service = build(
+                    'sheets', 'v4', credentials=credentials,
+                    client_options=client_options, static_discovery=True
+                )
+            except TypeError: # static_discovery added in google-api-python-client 2.0
+                discovery_cache = None
+                if discovery_cache_dir != None:
+                    discovery_cache = DiscoveryFileCache(discovery_cache_dir)
+                service = build(
+                    'sheets', 'v4', credentials=credentials,
+                    client_options=client_options, cache=discovery_cache
+                )
 
         except HttpError as err:
-            logging.exception(err)
+            logger.exception(err)
+
+        if cache == True and service != None:
+            _service_cache[cache_key] = service
         return service
 
+    @timed('sheets.import_data')
     def import_data(
         self,
         service,
@@ -130,7 +274,8 @@ class SheetsAPI:
         ---------------
         service : Google Sheets service created using get_service function
 
-        data : data to be imported to Google Sheet
+        data : data to be imported to Google Sheet. PATH to a csv, or a file-like
+        object of csv text e.g. io.StringIO(ekos.fetch_report(report_name).decode())
 
         sheet_range : range of cells insert data into within the Google Sheet,
         provided in A1 notation
@@ -157,14 +302,23 @@ class SheetsAPI:
         clear : If true, clears cells in sheet_range before writing new values to
         cells. Ensures that no old data persists in the sheet when writing new data
         to the same sheet_range
+
+        Reads the whole csv into memory. Use import_data_chunked for large reports
+
+        Returns the response to the update request, or None if the import failed
         '''
         # Open and read csv data as list
-        data = list(csv.reader(open(data)))
+        if hasattr(data, 'read'):
+            data = list(csv.reader(data))
+        else:
+            with open(data, newline='') as f:
+                data = list(csv.reader(f))
         # Populate Google Sheet with csv data
         body = {
             'values' : data,
             'majorDimension' : major_dimension
         }
+        result = None
         try:
             if clear == True: # clear values in sheet if cleer == True
                 request = service.spreadsheets().values().clear(
@@ -184,9 +338,290 @@ class SheetsAPI:
 
         except HttpError as err:
             logger.exception(err)
+            result = None
 
-        return
+        return result
+
+    @timed('sheets.import_data_chunked')
+    def import_data_chunked(
+        self,
+        service,
+        data,
+        sheet_range,
+        chunk_bytes=1000000,
+        workers=1,
+        credentials=None,
+        value_input_option='USER_ENTERED',
+        clear=True,
+        api_endpoint=None
+    ):
+        '''Import data to Google Sheet in chunks of rows, reading the csv lazily
+        so memory use is bounded by chunk_bytes rather than the size of the
+        report. Each chunk is written to its own row offset within sheet_range
+
+        PARAMS
+        ---------------
+        service : Google Sheets service created using get_service function
+
+        data : PATH to csv to be imported to Google Sheet
+
+        sheet_range : range of cells insert data into within the Google Sheet,
+        provided in A1 notation e.g. 'data!A:T'
+
+        chunk_bytes : approximate size of the values sent in each request. Keep
+        well below the Sheets API request size limit
+
+        workers : number of chunk requests sent concurrently. Values above 1
+        require credentials, as a service can not be shared between threads
+
+        credentials : OAuth 2.0 credentials created using get_credentials
+        function, used to create a service per worker thread
+
+        value_input_option : Determines how values are treated after they are written
+        to cells (see import_data)
+
+        clear : If true, clears cells in sheet_range before writing new values
+
+        api_endpoint : base url of the Sheets API used by the worker services
+        (see get_service)
+
+        Returns True if every chunk was imported, or False if the import failed
+        '''
+        if workers > 1 and credentials == None:
+            logger.warning('credentials required for concurrent uploads. Using 1 worker')
+            workers = 1
+        sheet, start_column, start_row, end_column = split_range(sheet_range)
+        local = threading.local()
+
+        def write_chunk(offset, rows):
+            if workers > 1:
+                if not hasattr(local, 'service'):
+                    local.service = self.get_service(
+                        credentials, cache=False, api_endpoint=api_endpoint
+                    )
+                chunk_service = local.service
+            else:
+                chunk_service = service
+            last_column = end_column or index_to_column(
+                column_to_index(start_column) + max(len(row) for row in rows) - 1
+            )
+            request = chunk_service.spreadsheets().values().update(
+                spreadsheetId = self.spreadsheet_id,
+                range = row_range(
+                    sheet, start_column, last_column,
+                    start_row + offset, start_row + offset + len(rows) - 1
+                ),
+                valueInputOption = value_input_option,
+                body = {'values' : rows, 'majorDimension' : 'ROWS'}
+            )
+            return request.execute()
+
+        try:
+            if clear == True:
+                request = service.spreadsheets().values().clear(
+                    spreadsheetId = self.spreadsheet_id,
+                    range = sheet_range,
+                    body = {}
+                )
+                result = request.execute()
+
+            with open(data, newline='') as f, \
+                    ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = []
+                chunks = 0
+                offset = 0
+                rows = []
+                size = 0
+                for row in csv.reader(f):
+                    rows.append(row)
+                    # approximate json size: quotes and separators per cell
+                    size += sum(len(cell) + 3 for cell in row) + 2
+                    if size >= chunk_bytes:
+                        pending.append(executor.submit(write_chunk, offset, rows))
+                        chunks += 1
+                        offset += len(rows)
+                        rows = []
+                        size = 0
+                        # bound the number of chunks held in memory
+                        while len(pending) >= workers:
+                            pending.pop(0).result()
+                if rows:
+                    pending.append(executor.submit(write_chunk, offset, rows))
+                    chunks += 1
+                    offset += len(rows)
+                for future in pending:
+                    future.result()
+
+            logger.info('Imported {} rows to {} in {} chunks'.format(
+                offset, sheet_range, chunks
+            ))
+
+        except HttpError as err:
+            logger.exception(err)
+            return False
+
+        return True
+
+    @timed('sheets.import_data_delta')
+    def import_data_delta(
+        self,
+        service,
+        data,
+        sheet_range,
+        snapshot_path,
+        key_column=0,
+        max_changes=0.5,
+        value_input_option='USER_ENTERED'
+    ):
+        '''Import data to Google Sheet, writing only the rows that changed since
+        the last import. A snapshot of the rows as laid out in the sheet is kept
+        at snapshot_path and diffed against the new csv using key_column as the
+        primary key. Changed rows are updated in place, deleted rows are blanked
+        and inserted rows fill blank rows or are appended, all in a single
+        values.batchUpdate request
+
+        Because inserted rows reuse the rows freed by deletions, the row order
+        in the sheet no longer matches the order of the export once rows have
+        been deleted and inserted. Use import_data where the order matters
+        e.g. formulas that reference rows by position
+
+        Falls back to a full rewrite (see import_data) when there is no snapshot,
+        the header row changed, keys are not unique, or the number of changed
+        rows exceeds max_changes
+
+        PARAMS
+        ---------------
+        service : Google Sheets service created using get_service function
+
+        data : PATH to csv to be imported to Google Sheet
+
+        sheet_range : range of cells insert data into within the Google Sheet,
+        provided in A1 notation e.g. 'data!A:T'
+
+        snapshot_path : PATH to the local snapshot of the last import
+
+        key_column : index of the column that uniquely identifies each row
+
+        max_changes : fraction of rows that may change before a full rewrite
+        is used instead
 
+        value_input_option : Determines how values are treated after they are written
+        to cells (see import_data)
+
+        Returns True if the sheet holds the new csv, or False if the import
+        failed. The snapshot is only replaced once the write succeeded
+        '''
+        with open(data, newline='') as f:
+            new_rows = list(csv.reader(f))
+        old_rows = []
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, newline='') as f:
+                old_rows = list(csv.reader(f))
+
+        width = max([len(row) for row in new_rows + old_rows] or [1])
+        new_rows = [row + [''] * (width - len(row)) for row in new_rows]
+        old_rows = [row + [''] * (width - len(row)) for row in old_rows]
+        blank = [''] * width
+
+        new_by_key = {}
+        for row in new_rows[1:]:
+            new_by_key.setdefault(row[key_column], row)
+
+        updates = None
+        if not old_rows or not new_rows:
+            logger.info('No snapshot for {}. Running full import'.format(sheet_range))
+        elif old_rows[0] != new_rows[0]:
+            logger.info('Header changed for {}. Running full import'.format(sheet_range))
+        elif len(new_by_key) != len(new_rows) - 1:
+            logger.warning('Duplicate keys in {}. Running full import'.format(data))
+        else:
+            layout = list(old_rows)
+            updates = {}
+            old_positions = {}
+            for i, row in enumerate(old_rows[1:], start=1):
+                if any(row):
+                    old_positions[row[key_column]] = i
+            for key, i in old_positions.items():
+                if key not in new_by_key:
+                    layout[i] = updates[i] = blank
+                elif new_by_key[key] != old_rows[i]:
+                    layout[i] = updates[i] = new_by_key[key]
+            free = [i for i, row in enumerate(layout) if i > 0 and not any(row)]
+            free.reverse()
+            for key, row in new_by_key.items():
+                if key in old_positions:
+                    continue
+                if free:
+                    i = free.pop()
+                    layout[i] = row
+                else:
+                    i = len(layout)
+                    layout.append(row)
+                updates[i] = row
+            if len(updates) > max_changes * max(len(new_rows), 1):
+                logger.info('{} of {} rows changed. Running full import'.format(
+                    len(updates), len(new_rows)
+                ))
+                updates = None
+
+        if updates == None:
+            result = self.import_data(
+                service = service,
+                data = data,
+                sheet_range = sheet_range,
+                value_input_option = value_input_option
+            )
+            if result == None:
+                return False
+            layout = new_rows
+        elif updates:
+            sheet, start_column, start_row, end_column = split_range(sheet_range)
+            end_column = index_to_column(column_to_index(start_column) + width - 1)
+            # group consecutive rows into one range each
+            value_ranges = []
+            for i in sorted(updates):
+                if value_ranges and value_ranges[-1]['last'] == i - 1:
+                    value_ranges[-1]['values'].append(updates[i])
+                    value_ranges[-1]['last'] = i
+                else:
+                    value_ranges.append({'first' : i, 'last' : i, 'values' : [updates[i]]})
+            body = {
+                'valueInputOption' : value_input_option,
+                'data' : [
+                    {
+                        'range' : row_range(
+                            sheet, start_column, end_column,
+                            start_row + r['first'], start_row + r['last']
+                        ),
+                        'majorDimension' : 'ROWS',
+                        'values' : r['values']
+                    } for r in value_ranges
+                ]
+            }
+            try:
+                request = service.spreadsheets().values().batchUpdate(
+                    spreadsheetId = self.spreadsheet_id,
+                    body = body
+                )
+                result = request.execute()
+            except HttpError as err:
+                logger.exception(err)
+                return False
+            logger.info('Updated {} rows in {}'.format(len(updates), sheet_range))
+        else:
+            logger.info('No changes for {}'.format(sheet_range))
+
+        # trailing blank rows are already blank in the sheet
+        while len(layout) > 1 and not any(layout[-1]):
+            layout.pop()
+        tmp_path = snapshot_path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            csv.writer(f).writerows(layout)
+        os.replace(tmp_path, snapshot_path)
+
+        return True
+
+    @timed('sheets.last_updated')
     def last_updated(self, service, sheet_range):
         '''Enters the current datetime into a provided sheet_range to allow
         users to quickly determine when the Google Sheet was last updated
@@ -222,6 +657,147 @@ class SheetsAPI:
 
         return
 
+    def queue_clear(self, sheet_range, spreadsheet_id=None):
+        '''Queues sheet_range to be cleared on the next flush
+
+        PARAMS
+        -----------
+        sheet_range : range of cells to clear, provided in A1 notation
+
+        spreadsheet_id : spreadsheet containing sheet_range. Defaults to the
+        spreadsheet_id the class was initialized with
+        '''
+        spreadsheet_id = spreadsheet_id or self.spreadsheet_id
+        self.pending_clears.setdefault(spreadsheet_id, []).append(sheet_range)
+        return
+
+    def queue_values(
+        self,
+        sheet_range,
+        values,
+        major_dimension='ROWS',
+        value_input_option='USER_ENTERED',
+        spreadsheet_id=None
+    ):
+        '''Queues values to be written to sheet_range on the next flush
+
+        PARAMS
+        -----------
+        sheet_range : range of cells insert data into within the Google Sheet,
+        provided in A1 notation
+
+        values : list of lists of values to write
+
+        major_dimension : Dimension used to feed values into sheet (see import_data)
+
+        value_input_option : Determines how values are treated after they are written
+        to cells (see import_data)
+
+        spreadsheet_id : spreadsheet containing sheet_range. Defaults to the
+        spreadsheet_id the class was initialized with
+        '''
+        spreadsheet_id = spreadsheet_id or self.spreadsheet_id
+        self.pending_updates.setdefault(
+            (spreadsheet_id, value_input_option), []
+        ).append({
+            'range' : sheet_range,
+            'majorDimension' : major_dimension,
+            'values' : values
+        })
+        return
+
+    def queue_data(
+        self,
+        data,
+        sheet_range,
+        major_dimension='ROWS',
+        value_input_option='USER_ENTERED',
+        clear=True,
+        spreadsheet_id=None
+    ):
+        '''Queues a csv to be imported on the next flush. Queued equivalent of
+        import_data
+
+        PARAMS
+        -----------
+        data : PATH to csv to be imported to Google Sheet
+
+        sheet_range : range of cells insert data into within the Google Sheet,
+        provided in A1 notation
+
+        major_dimension : see import_data
+
+        value_input_option : see import_data
+
+        clear : If true, clears cells in sheet_range before writing new values
+
+        spreadsheet_id : spreadsheet containing sheet_range. Defaults to the
+        spreadsheet_id the class was initialized with
+        '''
+        with open(data, newline='') as f:
+            values = list(csv.reader(f))
+        if clear == True:
+            self.queue_clear(sheet_range, spreadsheet_id)
+        self.queue_values(
+            sheet_range, values, major_dimension, value_input_option, spreadsheet_id
+        )
+        return
+
+    def queue_last_updated(self, sheet_range, spreadsheet_id=None):
+        '''Queues the current datetime to be written to sheet_range on the next
+        flush. Queued equivalent of last_updated
+
+        PARAMS
+        -----------
+        sheet_range : range of cells insert data into within the Google Sheet,
+        provided in A1 notation
+
+        spreadsheet_id : spreadsheet containing sheet_range. Defaults to the
+        spreadsheet_id the class was initialized with
+        '''
+        today = [[str(datetime.today())]] # list of lists required by sheets API
+        self.queue_values(sheet_range, today, spreadsheet_id=spreadsheet_id)
+        return
+
+    @timed('sheets.flush')
+    def flush(self, service):
+        '''Sends all queued clears and writes using one values.batchClear per
+        spreadsheet followed by one values.batchUpdate per spreadsheet and
+        value_input_option. Clears are always applied before writes. Returns
+        True if every request succeeded
+
+        PARAMS
+        -----------
+        service : Google Sheets service created using get_service function
+        '''
+        clears, self.pending_clears = self.pending_clears, {}
+        updates, self.pending_updates = self.pending_updates, {}
+        try:
+            for spreadsheet_id, ranges in clears.items():
+                request = service.spreadsheets().values().batchClear(
+                    spreadsheetId = spreadsheet_id,
+                    body = {'ranges' : ranges}
+                )
+                result = request.execute()
+                logger.info('Cleared {} ranges in {}'.format(len(ranges), spreadsheet_id))
+
+            for (spreadsheet_id, value_input_option), data in updates.items():
+                request = service.spreadsheets().values().batchUpdate(
+                    spreadsheetId = spreadsheet_id,
+                    body = {
+                        'valueInputOption' : value_input_option,
+                        'data' : data
+                    }
+                )
+                result = request.execute()
+                logger.info('Updated {} ranges in {}'.format(len(data), spreadsheet_id))
+
+        except HttpError as err:
+            logger.exception(err)
+            return False
+
+        return True
+
 if __name__ == '__main__':
     # If modifying these scopes, delete the file token.json.
     SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import logging
+import os
+
+from urllib.parse import urljoin
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError: # optional, only needed for http_export
+    requests = None
+
+from src.metrics import timed
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+class HttpExportError(Exception):
+    '''Raised when a report cannot be exported over HTTP'''
+    pass
+
+class HttpExporter:
+    '''Downloads Ekos report exports directly over HTTP using the cookies of an
+    authenticated Selenium session, skipping the browser once logged in
+
+    PARAMS
+    --------------
+    base_url : base url that relative endpoints are resolved against, e.g.
+    the url of the logged in page. Point this at a local server for testing
+
+    endpoints : dict of report_name : export url (absolute or relative to
+    base_url) returning the report csv. Reports not listed are resolved from
+    the export_url recorded in the ReportCatalog by a browser export
+
+    pool_size : number of keep-alive connections kept open per host
+
+    timeout : seconds to wait for the server to respond
+    '''
+    def __init__(
+        self,
+        base_url,
+        endpoints=None,
+        pool_size=4,
+        timeout=60
+    ):
+        if requests == None:
+            raise ImportError('requests is required for http_export: pip install requests')
+        self.base_url = base_url
+        self.endpoints = endpoints or {}
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def load_cookies(self, cookies):
+        '''Copies cookies from a Selenium webdriver session into the HTTP session
+
+        PARAMS
+        -----------
+        cookies : list of cookie dicts as returned by webdriver get_cookies()
+        '''
+        for cookie in cookies:
+            self.session.cookies.set(
+                cookie['name'],
+                cookie['value'],
+                domain=cookie.get('domain', ''),
+                path=cookie.get('path', '/')
+            )
+        return
+
+    def resolve(self, report_name, catalog=None):
+        '''Returns the export url for report_name, or None if it is unknown
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        catalog : ReportCatalog holding the csv_export urls seen by browser
+        exports (see ReportCatalog.set_export_url)
+        '''
+        endpoint = self.endpoints.get(report_name)
+        if endpoint == None and catalog != None:
+            endpoint = (catalog.get(report_name) or {}).get('export_url')
+        if endpoint == None:
+            return None
+        return urljoin(self.base_url, endpoint)
+
+    @timed('http.export')
+    def export(self, report_name, filepath, chunk_size=64 * 1024, catalog=None):
+        '''Streams the csv export of report_name to filepath and returns
+        filepath. The file is written to a temporary name and moved into place
+        once complete
+
+        Raises HttpExportError if the endpoint is unknown or the response is not
+        a csv (e.g. the cookies have expired and Ekos returned the login page)
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        filepath : PATH the csv is written to
+        chunk_size : bytes read from the response at a time
+        catalog : ReportCatalog the url is resolved from (see resolve)
+        '''
+        url = self.resolve(report_name, catalog)
+        if url == None:
+            raise HttpExportError('No export endpoint for {}'.format(report_name))
+
+        logger.info('Downloading {} over HTTP'.format(report_name))
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                raise HttpExportError('{} returned HTTP {}'.format(
+                    url, response.status_code
+                ))
+            content_type = response.headers.get('Content-Type', '')
+            if 'html' in content_type:
+                raise HttpExportError('{} returned {} instead of csv'.format(
+                    url, content_type
+                ))
+            tmp_path = filepath + '.part'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            except Exception:
+                # a partial export must not be picked up as a download
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        os.replace(tmp_path, filepath)
+        logger.info('Downloaded {} to {}'.format(report_name, filepath))
+        return filepath
+
+    def close(self):
+        '''Closes the pooled connections'''
+        self.session.close()
+        return
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+import csv
+import importlib
+import logging
+import os
+import re
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Job used when the config has no jobs section
+DEFAULT_REPORT = 'Distro - This Week'
+DEFAULT_SHEET_RANGE = 'data!A:T'
+DEFAULT_INFO_RANGE = 'info!B1'
+
+def select_columns(src_path, dst_path, columns):
+    '''Transform keeping only columns, in the order given'''
+    with open(src_path, newline='') as src, open(dst_path, 'w', newline='') as dst:
+        reader = csv.reader(src)
+        header = next(reader)
+        indexes = [header.index(column) for column in columns]
+        writer = csv.writer(dst)
+        writer.writerow(columns)
+        for row in reader:
+            writer.writerow([row[i] if i < len(row) else '' for i in indexes])
+    return
+
+# Transforms that can be named in the config without a module path
+TRANSFORMS = {
+    'select_columns' : select_columns,
+}
+
+def load_transform(spec):
+    '''Returns the transform function named by spec, either a key of
+    TRANSFORMS or 'package.module:function'. A transform is called with the
+    source csv path, the destination csv path and the transform's args
+    '''
+    if spec in TRANSFORMS:
+        return TRANSFORMS[spec]
+    module_name, _, function_name = spec.partition(':')
+    if function_name == '':
+        raise ValueError('Transform must be a builtin or package.module:function: {}'.format(spec))
+    return getattr(importlib.import_module(module_name), function_name)
+
+class Sink:
+    '''Destination of a job's report: a range of a Google Sheet, optionally
+    written after transforming the report
+
+    PARAMS
+    --------------
+    spreadsheet_id : destination spreadsheet
+
+    sheet_range : range the report is imported into, provided in A1 notation
+
+    info_range : if provided, the current datetime is written to this range
+    once every sink sharing it has been uploaded
+
+    transform : name of the transform applied before uploading (see
+    load_transform). None uploads the report as exported
+
+    transform_args : dict of keyword arguments of the transform
+    '''
+    def __init__(
+        self,
+        spreadsheet_id,
+        sheet_range,
+        info_range=None,
+        transform=None,
+        transform_args=None
+    ):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_range = sheet_range
+        self.info_range = info_range
+        self.transform = transform
+        self.transform_args = transform_args or {}
+
+    @property
+    def key(self):
+        return '{}:{}'.format(self.spreadsheet_id, self.sheet_range)
+
+class Job:
+    '''An Ekos report delivered to one or more sinks
+
+    PARAMS
+    --------------
+    name : job name
+
+    report_name : ekos report name
+
+    sinks : list of Sink
+
+    warehouse_keys : natural key columns of the report in the warehouse (see
+    SQLiteWarehouse.load). None appends every export
+    '''
+    def __init__(self, name, report_name, sinks, warehouse_keys=None):
+        self.name = name
+        self.report_name = report_name
+        self.sinks = sinks
+        self.warehouse_keys = warehouse_keys
+
+def jobs_from_config(config):
+    '''Returns the list of Jobs described by the jobs section of the config.
+    Sinks default to the config's spreadsheet_id. A config without a jobs
+    section gives the single job deliveries.py has always run
+
+        jobs :
+          - name : distro
+            report : Distro - This Week
+            warehouse_keys : ['Invoice #']
+            sinks :
+              - sheet_range : data!A:T
+                info_range : info!B1
+              - spreadsheet_id : other_spreadsheet
+                sheet_range : distro!A:C
+                transform : select_columns
+                transform_args : {columns : [Customer, Product, Quantity]}
+
+    Raises ValueError if two sinks write the same range
+    '''
+    default_spreadsheet = config.get('spreadsheet_id')
+    entries = config.get('jobs')
+    if entries == None:
+        entries = [{
+            'name' : DEFAULT_REPORT,
+            'report' : DEFAULT_REPORT,
+            'sinks' : [{
+                'sheet_range' : DEFAULT_SHEET_RANGE,
+                'info_range' : DEFAULT_INFO_RANGE,
+            }],
+            'warehouse_keys' : config.get('warehouse_keys'),
+        }]
+
+    jobs = []
+    seen = {}
+    for entry in entries:
+        name = entry.get('name', entry['report'])
+        sinks = []
+        for sink_entry in entry['sinks']:
+            sink = Sink(
+                spreadsheet_id = sink_entry.get('spreadsheet_id', default_spreadsheet),
+                sheet_range = sink_entry['sheet_range'],
+                info_range = sink_entry.get('info_range'),
+                transform = sink_entry.get('transform'),
+                transform_args = sink_entry.get('transform_args')
+            )
+            if sink.spreadsheet_id == None:
+                raise ValueError('No spreadsheet_id for {} in job {}'.format(
+                    sink.sheet_range, name
+                ))
+            if sink.key in seen:
+                raise ValueError('Jobs {} and {} both write {}'.format(
+                    seen[sink.key], name, sink.key
+                ))
+            seen[sink.key] = name
+            sinks.append(sink)
+        jobs.append(Job(name, entry['report'], sinks, entry.get('warehouse_keys')))
+    return jobs
+
+def limits_from_config(config):
+    '''Returns the DAGExecutor limits described by the limits section of the
+    config, with defaults for the resources used by build_plan. Raises
+    ValueError for a limit below 1, which would never run its tasks
+    '''
+    limits = config.get('limits') or {}
+    invalid = {resource : limit for resource, limit in limits.items()
+        if not isinstance(limit, int) or limit < 1}
+    if invalid:
+        raise ValueError('limits must be at least 1: {}'.format(invalid))
+    return {
+        'browser' : limits.get('browser', 1), # Ekos sessions
+        'sheets' : limits.get('sheets', 2), # concurrent Sheets requests
+        'transform' : limits.get('transform', 2),
+        'warehouse' : 1, # SQLite has a single writer
+    }
+
+def _slug(value):
+    return re.sub(r'[^\w.-]+', '_', value).strip('_')
+
+def build_plan(
+    executor,
+    jobs,
+    export,
+    upload,
+    stamp,
+    work_dir,
+    load=None
+):
+    '''Adds the tasks delivering jobs to a DAGExecutor. Each report is
+    exported once however many jobs and sinks use it, then transformed and
+    uploaded per sink. Each info_range is stamped once, after every upload
+    sharing it, unless all of them were skipped as unchanged
+
+    Task functions are given the artifacts of the tasks they depend on
+
+    PARAMS
+    -----------
+    executor : DAGExecutor the tasks are added to
+
+    jobs : list of Job
+
+    export : function(report_name) returning the path of the exported csv.
+    Runs on the 'browser' resource
+
+    upload : function(job, sink, path) returning True if the csv at path was
+    uploaded or False if it was skipped as unchanged. Runs on 'sheets'
+
+    stamp : function(spreadsheet_id, info_range). Runs on 'sheets'
+
+    work_dir : directory transformed csvs are written to
+
+    load : optional function(report_name, path) e.g. loading the report into
+    a warehouse, run once per report on the 'warehouse' resource
+    '''
+    stamps = {} # (spreadsheet_id, info_range) : upload tasks
+    for job in jobs:
+        export_task = 'export:{}'.format(job.report_name)
+        if export_task not in executor.tasks:
+            def export_report(inputs, report_name=job.report_name):
+                path = export(report_name)
+                return {'path' : path, 'files' : [path]}
+            executor.add(export_task, export_report, resource='browser')
+
+            if load != None:
+                def load_report(inputs, report_name=job.report_name, export_task=export_task):
+                    load(report_name, inputs[export_task]['path'])
+                executor.add(
+                    'load:{}'.format(job.report_name), load_report,
+                    deps=[export_task], resource='warehouse'
+                )
+
+        for sink in job.sinks:
+            source_task = export_task
+            if sink.transform != None:
+                source_task = 'transform:{}'.format(sink.key)
+                def transform_report(inputs, sink=sink, export_task=export_task, job=job):
+                    path = os.path.join(work_dir, '{}-{}.csv'.format(
+                        _slug(job.report_name), _slug(sink.key)
+                    ))
+                    load_transform(sink.transform)(
+                        inputs[export_task]['path'], path, **sink.transform_args
+                    )
+                    return {'path' : path, 'files' : [path]}
+                executor.add(
+                    source_task, transform_report, deps=[export_task], resource='transform'
+                )
+
+            upload_task = 'upload:{}'.format(sink.key)
+            def upload_report(inputs, job=job, sink=sink, source_task=source_task):
+                return {'uploaded' : upload(job, sink, inputs[source_task]['path'])}
+            executor.add(upload_task, upload_report, deps=[source_task], resource='sheets')
+            if sink.info_range != None:
+                stamps.setdefault((sink.spreadsheet_id, sink.info_range), []).append(upload_task)
+
+    for (spreadsheet_id, info_range), upload_tasks in stamps.items():
+        def stamp_range(inputs, spreadsheet_id=spreadsheet_id, info_range=info_range):
+            if not any(artifacts.get('uploaded') for artifacts in inputs.values()):
+                logger.info('All reports unchanged, not stamping {}'.format(info_range))
+                return
+            stamp(spreadsheet_id, info_range)
+        executor.add(
+            'stamp:{}:{}'.format(spreadsheet_id, info_range), stamp_range,
+            deps=upload_tasks, resource='sheets'
+        )
+    return
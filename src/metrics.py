@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Tracer:
+    '''Records the duration of each step of a run as spans. Disabled tracers
+    do no work beyond a single attribute check, so instrumented code can be
+    left in place
+
+    PARAMS
+    --------------
+    enabled : if False, spans are not recorded
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+        self.started = datetime.today()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self):
+        '''Discards recorded spans and starts a new run'''
+        with self.lock:
+            self.spans = []
+            self.started = datetime.today()
+        return
+
+    @contextmanager
+    def span(self, step, report=None):
+        '''Context manager timing the enclosed block as step
+
+        PARAMS
+        -----------
+        step : name of the step e.g. 'ekos.login'
+        report : report the step belongs to, if any
+        '''
+        if not self.enabled:
+            yield
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(step)
+        error = None
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.spans.append({
+                    'step' : step,
+                    'report' : report,
+                    'parent' : parent,
+                    'start' : start,
+                    'duration' : duration,
+                    'error' : error
+                })
+
+    def write_trace(self, path):
+        '''Writes the recorded spans of this run to path as JSON'''
+        with self.lock:
+            trace = {'run_started' : str(self.started), 'spans' : list(self.spans)}
+        _write_atomic(path, json.dumps(trace, indent=2))
+        logger.info('Wrote trace of {} spans to {}'.format(len(trace['spans']), path))
+        return
+
+    def write_prometheus(self, path, metric='ekosexport_step_duration_seconds'):
+        '''Writes a histogram of span durations per step and report to path in
+        the Prometheus text format, for the node_exporter textfile collector
+        '''
+        series = {}
+        with self.lock:
+            for span in self.spans:
+                series.setdefault((span['step'], span['report']), []).append(
+                    span['duration']
+                )
+        lines = [
+            '# HELP {} Duration of export pipeline steps.'.format(metric),
+            '# TYPE {} histogram'.format(metric)
+        ]
+        for (step, report), durations in sorted(series.items(), key=str):
+            labels = 'step="{}"'.format(_escape(step))
+            if report != None:
+                labels += ',report="{}"'.format(_escape(report))
+            for bound in BUCKETS:
+                count = sum(1 for d in durations if d <= bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    metric, labels, bound, count
+                ))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                metric, labels, len(durations)
+            ))
+            lines.append('{}_sum{{{}}} {}'.format(metric, labels, sum(durations)))
+            lines.append('{}_count{{{}}} {}'.format(metric, labels, len(durations)))
+        _write_atomic(path, '\n'.join(lines) + '\n')
+        return
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _write_atomic(path, content):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+# Tracer shared by the instrumented modules. Enable with tracer.enabled = True
+tracer = Tracer()
+
+def timed(step):
+    '''Decorator recording each call of the decorated function as a span of
+    tracer. If the function takes a report_name argument it is used as the
+    span's report label
+
+    PARAMS
+    -----------
+    step : name of the step e.g. 'ekos.login'
+    '''
+    def decorator(func):
+        params = list(inspect.signature(func).parameters)
+        report_index = params.index('report_name') if 'report_name' in params else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            report = None
+            if report_index != None:
+                if 'report_name' in kwargs:
+                    report = kwargs['report_name']
+                elif len(args) > report_index:
+                    report = args[report_index]
+            with tracer.span(step, report):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from datetime import datetime
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Results of ReportState.check
+NEW = 'new'
+UNCHANGED = 'unchanged'
+ROWS_CHANGED = 'rows_changed'
+SCHEMA_CHANGED = 'schema_changed'
+
+def fingerprint(path, block_size=64 * 1024):
+    '''Returns (content_hash, schema_hash) for a csv. The content hash covers
+    the whole file and is computed in blocks so memory use stays constant. The
+    schema hash covers the header row only
+
+    PARAMS
+    -----------
+    path : PATH to csv
+
+    block_size : bytes read at a time
+    '''
+    content = hashlib.sha256()
+    with open(path, 'rb') as f:
+        header = f.readline()
+        content.update(header)
+        for block in iter(lambda: f.read(block_size), b''):
+            content.update(block)
+    schema = hashlib.sha256(header.rstrip(b'\r\n'))
+    return content.hexdigest(), schema.hexdigest()
+
+class ReportState:
+    '''Small JSON state store recording a fingerprint of the last csv uploaded
+    for each report and destination range, used to skip uploads when an export
+    has not changed since the previous run
+
+    PARAMS
+    --------------
+    state_path : PATH to the JSON state file. Created on first save
+    '''
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.state = {}
+        self.lock = threading.RLock() # check and record are called from upload threads
+        self.fingerprints = {} # (path, mtime, size) : fingerprint
+        if os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    self.state = json.load(f)
+            except ValueError:
+                logger.warning('State file {} is corrupt. Ignoring'.format(state_path))
+
+    def _key(self, report_name, sheet_range, spreadsheet_id):
+        return '{}|{}|{}'.format(report_name, spreadsheet_id or '', sheet_range)
+
+    def _fingerprint(self, path):
+        '''fingerprint, reusing the result while the file is unmodified'''
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = fingerprint(path)
+        return self.fingerprints[key]
+
+    def check(self, report_name, sheet_range, path, spreadsheet_id=None):
+        '''Compares the csv at path with the one last recorded for report_name
+        and sheet_range. Returns one of NEW, UNCHANGED, ROWS_CHANGED or
+        SCHEMA_CHANGED
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        sheet_range : destination range, in A1 notation
+        path : PATH to the exported csv
+        spreadsheet_id : destination spreadsheet
+        '''
+        with self.lock:
+            previous = self.state.get(self._key(report_name, sheet_range, spreadsheet_id))
+        if previous == None:
+            return NEW
+        content_hash, schema_hash = self._fingerprint(path)
+        if content_hash == previous['content_hash']:
+            return UNCHANGED
+        if schema_hash != previous['schema_hash']:
+            return SCHEMA_CHANGED
+        return ROWS_CHANGED
+
+    def record(self, report_name, sheet_range, path, spreadsheet_id=None):
+        '''Records the fingerprint of the csv at path as the last upload for
+        report_name and sheet_range and saves the state file
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        sheet_range : destination range, in A1 notation
+        path : PATH to the uploaded csv
+        spreadsheet_id : destination spreadsheet
+        '''
+        content_hash, schema_hash = self._fingerprint(path)
+        with self.lock:
+            self.state[self._key(report_name, sheet_range, spreadsheet_id)] = {
+                'content_hash' : content_hash,
+                'schema_hash' : schema_hash,
+                'updated' : str(datetime.today())
+            }
+            self.save()
+        return
+
+    def save(self):
+        '''Writes the state file atomically, through a temporary file unique
+        to the call so concurrent saves do not write to the same one
+        '''
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.state_path)),
+                prefix=os.path.basename(self.state_path) + '.',
+                suffix='.tmp'
+            )
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+        return
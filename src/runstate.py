@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import random
+import time
+
+from datetime import datetime
+
+from src.reportstate import fingerprint
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+class StageFailed(Exception):
+    '''Raised by a stage that reports failure without raising, so it is retried'''
+    pass
+
+def retry(func, attempts=3, base_delay=2, max_delay=60, retry_on=(Exception,), step=''):
+    '''Calls func until it succeeds and returns its result, retrying up to
+    attempts times in total. The delay before retry n is base_delay * 2 ** n
+    seconds, capped at max_delay, with up to 10% jitter. The last exception is
+    raised when every attempt fails
+
+    PARAMS
+    -----------
+    func : callable taking no arguments
+    attempts : total number of calls, including the first
+    base_delay : seconds before the first retry
+    max_delay : maximum seconds between retries
+    retry_on : exception types that are retried. Others are raised at once
+    step : name used in log messages
+    '''
+    for attempt in range(attempts):
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == attempts - 1:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            delay += random.uniform(0, delay * 0.1)
+            logger.warning('{} failed ({}). Retry {} of {} in {:.1f}s'.format(
+                step or getattr(func, '__name__', 'call'), e, attempt + 1, attempts - 1, delay
+            ))
+            time.sleep(delay)
+
+class RunCheckpoint:
+    '''Persists the progress of a run through its stages, i.e. the tasks of a
+    DAGExecutor, so a run that fails part way is resumed at the failed stage
+    by the next run instead of starting over. Each completed stage is saved
+    with its artifacts, e.g. the path and content hash of a downloaded file
+
+    A checkpoint is resumed only while it is younger than max_age and the
+    files of the last stage that produced any still have their recorded hashes.
+    Otherwise the run starts fresh
+
+    PARAMS
+    --------------
+    path : PATH to the JSON checkpoint file. None keeps the checkpoint in
+    memory only, which still gives per stage retries
+
+    run_key : identifies the job the checkpoint belongs to e.g. the report
+    name. A checkpoint for a different key is ignored
+
+    max_age : seconds an unfinished checkpoint may be resumed for
+    '''
+    def __init__(self, path, run_key, max_age=3600):
+        self.path = path
+        self.run_key = run_key
+        self.max_age = max_age
+        self.state = self._load()
+
+    def _fresh(self):
+        return {'run_key': self.run_key, 'started': time.time(), 'stages': {}}
+
+    def _load(self):
+        if self.path == None or not os.path.exists(self.path):
+            return self._fresh()
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except ValueError:
+            logger.warning('Checkpoint {} is corrupt. Ignoring'.format(self.path))
+            return self._fresh()
+
+        if state.get('run_key') != self.run_key or state.get('finished'):
+            return self._fresh()
+        if time.time() - state.get('started', 0) > self.max_age:
+            logger.info('Checkpoint for {} is older than {}s. Starting fresh'.format(
+                self.run_key, self.max_age
+            ))
+            return self._fresh()
+        # earlier files may have been consumed by later stages e.g. renamed
+        produced = [(stage, record) for stage, record in state.get('stages', {}).items()
+            if record.get('hashes')]
+        for stage, record in produced[-1:]:
+            for path, content_hash in record['hashes'].items():
+                if not os.path.exists(path) or fingerprint(path)[0] != content_hash:
+                    logger.info('Artifact {} of {} changed. Starting fresh'.format(
+                        path, stage
+                    ))
+                    return self._fresh()
+        if state['stages']:
+            logger.info('Resuming {} after {}'.format(
+                self.run_key, ', '.join(state['stages'])
+            ))
+        return state
+
+    def save(self):
+        '''Writes the checkpoint to path'''
+        if self.path == None:
+            return
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+        return
+
+    def done(self, stage):
+        '''Returns True if stage completed in this run or the run being resumed'''
+        return stage in self.state['stages']
+
+    def artifacts(self, stage):
+        '''Returns the artifacts recorded when stage completed'''
+        return dict(self.state['stages'].get(stage, {}).get('artifacts', {}))
+
+    def valid(self, stage):
+        '''Returns True if the files stage produced still have their recorded
+        hashes
+        '''
+        hashes = self.state['stages'].get(stage, {}).get('hashes', {})
+        for path, content_hash in hashes.items():
+            if not os.path.exists(path) or fingerprint(path)[0] != content_hash:
+                return False
+        return True
+
+    def complete(self, stage, files=(), **artifacts):
+        '''Records stage as complete with its artifacts and saves the
+        checkpoint. The content hash of each path in files is recorded and
+        checked before resuming
+
+        PARAMS
+        -----------
+        stage : stage name e.g. a DAGExecutor task
+        files : PATHS of files the stage produced
+        artifacts : JSON serializable values recorded with the stage
+        '''
+        self.state['stages'][stage] = {
+            'completed': datetime.now().isoformat(sep=' '),
+            'artifacts': artifacts,
+            'hashes': {path : fingerprint(path)[0] for path in files},
+        }
+        self.save()
+        return
+
+    def finish(self):
+        '''Marks the run as finished, so the next run starts fresh'''
+        self.state['finished'] = time.time()
+        self.save()
+        return
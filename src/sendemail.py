@@ -1,16 +1,19 @@
 #!/usr/bin/env/ python
 
+import base64
+import gzip
 import logging
 import mimetypes
 import os
 import smtplib
+import tempfile
+import time
+import uuid
+import zipfile
 
-from email import encoders
+from email import policy
+from email.generator import BytesGenerator
 from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from email.mime.audio import MIMEAudio
-from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 
 # Logging
@@ -27,6 +30,445 @@ formatter = logging.Formatter(
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+# Gmail rejects messages larger than 25MB, including the base64 overhead
+MAX_MESSAGE_BYTES = 25 * 1024 * 1024
+# Room left in each message for headers, the body and MIME boundaries
+MESSAGE_OVERHEAD = 64 * 1024
+COMPRESSION_TYPES = {
+	'gzip' : ('.gz', 'application/gzip'),
+	'zip' : ('.zip', 'application/zip'),
+}
+
+def _content_type(path):
+	ctype, encoding = mimetypes.guess_type(path)
+	if ctype is None or encoding is not None:
+		ctype = 'application/octet-stream'
+	return ctype
+
+def _encoded_size(size):
+	'''Size of size bytes once base64 encoded in 76 character CRLF lines'''
+	lines = (size + 56) // 57
+	return lines * 78
+
+class _PartWriter:
+	'''Writes one attachment part to a file in tmp_dir, compressing it on the
+	fly with gzip or zip when compress is set. size is the number of bytes
+	written to disk so far
+	'''
+	def __init__(self, tmp_dir, inner_name, compress=None):
+		fd, self.path = tempfile.mkstemp(dir=tmp_dir)
+		self.raw = os.fdopen(fd, 'wb')
+		self.archive = None
+		if compress == 'gzip':
+			self.out = gzip.GzipFile(filename=inner_name, mode='wb', fileobj=self.raw)
+		elif compress == 'zip':
+			self.archive = zipfile.ZipFile(self.raw, 'w', zipfile.ZIP_DEFLATED)
+			self.out = self.archive.open(inner_name, 'w', force_zip64=True)
+		else:
+			self.out = self.raw
+
+	@property
+	def size(self):
+		return self.raw.tell()
+
+	def write(self, data):
+		self.out.write(data)
+
+	def close(self):
+		if self.out is not self.raw:
+			self.out.close()
+		if self.archive != None:
+			self.archive.close()
+		self.raw.close()
+		return self.path
+
+def prepare_attachments(files, tmp_dir, compress=None, max_part_bytes=None):
+	'''Prepares files for streaming as attachments and returns a list of
+	(path, filename, content type). Files are returned as is unless they are
+	compressed or larger than max_part_bytes, in which case they are
+	compressed and split into parts written to tmp_dir. Text files are split on
+	line boundaries and csv parts repeat the header row, so every part can be
+	opened on its own
+
+	PARAMS
+	-----------
+	files : PATH or list of PATHS to attach
+	tmp_dir : directory compressed and split parts are written to
+	compress : None, 'gzip' or 'zip'
+	max_part_bytes : maximum bytes of each part on disk. None never splits
+	'''
+	if compress not in (None, 'gzip', 'zip'):
+		raise ValueError('compress must be None, gzip or zip')
+	if type(files) != list:
+		files = [files]
+
+	attachments = []
+	for f in files:
+		filename = os.path.basename(f)
+		ctype = _content_type(f)
+		size = os.path.getsize(f)
+		if compress == None and (max_part_bytes == None or size <= max_part_bytes):
+			attachments.append((f, filename, ctype))
+			continue
+
+		# leave room for data buffered in the compressor when checking the size
+		margin = 0 if compress == None else min(64 * 1024, (max_part_bytes or 0) // 10)
+		limit = None if max_part_bytes == None else max_part_bytes - margin
+		text = ctype.startswith('text/')
+		parts = []
+		with open(f, 'rb') as fp:
+			header = fp.readline() if ctype == 'text/csv' else b''
+			chunks = iter(fp) if text else iter(lambda: fp.read(64 * 1024), b'')
+			part = _PartWriter(tmp_dir, filename, compress)
+			part.write(header)
+			written = False
+			for chunk in chunks:
+				if limit != None and written and part.size + len(chunk) > limit:
+					parts.append(part.close())
+					part = _PartWriter(tmp_dir, filename, compress)
+					part.write(header)
+				part.write(chunk)
+				written = True
+			parts.append(part.close())
+
+		stem, ext = os.path.splitext(filename)
+		if compress != None:
+			suffix, ctype = COMPRESSION_TYPES[compress]
+			ext = ext + suffix if compress == 'gzip' else suffix
+		for i, path in enumerate(parts, 1):
+			if len(parts) == 1:
+				name = stem + ext
+			else:
+				name = '{}_part{}of{}{}'.format(stem, i, len(parts), ext)
+			attachments.append((path, name, ctype))
+		logger.info('Prepared {} as {} attachment(s) of {} bytes'.format(
+			filename, len(parts), ', '.join(str(os.path.getsize(p)) for p in parts)
+		))
+	return attachments
+
+def group_attachments(attachments, max_message_bytes=MAX_MESSAGE_BYTES):
+	'''Splits attachments into groups that each fit in one message of at most
+	max_message_bytes once base64 encoded. An attachment too large for a
+	message on its own is sent in a message by itself
+	'''
+	groups, group, group_size = [], [], MESSAGE_OVERHEAD
+	for attachment in attachments:
+		size = _encoded_size(os.path.getsize(attachment[0]))
+		if group and group_size + size > max_message_bytes:
+			groups.append(group)
+			group, group_size = [], MESSAGE_OVERHEAD
+		group.append(attachment)
+		group_size += size
+	if group or not groups:
+		groups.append(group)
+	return groups
+
+def write_message(
+	out,
+	message,
+	subject,
+	email_to,
+	email_from,
+	reply_to='NoReply',
+	attachments=(),
+	chunk_size=57 * 1024
+):
+	'''Writes a MIME message with CRLF line endings to the binary file out,
+	base64 encoding each attachment straight from disk chunk_size bytes at a
+	time, so neither the attachments nor the message are held in memory
+
+	PARAMS
+	-----------
+	out : binary file the message is written to
+	attachments : list of (path, filename, content type) e.g. from
+	prepare_attachments
+	chunk_size : bytes encoded at a time. A multiple of 57, so every chunk
+	encodes to whole 76 character lines
+	See send_gmail for the other PARAMS
+	'''
+	boundary = '=' * 15 + uuid.uuid4().hex
+	if type(email_to) == list:
+		email_to = ', '.join(email_to)
+	headers = [
+		('From', email_from),
+		('To', email_to),
+		('Reply-To', reply_to),
+		('Subject', subject),
+		('MIME-Version', '1.0'),
+		('Content-Type', 'multipart/mixed; boundary="{}"'.format(boundary)),
+	]
+	for name, value in headers:
+		out.write(policy.SMTP.fold_binary(name, value))
+	out.write(b'\r\n')
+
+	delimiter = '--{}\r\n'.format(boundary).encode('ascii')
+	out.write(delimiter)
+	out.write(MIMEText(message).as_bytes(policy=policy.SMTP))
+	out.write(b'\r\n')
+	for path, filename, ctype in attachments:
+		out.write(delimiter)
+		att = MIMEBase(*ctype.split('/', 1))
+		att['Content-Transfer-Encoding'] = 'base64'
+		att.add_header('content-disposition', 'attachment', filename=filename)
+		for name, value in att.items():
+			out.write(policy.SMTP.fold_binary(name, value))
+		out.write(b'\r\n')
+		with open(path, 'rb') as fp:
+			for chunk in iter(lambda: fp.read(chunk_size), b''):
+				out.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+	out.write('--{}--\r\n'.format(boundary).encode('ascii'))
+	return
+
+class SMTPMailer:
+	'''Holds one authenticated SMTP connection and sends any number of
+	messages over it, so the TLS and login handshakes are paid once per batch
+	instead of once per message. Use as a context manager or call close
+
+	The connection is checked with NOOP after idle_timeout seconds without a
+	send, and reopened if the server has dropped it
+
+	PARAMS
+	--------------
+	username : account used to log in to the SMTP server
+
+	password : password associated with username
+
+	host, port : SMTP server. Point these at a local SMTP server for testing
+
+	starttls : upgrade the connection with STARTTLS before logging in. Disable
+	for local servers without TLS
+
+	idle_timeout : seconds a connection may sit unused before it is checked
+
+	timeout : socket timeout in seconds
+	'''
+	def __init__(
+		self,
+		username,
+		password,
+		host='smtp.gmail.com',
+		port=587,
+		starttls=True,
+		idle_timeout=60,
+		timeout=60
+	):
+		self.username = username
+		self.password = password
+		self.host = host
+		self.port = port
+		self.starttls = starttls
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+		self.server = None
+		self.last_used = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		return False
+
+	def connect(self):
+		'''Opens and authenticates a new connection, closing any old one'''
+		self.close()
+		logger.info('Connecting to {}:{}'.format(self.host, self.port))
+		server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+		try:
+			server.ehlo()
+			if self.starttls:
+				server.starttls()
+				server.ehlo()
+			if self.password != None:
+				server.login(self.username, self.password)
+		except Exception:
+			server.close()
+			raise
+		self.server = server
+		self.last_used = time.monotonic()
+		return
+
+	def _connected(self):
+		'''Returns True if the open connection is usable, checking it with NOOP
+		if it has been idle longer than idle_timeout
+		'''
+		if self.server == None:
+			return False
+		if time.monotonic() - self.last_used < self.idle_timeout:
+			return True
+		try:
+			return self.server.noop()[0] == 250
+		except (smtplib.SMTPException, OSError):
+			return False
+
+	def send(self, msg, email_to, email_from=None):
+		'''Sends a message built in memory to email_to over the pooled
+		connection, written with CRLF line endings to a temporary file and
+		streamed from it (see send_file). Returns the dict of refused
+		recipients
+
+		PARAMS
+		-----------
+		msg : email.message.Message
+		email_to : email or list of emails of intended recipient(s)
+		email_from : envelope sender. Defaults to username
+		'''
+		with tempfile.TemporaryFile() as fp:
+			BytesGenerator(fp, policy=policy.SMTP).flatten(msg)
+			return self.send_file(fp, email_to, email_from)
+
+	def _send_file(self, fp, email_to, email_from):
+		'''Sends the message in the binary file fp with an SMTP DATA command
+		streamed from the file in blocks, dot stuffing lines as it goes
+		'''
+		recipients = [email_to] if type(email_to) == str else email_to
+		server = self.server
+		server.ehlo_or_helo_if_needed()
+		code, resp = server.mail(email_from)
+		if code != 250:
+			server.rset()
+			raise smtplib.SMTPSenderRefused(code, resp, email_from)
+		refused = {}
+		for recipient in recipients:
+			code, resp = server.rcpt(recipient)
+			if code not in (250, 251):
+				refused[recipient] = (code, resp)
+		if len(refused) == len(recipients):
+			server.rset()
+			raise smtplib.SMTPRecipientsRefused(refused)
+		code, resp = server.docmd('data')
+		if code != 354:
+			server.rset()
+			raise smtplib.SMTPDataError(code, resp)
+
+		fp.seek(0)
+		block = []
+		block_size = 0
+		line = b'\r\n'
+		for line in fp:
+			if line.startswith(b'.'):
+				line = b'.' + line
+			block.append(line)
+			block_size += len(line)
+			if block_size >= 64 * 1024:
+				server.send(b''.join(block))
+				block, block_size = [], 0
+		# the terminating dot must be on a line of its own
+		if not line.endswith(b'\r\n'):
+			block.append(b'\r\n')
+		block.append(b'.\r\n')
+		server.send(b''.join(block))
+		code, resp = server.getreply()
+		if code != 250:
+			server.rset()
+			raise smtplib.SMTPDataError(code, resp)
+		return refused
+
+	def send_file(self, fp, email_to, email_from=None):
+		'''Sends a message already written to the binary file fp with CRLF line
+		endings e.g. by write_message, streaming it from the file. Reconnects
+		once if the server dropped the connection. Returns the dict of refused
+		recipients
+		'''
+		if email_from == None:
+			email_from = self.username
+		if not self._connected():
+			self.connect()
+		try:
+			refused = self._send_file(fp, email_to, email_from)
+		except smtplib.SMTPServerDisconnected:
+			logger.info('SMTP connection dropped. Reconnecting')
+			self.connect()
+			refused = self._send_file(fp, email_to, email_from)
+		self.last_used = time.monotonic()
+		return refused
+
+	def send_attachments(
+		self,
+		message,
+		subject,
+		email_to,
+		email_from=None,
+		reply_to='NoReply',
+		file_to_send=None,
+		compress=None,
+		max_message_bytes=MAX_MESSAGE_BYTES
+	):
+		'''Sends files as attachments, encoded from disk as they are sent and
+		optionally compressed. When the attachments do not fit in one message
+		of max_message_bytes, they are split across several messages and the
+		subject is numbered e.g. 'Report (1/3)'. Returns the number of messages
+		sent
+
+		PARAMS
+		-----------
+		compress : None, 'gzip' or 'zip'
+		max_message_bytes : maximum size of each message, including encoding
+		See send_gmail for the other PARAMS
+		'''
+		if email_from == None:
+			email_from = self.username
+		# raw bytes that fit in one message once base64 encoded
+		max_part_bytes = (max_message_bytes - MESSAGE_OVERHEAD) // 78 * 57
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			attachments = []
+			if file_to_send != None:
+				attachments = prepare_attachments(
+					file_to_send, tmp_dir, compress, max_part_bytes
+				)
+			groups = group_attachments(attachments, max_message_bytes)
+			for i, group in enumerate(groups, 1):
+				part_subject = subject
+				if len(groups) > 1:
+					part_subject = '{} ({}/{})'.format(subject, i, len(groups))
+				with tempfile.TemporaryFile(dir=tmp_dir) as fp:
+					write_message(
+						fp, message, part_subject, email_to, email_from, reply_to, group
+					)
+					logger.info('Sending {} ({} bytes)'.format(part_subject, fp.tell()))
+					self.send_file(fp, email_to, email_from)
+		return len(groups)
+
+	def send_batch(self, messages, email_from=None):
+		'''Sends a batch of messages over the pooled connection, streaming
+		each one's attachments from disk (see send_attachments). A failed
+		message is logged and does not stop the rest of the batch. Returns a
+		list of (email_to, exception) for the messages that failed
+
+		PARAMS
+		-----------
+		messages : iterable of dicts of send_attachments keyword arguments
+		e.g. {'message' : ..., 'subject' : ..., 'email_to' : ...,
+		'file_to_send' : ...}
+		email_from : envelope sender. Defaults to username
+		'''
+		failed = []
+		sent = 0
+		for kwargs in messages:
+			kwargs = dict(kwargs)
+			kwargs.setdefault('email_from', email_from)
+			try:
+				self.send_attachments(**kwargs)
+				sent += 1
+			except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError,
+				smtplib.SMTPSenderRefused) as e:
+				logger.error('Could not send {} to {}: {}'.format(
+					kwargs['subject'], kwargs['email_to'], e
+				))
+				failed.append((kwargs['email_to'], e))
+		logger.info('Sent {} of {} messages'.format(sent, sent + len(failed)))
+		return failed
+
+	def close(self):
+		'''Closes the connection'''
+		if self.server != None:
+			try:
+				self.server.quit()
+			except (smtplib.SMTPException, OSError):
+				self.server.close()
+			self.server = None
+		return
+
 def send_gmail(
 	message, 
 	subject, 
@@ -34,7 +476,10 @@ def send_gmail(
 	email_from, 
 	password,
 	reply_to='NoReply', 
-	file_to_send=None
+	file_to_send=None,
+	mailer=None,
+	compress=None,
+	max_message_bytes=MAX_MESSAGE_BYTES
 ):
 	'''Sends email with provided file as attachment from email_from to email_to.
 	Username and Password provided for gmail acount that sends email. Only works
@@ -56,99 +501,29 @@ def send_gmail(
 
 	reply_to : email address to which all replies will be addressed
 
-	file_to_send : attachment file
-	'''
+	file_to_send : attachment file or list of files. Attachments are encoded
+	from disk as the email is sent
 
-	# logger.info('Sending Email')
+	mailer : SMTPMailer to send with, reusing its connection. A connection to
+	gmail is opened and closed for this message when None
 
-	msg = MIMEMultipart()
-	msg['From'] = email_from
-	if type(email_to) == list:
-		msg['To'] = ', '.join(email_to)
-	else:
-		msg['To'] = email_to
-	msg['Reply-To'] = reply_to
-	msg['Subject'] = subject
-
-	body = MIMEText(message)
-	msg.attach(body)
-
-	if file_to_send == None:
-		pass
-	elif type(file_to_send) == list:	# Allows for multiple attachments
-		for f in file_to_send:
-			
-			ctype, encoding = mimetypes.guess_type(f)
-			if ctype is None or encoding is not None:
-				ctype = 'application/octet-stream'
-
-			maintype, subtype = ctype.split('/', 1)
-
-			if maintype == 'application':
-				fp = open(f, 'rb')
-				att = MIMEApplication(fp.read(), _subtype=subtype)
-				fp.close()
-			elif maintype == 'text':
-				fp = open(f)
-				att = MIMEText(fp.read(), _subtype=subtype)
-				fp.close()
-			elif maintype == 'image':
-				fp = open(f, 'rb')
-				att = MIMEImage(fp.read(), _subtype=subtype)
-				fp.close()
-			elif maintype == 'audio':
-				fp = open(f, 'rb')
-				att = MIMEAudio(fp.read(), _subtype=subtype)
-				fp.close()
-			else:
-				fp = open(f, 'rb')
-				att = MIMEBase(maintype, subtype)
-				att.set_payload(fp.read())
-				fp.close()
-				encoders.encode_base64(att)
-
-			att.add_header('content-disposition', 'attachment', filename=os.path.basename(f))
-			msg.attach(att)
-	else:
-		ctype, encoding = mimetypes.guess_type(file_to_send)
-		if ctype is None or encoding is not None:
-			ctype = 'application/octet-stream'
-
-		maintype, subtype = ctype.split('/', 1)
-
-		if maintype == 'application':
-				fp = open(file_to_send, 'rb')
-				att = MIMEApplication(fp.read(), _subtype=subtype)
-				fp.close()
-		elif maintype == 'text':
-			fp = open(file_to_send)
-			att = MIMEText(fp.read(), _subtype=subtype)
-			fp.close()
-		elif maintype == 'image':
-			fp = open(file_to_send, 'rb')
-			att = MIMEImage(fp.read(), _subtype=subtype)
-			fp.close()
-		elif maintype == 'audio':
-			fp = open(file_to_send, 'rb')
-			att = MIMEAudio(fp.read(), _subtype=subtype)
-			fp.close()
-		else:
-			fp = open(file_to_send, 'rb')
-			att = MIMEBase(maintype, subtype)
-			att.set_payload(fp.read())
-			fp.close()
-			encoders.encode_base64(att)
-
-		att.add_header('content-disposition', 'attachment', filename=os.path.basename(file_to_send))
-		msg.attach(att)
-
-	server = smtplib.SMTP('smtp.gmail.com', 587)
-	server.ehlo()
-	server.starttls()
-	server.ehlo()
-	server.login(email_from, password)
-	server.sendmail(email_from, email_to, msg.as_string())
-	server.quit()
+	compress : None, 'gzip' or 'zip'. Compresses attachments before sending
+
+	max_message_bytes : attachments that do not fit in one email of this size
+	are split across several emails
+	'''
+	if mailer != None:
+		mailer.send_attachments(
+			message, subject, email_to, email_from, reply_to, file_to_send,
+			compress, max_message_bytes
+		)
+		return
+
+	with SMTPMailer(email_from, password) as mailer:
+		mailer.send_attachments(
+			message, subject, email_to, email_from, reply_to, file_to_send,
+			compress, max_message_bytes
+		)
 
 	return
 
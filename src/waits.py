@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+import json
+import logging
+import math
+import os
+import time
+
+from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import StaleElementReferenceException
+from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import UnexpectedAlertPresentException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# Error dialogs that mean a wait will never succeed. Alerts only count inside
+# a dialog, as pages also show persistent .alert-danger banners e.g. notices
+ERROR_DIALOG_LOCATORS = [
+    (By.CSS_SELECTOR, '.validation-summary-errors, .error-dialog'),
+    (By.CSS_SELECTOR, '.modal .alert-danger, .ui-dialog .alert-danger, '
+        '[role="dialog"] .alert-danger'),
+    (By.ID, 'lblError'),
+]
+
+class ErrorDialogException(Exception):
+    '''Raised when an error dialog appears while waiting for an element'''
+    pass
+
+class AdaptiveWait:
+    '''Explicit, condition based waits with per step timeouts learned from
+    observed latencies. Use with implicit waits disabled, as implicit waits
+    multiply the time spent in every explicit wait poll
+
+    The timeout of a step is multiplier times the percentile of its recent
+    latencies, kept between min_timeout and max_timeout, or default_timeout
+    until min_samples latencies have been seen. While waiting, known error
+    dialogs are checked for so a wait that can not succeed fails fast
+
+    PARAMS
+    --------------
+    session : Selenium webdriver session
+
+    stats_path : PATH to JSON file the latencies are kept in between runs.
+    None keeps them in memory only
+
+    default_timeout : seconds to wait for a step with too few samples
+
+    min_timeout, max_timeout : bounds on a learned timeout
+
+    poll_frequency : seconds between checks of the condition
+
+    percentile, multiplier : learned timeout is multiplier * percentile
+
+    error_locators : (By, value) locators of error dialogs
+    '''
+    def __init__(
+        self,
+        session,
+        stats_path=None,
+        default_timeout=10,
+        min_timeout=2,
+        max_timeout=60,
+        poll_frequency=0.1,
+        percentile=0.95,
+        multiplier=3,
+        min_samples=5,
+        max_samples=100,
+        error_locators=ERROR_DIALOG_LOCATORS
+    ):
+        self.session = session
+        self.stats_path = stats_path
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.poll_frequency = poll_frequency
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.error_locators = error_locators
+        self.stats = {} # step : list of latencies in seconds
+        if stats_path != None and os.path.exists(stats_path):
+            try:
+                with open(stats_path) as f:
+                    self.stats = json.load(f)
+            except ValueError:
+                logger.warning('Wait stats {} are corrupt. Ignoring'.format(stats_path))
+
+    def timeout(self, step):
+        '''Returns the timeout in seconds for step'''
+        samples = self.stats.get(step, [])
+        if len(samples) < self.min_samples:
+            return self.default_timeout
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(math.ceil(self.percentile * len(ordered))) - 1)
+        timeout = ordered[index] * self.multiplier
+        return max(self.min_timeout, min(self.max_timeout, timeout))
+
+    def record(self, step, seconds):
+        '''Records an observed latency for step'''
+        samples = self.stats.setdefault(step, [])
+        samples.append(round(seconds, 3))
+        del samples[:-self.max_samples]
+        return
+
+    def check_errors(self):
+        '''Raises ErrorDialogException if a known error dialog is displayed'''
+        for locator in self.error_locators:
+            for elem in self.session.find_elements(*locator):
+                try:
+                    if elem.is_displayed():
+                        raise ErrorDialogException(elem.text or locator[1])
+                except StaleElementReferenceException:
+                    continue
+        return
+
+    def until(self, method, step='default', message=''):
+        '''Waits until method returns a truthy value and returns it. Drop in
+        replacement for WebDriverWait.until with a step name for the timeout
+
+        A learned timeout that is exceeded is retried once with what is left
+        of default_timeout, as the latencies it was learned from may no longer
+        hold, and the time waited is recorded so later timeouts back off.
+        Raises TimeoutException when the wait still times out and
+        ErrorDialogException when an error dialog appears first
+
+        PARAMS
+        -----------
+        method : condition called with the webdriver e.g. an expected_conditions
+        step : name used to learn and look up the timeout of this wait
+        message : message of the TimeoutException
+        '''
+        timeout = self.timeout(step)
+        polls = [0]
+
+        def condition(driver):
+            result = method(driver)
+            if result:
+                return result
+            # the error check costs a round trip, so only every few polls
+            polls[0] += 1
+            if self.error_locators and polls[0] % 5 == 0:
+                self.check_errors()
+            return False
+
+        start = time.perf_counter()
+        try:
+            try:
+                result = self._wait(condition, timeout, message)
+            except TimeoutException:
+                if timeout >= self.default_timeout:
+                    raise
+                logger.info('Learned timeout of {:.1f}s exceeded for {}. Retrying up to {}s'.format(
+                    timeout, step, self.default_timeout
+                ))
+                result = self._wait(
+                    condition, self.default_timeout - (time.perf_counter() - start), message
+                )
+        except TimeoutException:
+            elapsed = time.perf_counter() - start
+            self.record(step, elapsed)
+            logger.warning('Timed out after {:.1f}s waiting for {}'.format(elapsed, step))
+            raise
+        except UnexpectedAlertPresentException as e:
+            raise ErrorDialogException(e.alert_text or 'Unexpected alert') from e
+        self.record(step, time.perf_counter() - start)
+        return result
+
+    def _wait(self, condition, timeout, message):
+        return WebDriverWait(
+            self.session,
+            timeout,
+            poll_frequency=self.poll_frequency,
+            ignored_exceptions=(NoSuchElementException,)
+        ).until(condition, message)
+
+    def save(self):
+        '''Writes the latencies to stats_path'''
+        if self.stats_path == None:
+            return
+        tmp_path = '{}.{}.tmp'.format(self.stats_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stats, f)
+        os.replace(tmp_path, self.stats_path)
+        return
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+import abc
+import collections
+import csv
+import logging
+import re
+import sqlite3
+import time
+
+from datetime import datetime
+
+from src import columnar
+from src.metrics import timed
+from src.reportstate import fingerprint
+
+# Logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Handler
+log_path = '' # path to log file
+fh = logging.FileHandler('{}deliveries.log'.format(log_path))
+fh.setLevel(logging.INFO)
+# Formatter
+formatter = logging.Formatter(
+    '%(asctime)s : %(name)s : %(levelname)s : %(message)s'
+)
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+# SQLite column affinity for each columnar type
+SQLITE_TYPES = {
+    columnar.ID: 'TEXT',
+    columnar.DATE: 'TEXT', # ISO 8601, sorts and compares as a date
+    columnar.INTEGER: 'INTEGER',
+    columnar.DECIMAL: 'REAL',
+    columnar.CURRENCY: 'REAL',
+    columnar.STRING: 'TEXT',
+}
+
+def table_name(report_name):
+    '''Returns the warehouse table name for report_name
+    e.g. 'Distro - This Week' -> 'distro_this_week'
+    '''
+    return re.sub(r'\W+', '_', report_name).strip('_').lower() or 'report'
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+def _converter(column_type, date_format):
+    '''Returns a function converting a csv cell to the python value stored for
+    column_type. Empty cells become None and cells that do not convert are kept
+    as text, since SQLite stores values of any type in any column
+    '''
+    def convert(value):
+        value = value.strip()
+        if value == '':
+            return None
+        try:
+            if column_type == columnar.INTEGER:
+                return int(value)
+            if column_type == columnar.DECIMAL:
+                return float(value)
+            if column_type == columnar.CURRENCY:
+                number = float(re.sub(r'[$,()]', '', value))
+                return -number if value.startswith('(') else number
+            if column_type == columnar.DATE:
+                # one text form per column, so values compare consistently
+                parsed = datetime.strptime(value, date_format)
+                if columnar.TIME_DIRECTIVE.search(date_format):
+                    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+                return parsed.date().isoformat()
+        except ValueError:
+            pass
+        return value
+    return convert
+
+class WarehouseSink(abc.ABC):
+    '''Interface of a historical store that report exports are loaded into.
+    SQLiteWarehouse is the local implementation, a BigQuery loader can be
+    plugged in by implementing the same methods. A sink missing one of them
+    can not be instantiated
+    '''
+    @abc.abstractmethod
+    def load(self, report_name, csv_path, key_columns=None, watermark_column=None):
+        '''Loads the csv at csv_path into the table for report_name and returns
+        the number of rows written
+        '''
+
+    @abc.abstractmethod
+    def watermark(self, report_name):
+        '''Returns the high watermark of the last load of report_name, or None'''
+
+    def close(self):
+        return
+
+class SQLiteWarehouse(WarehouseSink):
+    '''Keeps the history of every export in a local SQLite database, one table
+    per report, so reports can be queried across runs without reprocessing csvs
+
+    Column types are inferred with columnar.infer_schema, dates are stored as
+    ISO 8601 text and indexed. Each load is written with executemany in a
+    single transaction and recorded in the _loads table with its content hash,
+    so loading an unchanged export is a no-op
+
+    With key_columns rows are upserted on that natural key and the latest
+    version of each row is kept. Without them every export is appended as a
+    snapshot, tagged with the _load_id of the load it came from
+
+    PARAMS
+    --------------
+    db_path : PATH to the SQLite database. Created on first use
+
+    batch_size : rows passed to each executemany call
+    '''
+    def __init__(self, db_path, batch_size=5000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                '''CREATE TABLE IF NOT EXISTS _loads (
+                    load_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    report_name TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    loaded_at TEXT NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    watermark TEXT
+                )'''
+            )
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS _loads_report ON _loads (report_name, load_id)'
+            )
+
+    def _columns(self, table):
+        return [row[1] for row in self.conn.execute(
+            'PRAGMA table_info({})'.format(_quote(table))
+        )]
+
+    def _prepare_table(self, table, schema, key_columns):
+        '''Creates table for schema, or adds columns that are new in this
+        export, and creates the key and date indexes
+        '''
+        existing = self._columns(table)
+        if not existing:
+            columns = ['{} {}'.format(_quote(name), SQLITE_TYPES[column_type])
+                for name, (column_type, _) in schema.items()]
+            columns.append('_load_id INTEGER NOT NULL')
+            self.conn.execute('CREATE TABLE {} ({})'.format(
+                _quote(table), ', '.join(columns)
+            ))
+        else:
+            for name, (column_type, _) in schema.items():
+                if name not in existing:
+                    logger.info('Adding column {} to {}'.format(name, table))
+                    self.conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        _quote(table), _quote(name), SQLITE_TYPES[column_type]
+                    ))
+
+        if key_columns:
+            self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                _quote('{}_key'.format(table)),
+                _quote(table),
+                ', '.join(_quote(c) for c in key_columns)
+            ))
+        for name, (column_type, _) in schema.items():
+            if column_type == columnar.DATE:
+                self.conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    _quote('{}_{}'.format(table, table_name(name))),
+                    _quote(table),
+                    _quote(name)
+                ))
+        return
+
+    def watermark(self, report_name):
+        '''Returns the watermark recorded by the last load of report_name'''
+        row = self.conn.execute(
+            '''SELECT watermark FROM _loads WHERE report_name = ?
+                ORDER BY load_id DESC LIMIT 1''',
+            (report_name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _last_hash(self, report_name):
+        row = self.conn.execute(
+            '''SELECT content_hash FROM _loads WHERE report_name = ?
+                ORDER BY load_id DESC LIMIT 1''',
+            (report_name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @timed('warehouse.load')
+    def load(self, report_name, csv_path, key_columns=None, watermark_column=None):
+        '''Loads the csv at csv_path into the table for report_name and returns
+        the number of rows written. Unchanged exports are skipped
+
+        PARAMS
+        -----------
+        report_name : ekos report name
+        csv_path : PATH to the exported csv
+
+        key_columns : list of columns forming the natural key of a row. Rows
+        are upserted on it. None appends every row
+
+        watermark_column : date column used for incremental loads. The largest
+        value loaded becomes the new watermark. When appending, rows below the
+        previous load's watermark are skipped, as are rows at the watermark
+        that are already in the table, so late rows for the watermark date are
+        added without repeating the rest. With key_columns every row is
+        upserted, so corrections to rows older than the watermark are kept
+        '''
+        content_hash, _ = fingerprint(csv_path)
+        if content_hash == self._last_hash(report_name):
+            logger.info('{} unchanged since last load. Skipping'.format(report_name))
+            return 0
+
+        table = table_name(report_name)
+        schema = columnar.infer_schema(csv_path)
+        missing = [c for c in (key_columns or []) + [watermark_column]
+            if c != None and c not in schema]
+        if missing:
+            raise ValueError('Columns {} not in {}'.format(missing, report_name))
+        if watermark_column != None and schema[watermark_column][0] != columnar.DATE:
+            raise ValueError('Watermark column {} is not a date'.format(watermark_column))
+        previous_watermark = self.watermark(report_name) if watermark_column else None
+        # upserts replace rows in place, so only appends can skip old rows
+        skip_below = previous_watermark if not key_columns else None
+
+        start = time.perf_counter()
+        rows_written = 0
+        # one transaction for the whole load, rolled back on any error
+        with self.conn:
+            self._prepare_table(table, schema, key_columns)
+            cursor = self.conn.execute(
+                '''INSERT INTO _loads
+                    (report_name, table_name, content_hash, loaded_at, row_count)
+                    VALUES (?, ?, ?, ?, 0)''',
+                (report_name, table, content_hash, datetime.now().isoformat(sep=' '))
+            )
+            load_id = cursor.lastrowid
+
+            with open(csv_path, newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                converters = [_converter(*schema[name]) for name in header]
+                columns = ', '.join(_quote(name) for name in header + ['_load_id'])
+                sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                    _quote(table), columns, ', '.join('?' * (len(header) + 1))
+                )
+                if key_columns:
+                    updates = ', '.join('{0} = excluded.{0}'.format(_quote(name))
+                        for name in header + ['_load_id'] if name not in key_columns)
+                    sql += ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                        ', '.join(_quote(c) for c in key_columns), updates
+                    )
+
+                watermark_index = header.index(watermark_column) if watermark_column else None
+                new_watermark = previous_watermark
+                # rows at the watermark already loaded, as the export is a snapshot
+                loaded = collections.Counter()
+                if skip_below != None:
+                    loaded.update(tuple(row) for row in self.conn.execute(
+                        'SELECT {} FROM {} WHERE {} = ?'.format(
+                            ', '.join(_quote(name) for name in header),
+                            _quote(table), _quote(watermark_column)
+                        ),
+                        (skip_below,)
+                    ))
+                batch = []
+                for row in reader:
+                    if not any(row):
+                        continue
+                    values = [convert(value) for convert, value in zip(converters, row)]
+                    values += [None] * (len(header) - len(values))
+                    mark = values[watermark_index] if watermark_index != None else None
+                    if mark != None and skip_below != None:
+                        if mark < skip_below:
+                            continue
+                        if mark == skip_below and loaded[tuple(values)] > 0:
+                            loaded[tuple(values)] -= 1
+                            continue
+                    if mark != None and (new_watermark == None or mark > new_watermark):
+                        new_watermark = mark
+                    values.append(load_id)
+                    batch.append(values)
+                    if len(batch) >= self.batch_size:
+                        self.conn.executemany(sql, batch)
+                        rows_written += len(batch)
+                        batch = []
+                if batch:
+                    self.conn.executemany(sql, batch)
+                    rows_written += len(batch)
+
+            self.conn.execute(
+                'UPDATE _loads SET row_count = ?, watermark = ? WHERE load_id = ?',
+                (rows_written, new_watermark, load_id)
+            )
+        logger.info('Loaded {} rows of {} into {} in {:.2f}s'.format(
+            rows_written, report_name, table, time.perf_counter() - start
+        ))
+        return rows_written
+
+    def query(self, sql, params=()):
+        '''Runs a query against the warehouse and returns all rows'''
+        return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+        return
@@ -0,0 +1,67 @@
+import os
+from datetime import date
+from datetime import datetime
+
+import pytest
+
+from src import columnar
+
+REPORT = (
+    'Invoice #,Date,Delivered,Picked Up,Qty,Total\n'
+    '0012,01/02/2023,2023-01-02 10:30:00,01/02/2023 04:15 PM,5,"$1,200.00"\n'
+    '0013,01/03/2023,2023-01-03 00:00:00,01/03/2023 09:05 AM,6,($3.00)\n'
+)
+
+@pytest.fixture
+def report(tmp_path):
+    path = tmp_path / 'report.csv'
+    path.write_text(REPORT)
+    return str(path)
+
+def test_infer_schema(report):
+    schema = columnar.infer_schema(report)
+    assert schema == {
+        'Invoice #' : (columnar.ID, None),
+        'Date' : (columnar.DATE, '%m/%d/%Y'),
+        'Delivered' : (columnar.DATE, '%Y-%m-%d %H:%M:%S'),
+        'Picked Up' : (columnar.DATE, '%m/%d/%Y %I:%M %p'),
+        'Qty' : (columnar.INTEGER, None),
+        'Total' : (columnar.CURRENCY, None),
+    }
+
+def test_load_report_keeps_times(report, tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    table = columnar.load_report(report)
+    assert table.schema.field('Date').type == pa.date32()
+    assert table.schema.field('Delivered').type == pa.timestamp('s')
+    assert table.schema.field('Picked Up').type == pa.timestamp('s')
+
+    # round trip through the parquet cache
+    cached = columnar.ColumnarCache(str(tmp_path / 'cache')).load('Report', report)
+    cached = columnar.ColumnarCache(str(tmp_path / 'cache')).load('Report', report)
+    assert cached.schema.field('Delivered').type == pa.timestamp('s')
+    values = cached.to_pydict()
+    assert values['Date'] == [date(2023, 1, 2), date(2023, 1, 3)]
+    assert values['Delivered'] == [datetime(2023, 1, 2, 10, 30), datetime(2023, 1, 3)]
+    assert values['Picked Up'] == [datetime(2023, 1, 2, 16, 15), datetime(2023, 1, 3, 9, 5)]
+    assert values['Total'] == [1200.0, -3.0]
+
+def test_cache_key_includes_schema(report, tmp_path):
+    cache = columnar.ColumnarCache(str(tmp_path / 'cache'))
+    schema = columnar.infer_schema(report)
+    as_text = dict(schema, Qty=(columnar.STRING, None))
+    assert cache.path('Report', report) == cache.path('Report', report, schema)
+    assert cache.path('Report', report, as_text) != cache.path('Report', report, schema)
+
+def test_prune_keeps_other_reports(report, tmp_path):
+    pytest.importorskip('pyarrow')
+    cache = columnar.ColumnarCache(str(tmp_path / 'cache'), keep=1)
+    # names that start with another report's name, or only differ in punctuation
+    for name in ['Distro-X', 'Distro - X', 'Distro_X', 'Distro__X']:
+        cache.load(name, report)
+    cache.load('Distro', report)
+    cache.prune('Distro')
+
+    for name in ['Distro', 'Distro-X', 'Distro - X', 'Distro_X', 'Distro__X']:
+        assert os.path.exists(cache.path(name, report)), name
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+import pytest
+
+from src.downloads import DownloadTimeout
+from src.downloads import DownloadWatcher
+
+FILENAME = 'Export_20240102030405_.csv'
+
+def _download(directory, chunks, delay, errors):
+    '''Writes chunks to FILENAME.part with delay between them, then renames it
+    into place like firefox does once a download completes
+    '''
+    part = os.path.join(directory, FILENAME + '.part')
+    try:
+        with open(part, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                f.flush()
+                time.sleep(delay)
+        os.replace(part, os.path.join(directory, FILENAME))
+    except OSError as e:
+        errors.append(e)
+
+def test_wait_for_file_ignores_growing_part_file(tmp_path):
+    watcher = DownloadWatcher(str(tmp_path), poll_interval=0.05)
+    watcher.snapshot()
+    chunks = [b'a,b\n', b'1,2\n', b'3,4\n']
+    # stalls longer than the size stability check between chunks
+    errors = []
+    t = threading.Thread(target=_download, args=(str(tmp_path), chunks, 0.5, errors))
+    t.start()
+    path = watcher.wait_for_file('report.csv', timeout=10)
+    with open(path, 'rb') as f:
+        content = f.read()
+    t.join()
+
+    assert path == os.path.join(str(tmp_path), 'report.csv')
+    assert content == b''.join(chunks)
+    assert errors == []
+    assert os.listdir(str(tmp_path)) == ['report.csv']
+
+def test_wait_for_file_times_out_on_part_file_only(tmp_path):
+    watcher = DownloadWatcher(str(tmp_path), poll_interval=0.05)
+    watcher.snapshot()
+    with open(os.path.join(str(tmp_path), FILENAME + '.part'), 'wb') as f:
+        f.write(b'a,b\n')
+    with pytest.raises(DownloadTimeout):
+        watcher.wait_for_file(timeout=0.5)
+
+def test_wait_for_file_requires_full_match(tmp_path):
+    watcher = DownloadWatcher(str(tmp_path), poll_interval=0.05)
+    watcher.snapshot()
+    with open(os.path.join(str(tmp_path), FILENAME + '.bak'), 'wb') as f:
+        f.write(b'a,b\n')
+    with pytest.raises(DownloadTimeout):
+        watcher.wait_for_file(timeout=0.5)
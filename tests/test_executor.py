@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+from src import executor
+from src.jobs import limits_from_config
+
+def test_limits_below_one_rejected():
+    with pytest.raises(ValueError):
+        executor.DAGExecutor(limits={'sheets' : 0})
+    with pytest.raises(ValueError):
+        limits_from_config({'limits' : {'sheets' : 0}})
+
+def test_tasks_that_can_not_start_fail():
+    dag = executor.DAGExecutor(limits={'sheets' : 1}, attempts=1)
+    dag.add('export', lambda inputs: {'path' : 'a.csv'}, resource='browser')
+    dag.add('upload', lambda inputs: None, deps=['export'], resource='sheets')
+    dag.limits['sheets'] = 0 # changed after validation
+    result = {}
+    t = threading.Thread(target=lambda: result.update(dag.run()), daemon=True)
+    t.start()
+    t.join(5)
+    assert not t.is_alive()
+    assert result == {'export' : executor.DONE, 'upload' : executor.FAILED}
+
+def test_dependents_of_failed_task_not_run():
+    ran = []
+    dag = executor.DAGExecutor(attempts=1)
+    dag.add('export', lambda inputs: 1 / 0, resource='browser')
+    dag.add('upload', lambda inputs: ran.append('upload'), deps=['export'], resource='sheets')
+    dag.add('other', lambda inputs: ran.append('other'), resource='sheets')
+    assert dag.run() == {
+        'export' : executor.FAILED,
+        'upload' : executor.UPSTREAM_FAILED,
+        'other' : executor.DONE,
+    }
+    assert ran == ['other']
@@ -0,0 +1,153 @@
+import csv
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+from src.googleapi import SheetsAPI
+
+class _Request:
+    def __init__(self, fail):
+        self.fail = fail
+
+    def execute(self):
+        if self.fail:
+            raise HttpError(Response({'status': 500}), b'backend error')
+        return {}
+
+class FakeService:
+    '''Stands in for a Sheets service, recording each values request as
+    (method, kwargs). Requests fail with HttpError while fail is True
+    '''
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def __getattr__(self, method):
+        def request(**kwargs):
+            self.calls.append((method, kwargs))
+            return _Request(self.fail)
+        return request
+
+    def methods(self):
+        return [method for method, _ in self.calls]
+
+def _write(path, rows):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return str(path)
+
+def _read(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+@pytest.fixture
+def api():
+    return SheetsAPI(scopes=[], spreadsheet_id='sheet')
+
+def test_delta_writes_only_changed_rows(api, tmp_path):
+    snapshot = _write(tmp_path / 'snapshot.csv', [
+        ['Key', 'Value'], ['1', 'a'], ['2', 'b'], ['3', 'c'], ['4', 'd']
+    ])
+    data = _write(tmp_path / 'report.csv', [
+        ['Key', 'Value'], ['1', 'a'], ['2', 'B'], ['4', 'd'], ['5', 'e'], ['6', 'f']
+    ])
+    service = FakeService()
+
+    assert api.import_data_delta(service, data, 'data!A:B', snapshot, max_changes=1)
+    assert service.methods() == ['batchUpdate']
+    body = service.calls[0][1]['body']
+    # 2 updated in place, 5 fills the row freed by 3 and 6 is appended
+    assert [(r['range'], r['values']) for r in body['data']] == [
+        ('data!A3:B4', [['2', 'B'], ['5', 'e']]),
+        ('data!A6:B6', [['6', 'f']]),
+    ]
+    assert _read(snapshot) == [
+        ['Key', 'Value'], ['1', 'a'], ['2', 'B'], ['5', 'e'], ['4', 'd'], ['6', 'f']
+    ]
+
+    # the sheet matches the snapshot, so an unchanged export writes nothing
+    service = FakeService()
+    assert api.import_data_delta(service, data, 'data!A:B', snapshot, max_changes=1)
+    assert service.calls == []
+
+def test_delta_without_snapshot_rewrites_sheet(api, tmp_path):
+    snapshot = str(tmp_path / 'snapshot.csv')
+    rows = [['Key', 'Value'], ['1', 'a']]
+    data = _write(tmp_path / 'report.csv', rows)
+    service = FakeService()
+    service.fail = True
+
+    # the snapshot is only written once the sheet holds the data
+    assert not api.import_data_delta(service, data, 'data!A:B', snapshot)
+    assert not (tmp_path / 'snapshot.csv').exists()
+
+    service = FakeService()
+    assert api.import_data_delta(service, data, 'data!A:B', snapshot)
+    assert service.methods() == ['clear', 'update']
+    assert _read(snapshot) == rows
+
+def test_chunks_split_on_byte_budget(api, tmp_path):
+    # each row is (4 + 3) * 2 + 2 = 16 bytes, so a 40 byte budget sends 3 rows a chunk
+    rows = [['{:04d}'.format(i), 'xxxx'] for i in range(7)]
+    data = _write(tmp_path / 'report.csv', rows)
+    service = FakeService()
+
+    assert api.import_data_chunked(service, data, 'data!A:B', chunk_bytes=40)
+    assert service.methods() == ['clear', 'update', 'update', 'update']
+    chunks = [(kwargs['range'], kwargs['body']['values']) for _, kwargs in service.calls[1:]]
+    assert chunks == [
+        ('data!A1:B3', rows[0:3]),
+        ('data!A4:B6', rows[3:6]),
+        ('data!A7:B7', rows[6:7]),
+    ]
+
+def test_chunks_start_at_range_row(api, tmp_path):
+    rows = [['{:04d}'.format(i), 'xxxx'] for i in range(4)]
+    data = _write(tmp_path / 'report.csv', rows)
+    service = FakeService()
+
+    assert api.import_data_chunked(service, data, 'data!C5:D', chunk_bytes=40, clear=False)
+    assert [kwargs['range'] for _, kwargs in service.calls] == ['data!C5:D7', 'data!C8:D8']
+
+def test_flush_batches_queued_writes(api, tmp_path):
+    data = _write(tmp_path / 'report.csv', [['Key', 'Value'], ['1', 'a']])
+    api.queue_data(data, 'data!A:B')
+    api.queue_data(data, 'copy!A:B')
+    api.queue_values('raw!A1', [['=1+2']], value_input_option='RAW')
+    api.queue_last_updated('info!B1', spreadsheet_id='other')
+    service = FakeService()
+
+    assert api.flush(service)
+    # clears first, then one batchUpdate per spreadsheet and input option
+    assert service.methods() == ['batchClear', 'batchUpdate', 'batchUpdate', 'batchUpdate']
+    assert service.calls[0][1] == {
+        'spreadsheetId': 'sheet', 'body': {'ranges': ['data!A:B', 'copy!A:B']}
+    }
+    updates = {(kwargs['spreadsheetId'], kwargs['body']['valueInputOption']) :
+        [d['range'] for d in kwargs['body']['data']] for _, kwargs in service.calls[1:]}
+    assert updates == {
+        ('sheet', 'USER_ENTERED') : ['data!A:B', 'copy!A:B'],
+        ('sheet', 'RAW') : ['raw!A1'],
+        ('other', 'USER_ENTERED') : ['info!B1'],
+    }
+
+    # the queue is emptied by flush
+    service = FakeService()
+    assert api.flush(service)
+    assert service.calls == []
+
+def test_flush_reports_failure(api, tmp_path):
+    api.queue_values('data!A1', [['a']])
+    service = FakeService()
+    service.fail = True
+    assert not api.flush(service)
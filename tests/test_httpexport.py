@@ -0,0 +1,92 @@
+import csv
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import quote
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from benchmarks.mock_ekos import MockEkosServer
+from src.catalog import ReportCatalog
+from src.httpexport import HttpExportError
+from src.httpexport import HttpExporter
+
+REPORT = 'Bench 25'
+# cookie set by the mock's login form
+COOKIES = [{'name': 'ekos_bench_session', 'value': '1', 'domain': '127.0.0.1'}]
+
+@pytest.fixture
+def server():
+    server = MockEkosServer([REPORT]).start()
+    yield server
+    server.stop()
+
+def _rows(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+def test_export_endpoint(server, tmp_path):
+    exporter = HttpExporter(server.url, {REPORT: '/export?name=' + quote(REPORT)})
+    exporter.load_cookies(COOKIES)
+    path = exporter.export(REPORT, str(tmp_path / 'report.csv'))
+    exporter.close()
+
+    assert len(_rows(path)) == 26 # header and 25 rows
+    assert os.listdir(str(tmp_path)) == ['report.csv']
+
+def test_export_url_resolved_from_catalog(server, tmp_path):
+    catalog = ReportCatalog(str(tmp_path / 'catalog.json'))
+    catalog.update(server.url + 'classic/reports', [{'name': REPORT, 'href': '#', 'index': 0}])
+    exporter = HttpExporter(server.app_url)
+    assert exporter.resolve(REPORT, catalog) == None
+
+    # href of the csv_export link, as read by the browser export
+    catalog.set_export_url(REPORT, server.url + 'export?name=' + quote(REPORT))
+    exporter.load_cookies(COOKIES)
+    path = exporter.export(REPORT, str(tmp_path / 'report.csv'), catalog=catalog)
+    exporter.close()
+
+    assert len(_rows(path)) == 26
+    assert ReportCatalog(catalog.path).get(REPORT)['export_url'].endswith('/export?name=Bench%2025')
+
+def test_expired_cookies_are_not_saved_as_csv(server, tmp_path):
+    exporter = HttpExporter(server.url, {REPORT: '/export?name=' + quote(REPORT)})
+    # no cookies, so the mock redirects to its login page
+    with pytest.raises(HttpExportError):
+        exporter.export(REPORT, str(tmp_path / 'report.csv'))
+    exporter.close()
+
+    assert os.listdir(str(tmp_path)) == []
+
+class _TruncatedHandler(BaseHTTPRequestHandler):
+    '''Promises more bytes than it sends, then drops the connection'''
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', '100000')
+        self.end_headers()
+        self.wfile.write(b'a,b\n1,2\n')
+        self.close_connection = True
+
+def test_partial_export_is_removed(tmp_path):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _TruncatedHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+    exporter = HttpExporter(url, {REPORT: '/export'})
+    try:
+        with pytest.raises(requests.RequestException):
+            exporter.export(REPORT, str(tmp_path / 'report.csv'))
+    finally:
+        exporter.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert os.listdir(str(tmp_path)) == []
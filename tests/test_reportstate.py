@@ -0,0 +1,49 @@
+import json
+import threading
+
+from src import reportstate
+from src.catalog import ReportCatalog
+
+def _concurrently(target, count=8):
+    errors = []
+    def run(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+def test_concurrent_records_are_all_saved(tmp_path):
+    csv_path = tmp_path / 'report.csv'
+    csv_path.write_text('a,b\n1,2\n')
+    state = reportstate.ReportState(str(tmp_path / 'state.json'))
+
+    def record(i):
+        for j in range(5):
+            state.record('Report', 'sheet{}!A:B'.format(i), str(csv_path), str(j))
+    assert _concurrently(record) == []
+
+    saved = reportstate.ReportState(state.state_path)
+    assert len(saved.state) == 8 * 5
+    assert saved.check('Report', 'sheet3!A:B', str(csv_path), '4') == reportstate.UNCHANGED
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == '.tmp'] == []
+
+def test_concurrent_catalog_updates_are_all_saved(tmp_path):
+    catalog = ReportCatalog(str(tmp_path / 'catalog.json'))
+    catalog.update('reports', [{'name': 'Report {}'.format(i), 'href': '#', 'index': i}
+        for i in range(8)])
+
+    def export_urls(i):
+        for j in range(5):
+            catalog.set_export_url('Report {}'.format(i), '/export?name={}&v={}'.format(i, j))
+    assert _concurrently(export_urls) == []
+
+    with open(catalog.path) as f:
+        reports = json.load(f)['reports']
+    assert reports['Report 5']['export_url'] == '/export?name=5&v=4'
+    assert reports['Report 5']['index'] == 5
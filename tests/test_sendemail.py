@@ -0,0 +1,122 @@
+import email
+import io
+import socketserver
+import threading
+
+from email import policy
+from email.message import EmailMessage
+
+import pytest
+
+from src import sendemail
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    '''Minimal SMTP server keeping the raw DATA lines of each message, still
+    dot stuffed, in server.received
+    '''
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 ready')
+        lines = None
+        for line in self.rfile:
+            if lines != None:
+                if line == b'.\r\n':
+                    self.server.received.append(lines)
+                    lines = None
+                    self.reply('250 queued')
+                else:
+                    lines.append(line)
+                continue
+            command = line[:4].decode('ascii').upper()
+            if command == 'DATA':
+                lines = []
+                self.reply('354 go ahead')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SMTPHandler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _mailer(server):
+    return sendemail.SMTPMailer(
+        'me@example.com', None, host='127.0.0.1', port=server.server_address[1],
+        starttls=False
+    )
+
+def _unstuff(lines):
+    return b''.join(line[1:] if line.startswith(b'..') else line for line in lines)
+
+def test_write_message(tmp_path):
+    report = tmp_path / 'report.csv'
+    report.write_bytes(b'id,name\r\n1,caf\xc3\xa9\n' * 5000)
+    out = io.BytesIO()
+    sendemail.write_message(
+        out, 'See attached', 'Report', ['a@example.com', 'b@example.com'],
+        'me@example.com', attachments=[(str(report), 'report.csv', 'text/csv')]
+    )
+    raw = out.getvalue()
+
+    assert all(line.endswith(b'\r\n') for line in raw.splitlines(True))
+    assert all(len(line) <= 78 for line in raw.splitlines(True))
+    msg = email.message_from_bytes(raw, policy=policy.default)
+    assert msg['To'] == 'a@example.com, b@example.com'
+    assert msg['Subject'] == 'Report'
+    body, attachment = msg.iter_parts()
+    assert body.get_content().strip() == 'See attached'
+    assert attachment.get_filename() == 'report.csv'
+    assert attachment.get_content_type() == 'text/csv'
+    assert attachment.get_payload(decode=True) == report.read_bytes()
+
+def test_send_file_dot_stuffs_lines(smtp_server, tmp_path):
+    notes = tmp_path / 'notes.txt'
+    notes.write_bytes(b'.leading dot\r\n..two dots\r\nplain\r\n')
+    out = io.BytesIO()
+    sendemail.write_message(
+        out, '.hidden line\n.', 'Notes', 'a@example.com', 'me@example.com',
+        attachments=[(str(notes), 'notes.txt', 'application/octet-stream')]
+    )
+    with _mailer(smtp_server) as mailer:
+        mailer.send_file(out, 'a@example.com')
+
+    lines, = smtp_server.received
+    # no line of the message ends the DATA command early
+    assert b'..hidden line\r\n' in lines
+    assert _unstuff(lines) == out.getvalue()
+    msg = email.message_from_bytes(_unstuff(lines), policy=policy.default)
+    body, attachment = msg.iter_parts()
+    assert body.get_content().splitlines() == ['.hidden line', '.']
+    assert attachment.get_payload(decode=True) == notes.read_bytes()
+
+def test_send_streams_built_message(smtp_server):
+    msg = EmailMessage()
+    msg['Subject'] = 'Built'
+    msg['To'] = 'a@example.com'
+    msg.set_content('first\n.second', cte='7bit')
+    with _mailer(smtp_server) as mailer:
+        assert mailer.send(msg, ['a@example.com']) == {}
+
+    lines, = smtp_server.received
+    assert b'..second\r\n' in lines
+    received = email.message_from_bytes(_unstuff(lines), policy=policy.default)
+    assert received['Subject'] == 'Built'
+    assert received.get_content().splitlines() == ['first', '.second']
+
+def test_send_file_ends_last_line(smtp_server):
+    out = io.BytesIO(b'Subject: Short\r\n\r\nno newline')
+    with _mailer(smtp_server) as mailer:
+        mailer.send_file(out, 'a@example.com')
+
+    lines, = smtp_server.received
+    assert lines[-1] == b'no newline\r\n'
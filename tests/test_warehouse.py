@@ -0,0 +1,55 @@
+import pytest
+
+from src.warehouse import SQLiteWarehouse
+from src.warehouse import WarehouseSink
+
+@pytest.fixture
+def warehouse(tmp_path):
+    warehouse = SQLiteWarehouse(str(tmp_path / 'warehouse.db'))
+    yield warehouse
+    warehouse.close()
+
+def load(warehouse, tmp_path, text, **kwargs):
+    path = tmp_path / 'report.csv'
+    path.write_text(text)
+    return warehouse.load('Distro', str(path), watermark_column='Date', **kwargs)
+
+def test_upsert_keeps_corrections_below_watermark(warehouse, tmp_path):
+    load(warehouse, tmp_path, 'Invoice #,Date,Qty\n1,01/02/2023,5\n2,01/03/2023,6\n',
+        key_columns=['Invoice #'])
+    load(warehouse, tmp_path, 'Invoice #,Date,Qty\n1,01/02/2023,7\n2,01/03/2023,6\n',
+        key_columns=['Invoice #'])
+    assert warehouse.query('SELECT "Invoice #", "Qty" FROM distro ORDER BY 1') == [
+        ('1', 7), ('2', 6)
+    ]
+    assert warehouse.watermark('Distro') == '2023-01-03'
+
+def test_append_loads_each_row_once(warehouse, tmp_path):
+    load(warehouse, tmp_path, 'Invoice #,Date,Qty\n1,01/02/2023,5\n2,01/03/2023,6\n')
+    # a late row for the watermark date and a new date
+    load(warehouse, tmp_path, 'Invoice #,Date,Qty\n1,01/02/2023,7\n2,01/03/2023,6\n'
+        '4,01/03/2023,2\n3,01/04/2023,1\n')
+    load(warehouse, tmp_path, 'Invoice #,Date,Qty\n2,01/03/2023,6\n4,01/03/2023,2\n'
+        '3,01/04/2023,1\n5,01/04/2023,1\n')
+    assert warehouse.query('SELECT "Invoice #", "Date", "Qty" FROM distro ORDER BY 1') == [
+        ('1', '2023-01-02', 5),
+        ('2', '2023-01-03', 6),
+        ('3', '2023-01-04', 1),
+        ('4', '2023-01-03', 2),
+        ('5', '2023-01-04', 1),
+    ]
+    assert warehouse.watermark('Distro') == '2023-01-04'
+
+def test_date_times_stored_in_one_form(warehouse, tmp_path):
+    load(warehouse, tmp_path, 'Invoice #,Date,Qty\n1,2023-01-03 00:00:00,5\n'
+        '2,2023-01-03 14:00:00,6\n')
+    assert warehouse.query('SELECT "Date" FROM distro ORDER BY 1') == [
+        ('2023-01-03 00:00:00',), ('2023-01-03 14:00:00',)
+    ]
+
+def test_incomplete_sink_can_not_be_created():
+    class LoadOnly(WarehouseSink):
+        def load(self, report_name, csv_path, key_columns=None, watermark_column=None):
+            return 0
+    with pytest.raises(TypeError):
+        LoadOnly()